@@ -0,0 +1,66 @@
+import asyncio
+from typing import Callable, Dict, List
+
+import config
+import log
+from sensors import SensorAlarm
+
+logger = log.alarm_logger
+
+
+class _Window(object):
+
+    def __init__(self):
+        self.alarm = None
+        self.frames = []
+
+
+class AlarmCoalescer(object):
+    """
+    Collapses bursts of alarms of the same type. The first alarm of a burst is emitted right away and opens a
+    window, the alarms arriving within the window are merged into one alarm carrying the number of triggers,
+    the first and last trigger time and up to max_frames representative frames, which is emitted when the
+    window closes. A window that merged alarms is followed by a new one, so continuous activity is reported
+    once per window. It must be used from the control event loop, which runs the window timers.
+    """
+
+    def __init__(self, emit: Callable[[SensorAlarm, List], None]):
+        self.window = config.alarm.coalesce_window
+        # At least the latest frame is kept
+        self.max_frames = max(1, config.alarm.coalesce_frames)
+        self._emit = emit
+        self._windows: Dict[int, _Window] = {}
+
+    def add(self, alarm: SensorAlarm, frame):
+        if self.window <= 0:
+            self._emit(alarm, [frame])
+            return
+        window = self._windows.get(alarm.cate)
+        if window is not None:
+            self._merge(window, alarm, frame)
+            return
+        self._open_window(alarm.cate)
+        self._emit(alarm, [frame])
+
+    def _open_window(self, cate: int):
+        self._windows[cate] = _Window()
+        asyncio.get_event_loop().call_later(self.window, self._close_window, cate)
+
+    def _merge(self, window: _Window, alarm: SensorAlarm, frame):
+        if window.alarm is None:
+            window.alarm = SensorAlarm(alarm.cate, alarm.desc, alarm.time, count=0)
+        window.alarm.count += alarm.count
+        window.alarm.last_time = alarm.last_time
+        window.alarm.trace = list(alarm.trace)
+        # Keep the first frames and always the latest one
+        if len(window.frames) >= self.max_frames:
+            window.frames.pop()
+        window.frames.append(frame)
+
+    def _close_window(self, cate: int):
+        window = self._windows.pop(cate)
+        if window.alarm is not None:
+            self._open_window(cate)
+            logger.info("Coalesced %d alarms of type %d" % (window.alarm.count, cate))
+            window.alarm.mark("coalesced")
+            self._emit(window.alarm, window.frames)
@@ -0,0 +1,203 @@
+import heapq
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import config
+import log
+import metrics
+import net_conn
+from outbox import Outbox, OutboxEntry
+from sensors import MOTION_ALARM, SMOKE_ALARM, SensorAlarm
+
+logger = log.alarm_logger
+
+# Lower value is served first
+ALARM_PRIORITY = {
+    SMOKE_ALARM: 0,
+    MOTION_ALARM: 1
+}
+DEFAULT_PRIORITY = 1
+
+
+class _AlarmJob(object):
+
+    def __init__(self, alarm: SensorAlarm, frames: List):
+        self.alarm = alarm
+        self.frames = frames
+        self.priority = ALARM_PRIORITY.get(alarm.cate, DEFAULT_PRIORITY)
+
+
+class _AlarmQueue(object):
+    """
+    Bounded priority queue. When it is full, the job with the lowest priority (the newest one among equals)
+    is dropped to make room, unless the incoming job ranks even lower.
+    """
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._heap = []
+        self._seq = 0
+        self._cond = threading.Condition()
+
+    def put(self, job: _AlarmJob):
+        """Returns the job dropped to keep the queue bounded, if any."""
+        with self._cond:
+            dropped = None
+            entry = (job.priority, self._seq, job)
+            self._seq += 1
+            if len(self._heap) >= self._maxsize:
+                worst = max(self._heap)
+                if worst < entry:
+                    return job
+                self._heap.remove(worst)
+                heapq.heapify(self._heap)
+                dropped = worst[2]
+            heapq.heappush(self._heap, entry)
+            self._cond.notify()
+            return dropped
+
+    def get(self) -> _AlarmJob:
+        with self._cond:
+            while not self._heap:
+                self._cond.wait()
+            return heapq.heappop(self._heap)[2]
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._heap)
+
+
+class AlarmDispatcher(object):
+    """
+    Encodes and delivers the alarms in worker threads. An alarm is durable only once a worker stored it in the
+    outbox: the queue in front of the workers is in memory, the alarms waiting in it are lost on a crash and the
+    lowest ranked one is dropped when it is full.
+    """
+
+    def __init__(self):
+        self.workers_num = config.alarm.workers
+        self._queue = _AlarmQueue(config.alarm.queue_size)
+        self._workers = []
+        # Opened by start(), in the alarms boot phase
+        self._outbox = None
+        self._flush_lock = threading.Lock()
+        self._flush_thread = None
+        self._flush_requested = False
+
+    def start(self):
+        if self._workers:
+            return
+        self._outbox = Outbox(config.alarm.outbox_path, config.alarm.outbox_quota * 1024 * 1024)
+        for i in range(self.workers_num):
+            t = threading.Thread(target=self._worker, name="AlarmWorker-%d" % i, daemon=True)
+            t.start()
+            self._workers.append(t)
+        logger.info("Alarm dispatcher started with %d workers, %d alarms waiting in the outbox" %
+                    (self.workers_num, self._outbox.pending()))
+        with self._flush_lock:
+            flush_requested = self._flush_requested
+        if flush_requested:
+            self.flush()
+
+    def dispatch(self, alarm: SensorAlarm, frames: List):
+        alarm.mark("queued")
+        dropped = self._queue.put(_AlarmJob(alarm, frames))
+        if dropped:
+            logger.warning("Alarm queue is full, dropped alarm: type %d, time %f" %
+                           (dropped.alarm.cate, dropped.alarm.time))
+
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def outbox_pending(self) -> int:
+        if self._outbox is None:
+            return 0
+        return self._outbox.pending()
+
+    def flush(self):
+        """
+        Delivers the alarms stored in the outbox in the background, e.g. once the connection is back. Requested
+        before the outbox is opened, the flush starts with it.
+        """
+        with self._flush_lock:
+            if self._outbox is None:
+                self._flush_requested = True
+                return
+            if self._flush_thread and self._flush_thread.is_alive():
+                return
+            self._flush_thread = threading.Thread(target=self._flush_outbox, daemon=True)
+            self._flush_thread.start()
+
+    def _flush_outbox(self):
+        if self._outbox.pending() == 0:
+            return
+        logger.info("Flushing %d alarms from the outbox" % self._outbox.pending())
+        delivered = 0
+        start_time = time.monotonic()
+        with ThreadPoolExecutor(max_workers=config.alarm.flush_concurrency) as executor:
+            while True:
+                batch = self._outbox.claim_batch(config.alarm.flush_batch)
+                if not batch:
+                    break
+                results = list(executor.map(self._deliver, batch))
+                delivered += results.count(net_conn.PUSH_DELIVERED)
+                if net_conn.PUSH_RETRY in results:
+                    logger.warning("Failed to deliver alarms from the outbox, will retry on the next flush")
+                    break
+        duration = time.monotonic() - start_time
+        logger.info("Outbox flushed: %d alarms delivered in %.3fs (%.2f alarms/s), %d left" %
+                    (delivered, duration, delivered / duration if duration > 0 else 0, self._outbox.pending()))
+
+    def _deliver(self, entry: OutboxEntry) -> int:
+        try:
+            result = net_conn.push_alarm(entry.alarm, entry.imgs)
+        except Exception as e:
+            logger.error("Failed to deliver alarm: type %d, time %f, error: %s" % (entry.alarm.cate, entry.alarm.time, e))
+            result = net_conn.PUSH_RETRY
+        if result == net_conn.PUSH_RETRY:
+            self._outbox.release(entry.id)
+            return result
+        if result == net_conn.PUSH_REJECTED:
+            # Retrying would block the alarms behind it in the outbox forever
+            logger.error("Alarm rejected by the server, removed from the outbox: type %d, time %f" %
+                         (entry.alarm.cate, entry.alarm.time))
+            metrics.counter("alarms_rejected_total").inc()
+        self._outbox.remove(entry.id)
+        return result
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                self._handle(job)
+            except Exception as e:
+                logger.error("Failed to handle alarm: type %d, time %f, error: %s" % (job.alarm.cate, job.alarm.time, e))
+
+    def _handle(self, job: _AlarmJob):
+        import cv2
+
+        alarm = job.alarm
+        alarm.mark("dequeued")
+        imgs = [cv2.imencode('.jpg', frame)[1].tobytes() for frame in job.frames]
+        alarm.mark("encoded")
+        # Persist before uploading so the alarm survives losing the connection or the power
+        entry = OutboxEntry(self._outbox.append(alarm, imgs), alarm, imgs)
+        alarm.mark("persisted")
+        result = self._deliver(entry)
+        if result == net_conn.PUSH_DELIVERED:
+            alarm.mark("uploaded")
+            _record_trace(alarm)
+        logger.info("Alarm handled: type %d, count %d, result %d, spans: %s" %
+                    (alarm.cate, alarm.count, result,
+                     ", ".join("%s %.3fs" % (stage, duration) for stage, duration in alarm.spans())))
+        if result == net_conn.PUSH_DELIVERED and self._outbox.pending() > 0:
+            self.flush()
+
+
+def _record_trace(alarm: SensorAlarm):
+    for stage, duration in alarm.spans():
+        metrics.histogram("alarm_stage_seconds", stage=stage).observe(duration)
+    if alarm.trace:
+        metrics.histogram("alarm_latency_seconds", type=str(alarm.cate)).observe(alarm.trace[-1][1] - alarm.trace[0][1])
@@ -1,52 +1,134 @@
+import errno
 import json
 import multiprocessing
+import select
 import threading
 import time
-
-import bluetooth
+from typing import List
 
 import log
 import net_conn
 import wifi_manager
-from util import clear_pipe
+import workers
 
 logger = log.bt_logger
 
+# Messages waiting to be handled by the main process. Beyond that the client socket isn't polled anymore, which
+# pushes back on the client.
+MAX_PENDING = 16
+MAX_FRAME_SIZE = 64 * 1024
+# Messages waiting to be sent to a client that doesn't read them, beyond that it is disconnected
+MAX_OUTGOING = 256 * 1024
+
+
+class FrameDecoder(object):
+    """
+    Splits the received bytes into JSON object messages, whatever the way they are split into or coalesced across
+    reads, separated by newlines or not. A frame that fails to decode is taken as incomplete until a newline
+    follows the error, then it is skipped up to that newline. JSON values other than objects are dropped.
+    """
+
+    def __init__(self):
+        self._buf = b''
+        self._decoder = json.JSONDecoder()
+
+    def feed(self, data: bytes) -> List[dict]:
+        self._buf += data
+        messages = []
+        while True:
+            self._buf = self._buf.lstrip()
+            if not self._buf:
+                break
+            # An UTF-8 sequence split across reads is kept as is until the rest arrives
+            text = self._buf.decode('utf8', 'surrogateescape')
+            try:
+                message, end = self._decoder.raw_decode(text)
+            except ValueError as e:
+                newline = text.find('\n', e.pos)
+                if newline < 0:
+                    # Incomplete, e.g. cut inside a literal or an escape, waits for the rest
+                    break
+                logger.warning("Decode message error %s", e)
+                self._buf = text[newline + 1:].encode('utf8', 'surrogateescape')
+                continue
+            self._buf = text[end:].encode('utf8', 'surrogateescape')
+            if isinstance(message, dict):
+                messages.append(message)
+            else:
+                logger.warning("Message that isn't a JSON object dropped")
+        if len(self._buf) > MAX_FRAME_SIZE:
+            logger.warning("Message longer than %d bytes, discarded" % MAX_FRAME_SIZE)
+            self._buf = b''
+        return messages
+
 
 class BluetoothService:
+    """
+    The service process waits in poll() on the listening socket, the client socket and the pipe carrying the
+    outgoing messages and commands from the main process, so it uses no CPU while idle and all the sockets are
+    handled by a single thread. The client socket is non-blocking, the outgoing messages wait in a buffer sent as
+    the client reads them, so a slow client doesn't hold up the commands.
+    """
 
     def __init__(self, cmd_pipe: multiprocessing.Queue):
         self._uuid = "00001101-0000-1000-8000-00805F9B34FB"
-        self._server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
+        self._server_sock = None
         self._client_sock = None
         self._recv_pipe = cmd_pipe
-        self._cmd_pipe = multiprocessing.Queue()
-        self._is_connecting = False
+        self._cmd_reader, self._cmd_writer = multiprocessing.Pipe(duplex=False)
+        self._cmd_lock = multiprocessing.Lock()
         self._service_process = None
-        self._processing_message = False
+        self._pending = 0
+        # "done" still to come for the messages of the previous clients
+        self._stale_done = 0
+        self._outgoing = bytearray()
+        self._client_events = 0
+        self._decoder = None
+        self._poller = None
+
+    def __getstate__(self):
+        # Sent to the service process when it isn't forked, the process handle stays in the parent
+        state = self.__dict__.copy()
+        state["_service_process"] = None
+        return state
 
     def start(self):
-        clear_pipe(self._cmd_pipe)
-        self._service_process = multiprocessing.Process(target=self._start_service, daemon=True)
+        while self._cmd_reader.poll():
+            self._cmd_reader.recv()
+        self._service_process = workers.process("bluetooth", self._start_service)
         self._service_process.start()
 
+    def is_alive(self) -> bool:
+        try:
+            return self._service_process is not None and self._service_process.is_alive()
+        except ValueError:
+            return False
+
+    def restart(self):
+        try:
+            self._service_process.terminate()
+            self._service_process.join()
+            self._service_process.close()
+        except ValueError:
+            pass
+        self.start()
+
     def _start_service(self):
-        self._is_connecting = False
+        # Only needed in the service process
+        import bluetooth
+
+        # Created in the service process, so a restarted service doesn't find the socket bound by the previous one
+        self._server_sock = bluetooth.BluetoothSocket(bluetooth.RFCOMM)
         self._server_sock.bind(("", bluetooth.PORT_ANY))
         self._server_sock.listen(1)
         bluetooth.advertise_service(self._server_sock, "HomeSecurity", service_id=self._uuid,
                                     service_classes=[self._uuid, bluetooth.SERIAL_PORT_CLASS],
                                     profiles=[bluetooth.SERIAL_PORT_PROFILE])
-
-        self._server_sock.settimeout(1)
-        thread_recv = threading.Thread(target=self._cmd_handler, daemon=True)
-        thread_recv.start()
         logger.info("Bluetooth service started")
-        self._accept_connection()
+        self._serve()
 
     def close(self):
-        clear_pipe(self._cmd_pipe)
-        self._cmd_pipe.put("close")
+        self._send_cmd("close")
         try:
             self._service_process.join()
             self._service_process.close()
@@ -55,22 +137,27 @@ class BluetoothService:
             return
         logger.info("Bluetooth service stopped")
 
+    def _send_cmd(self, cmd: str):
+        # Called from the main process, possibly from several threads
+        with self._cmd_lock:
+            self._cmd_writer.send(cmd)
+
     def close_connection(self):
-        self._cmd_pipe.put("close_connection")
+        self._send_cmd("close_connection")
 
     def command_done(self):
-        self._cmd_pipe.put("done")
+        self._send_cmd("done")
 
     def send_binding_status(self, bound: bool):
         if bound:
             message = {"type": 3, "message": "device is bound to the user", "code": 1}
         else:
             message = {"type": 3, "message": "device unbound", "code": 0}
-        self._cmd_pipe.put(json.dumps(message))
+        self._send_cmd(json.dumps(message))
 
     def send_unbound_message(self):
         message = {"type": 3, "message": "device is bound to another user", "code": 2}
-        self._cmd_pipe.put(json.dumps(message))
+        self._send_cmd(json.dumps(message))
 
     def send_wifi_message(self, code: int):
         message = {"type": 1, "code": code}
@@ -80,7 +167,7 @@ class BluetoothService:
             message["message"] = "failed to connect to wifi"
         elif code == wifi_manager.WIFI_NOT_FOUND:
             message["message"] = "cannot find the wifi"
-        self._cmd_pipe.put(json.dumps(message))
+        self._send_cmd(json.dumps(message))
 
     def send_login_status(self, code: int):
         message = {"type": 4, "code": code}
@@ -88,7 +175,7 @@ class BluetoothService:
             message["message"] = "success"
         else:
             message["message"] = "failed"
-        self._cmd_pipe.put(json.dumps(message))
+        self._send_cmd(json.dumps(message))
 
     def send_bind_message(self, code: int):
         message = {"type": 2, "code": code}
@@ -96,74 +183,235 @@ class BluetoothService:
             message["message"] = "success"
         else:
             message["message"] = "failed to bind user"
-        self._cmd_pipe.put(json.dumps(message))
+        self._send_cmd(json.dumps(message))
 
-    def _accept_connection(self):
-        while True:
-            try:
-                self._client_sock, client_info = self._server_sock.accept()
-                logger.info("Accepted connection from %s", client_info)
-                self._is_connecting = True
-                self._client_sock.settimeout(1)
-                self._processing_message = False
-                while True:
-                    try:
-                        data = self._client_sock.recv(1024)
-                        if data:
-                            logger.info("Received %s", data)
-                            if not self._processing_message:
-                                message = json.loads(data)
-                                self._recv_pipe.put(message)
-                                self._processing_message = True
-                            else:
-                                logger.info("Processing another message now, ignored")
-                        else:
-                            logger.debug("Empty message, ignored")
-                    except json.JSONDecodeError as e:
-                        logger.warning("Decode message error %s", e)
-                        break
-                    except OSError as e:
-                        if str(e) == "timed out":
-                            pass
-                        else:
-                            break
-                logger.info("Disconnected")
-                self._processing_message = False
-                self._client_sock.close()
-                self._is_connecting = False
-            except OSError as e:
-                if str(e) == "timed out":
-                    pass
-                else:
-                    logger.info("Server socket is closed")
-                    break
+    def send_scan_results(self, networks: list, age: float):
+        message = {
+            "type": 5,
+            "code": 0,
+            "message": "success",
+            "age": round(age, 1),
+            "networks": [{
+                "ssid": n.ssid,
+                "signal": n.signal,
+                "freq": n.freq,
+                "key_management": [wifi_manager.akm_names[akm] for akm in n.akm],
+                "cipher": wifi_manager.cipher_names[n.cipher]
+            } for n in networks]
+        }
+        self._send_cmd(json.dumps(message))
+
+    def send_scan_failure(self):
+        message = {"type": 5, "code": 1, "message": "no wifi interface", "networks": []}
+        self._send_cmd(json.dumps(message))
 
-    def _cmd_handler(self):
+    def _serve(self):
+        self._poller = select.poll()
+        self._poller.register(self._server_sock, select.POLLIN)
+        self._poller.register(self._cmd_reader, select.POLLIN)
         while True:
-            cmd: str = self._cmd_pipe.get()
-            if self._is_connecting and cmd == "close_connection":
-                self._processing_message = False
-                logger.info("Closing connection")
-                self._client_sock.close()
+            for fd, event in self._poller.poll():
+                if fd == self._server_sock.fileno():
+                    self._accept()
+                elif fd == self._cmd_reader.fileno():
+                    if not self._handle_cmds():
+                        self._server_sock.close()
+                        return
+                elif self._client_sock is not None and fd == self._client_sock.fileno():
+                    if event & select.POLLOUT:
+                        self._flush()
+                    if self._client_sock is not None and event & ~select.POLLOUT:
+                        self._receive(event)
+
+    def _accept(self):
+        self._client_sock, client_info = self._server_sock.accept()
+        logger.info("Accepted connection from %s", client_info)
+        self._client_sock.setblocking(False)
+        # A single client at a time, the next one waits in the backlog
+        self._poller.unregister(self._server_sock)
+        self._pending = 0
+        self._outgoing = bytearray()
+        self._decoder = FrameDecoder()
+        self._update_events()
+
+    def _disconnect(self):
+        logger.info("Disconnected")
+        if self._client_events:
+            self._poller.unregister(self._client_sock)
+            self._client_events = 0
+        self._client_sock.close()
+        self._client_sock = None
+        # The main process still sends "done" for the messages of this client it hasn't handled yet
+        self._stale_done += self._pending
+        self._pending = 0
+        self._outgoing = bytearray()
+        self._poller.register(self._server_sock, select.POLLIN)
+
+    def _update_events(self):
+        """Polls the client for reading until too many messages are pending, and for writing while some wait."""
+        events = (select.POLLIN if self._pending < MAX_PENDING else 0) | (select.POLLOUT if self._outgoing else 0)
+        if events == self._client_events:
+            return
+        if events:
+            # Modifies the events when it is already registered
+            self._poller.register(self._client_sock, events)
+        else:
+            self._poller.unregister(self._client_sock)
+        self._client_events = events
+
+    def _receive(self, event: int):
+        try:
+            data = self._client_sock.recv(1024) if event & select.POLLIN else b''
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            logger.warning("Failed to receive: %s" % e)
+            data = b''
+        if not data:
+            self._disconnect()
+            return
+        for message in self._decoder.feed(data):
+            logger.info("Received message of type %s", message.get("type"))
+            self._recv_pipe.put(message)
+            self._pending += 1
+        self._update_events()
+
+    def _send(self, data: bytes):
+        self._outgoing += data
+        if len(self._outgoing) > MAX_OUTGOING:
+            logger.warning("Client isn't reading, %d bytes waiting to be sent" % len(self._outgoing))
+            self._disconnect()
+            return
+        self._flush()
+
+    def _flush(self):
+        """Sends what the client socket takes without blocking, the rest when it is writable again."""
+        try:
+            while self._outgoing:
+                sent = self._client_sock.send(self._outgoing)
+                del self._outgoing[:sent]
+        except OSError as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                logger.warning("Failed to send message: %s" % e)
+                self._disconnect()
+                return
+        self._update_events()
+
+    def _handle_cmds(self) -> bool:
+        """Handles all the commands waiting in the pipe, returns False once the service is closed."""
+        while self._cmd_reader.poll():
+            cmd: str = self._cmd_reader.recv()
+            if cmd == "close":
+                return False
             elif cmd == "done":
-                self._processing_message = False
-            elif cmd == "close":
-                self._server_sock.close()
-                break
-            elif self._is_connecting:
+                if self._stale_done:
+                    self._stale_done -= 1
+                    continue
+                self._pending = max(0, self._pending - 1)
+                if self._client_sock is not None:
+                    self._update_events()
+            elif self._client_sock is None:
+                continue
+            elif cmd == "close_connection":
+                logger.info("Closing connection")
+                self._disconnect()
+            else:
                 logger.info("Sending message: %s" % cmd)
-                self._client_sock.send(cmd.encode(encoding="utf-8"))
+                # Newline-delimited, like the received messages
+                self._send((cmd + "\n").encode(encoding="utf-8"))
+        return True
 
 
-# For debugging
+# For debugging: a client over a local socket sending messages at a high rate in random fragments
 def main():
+    import os
+    import random
+    import socket
+    import tempfile
+
+    log.init()
+    # A message split at every byte, also inside the literals and the escapes, then a malformed line
+    message = {"type": 1, "ssid": "caf\u00e9 \u2603", "wifi_password": None, "hidden": True, "open": False}
+    for encoded in (json.dumps(message).encode(), json.dumps(message, ensure_ascii=False).encode()):
+        for split in range(1, len(encoded)):
+            decoder = FrameDecoder()
+            assert decoder.feed(encoded[:split]) == [], split
+            assert decoder.feed(encoded[split:]) == [message], split
+    decoder = FrameDecoder()
+    assert decoder.feed(b'{"type": nul') == []
+    assert decoder.feed(b'x}\n{"type": 2}') == [{"type": 2}]
+    print("Split messages decoded")
+
+    count = 10000
+    path = os.path.join(tempfile.mkdtemp(), "bt")
     pipe = multiprocessing.Queue()
     bts = BluetoothService(pipe)
-    bts.start()
-    time.sleep(7)
+    bts._server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bts._server_sock.bind(path)
+    bts._server_sock.listen(1)
+    service = threading.Thread(target=bts._serve)
+    service.start()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(path)
+
+    # A client sending a single object per write without a newline
+    start_time = time.monotonic()
+    client.sendall(json.dumps({"type": 2}).encode())
+    assert pipe.get(timeout=1) == {"type": 2}
+    bts.send_wifi_message(wifi_manager.SUCCESS)
+    assert json.loads(client.recv(1024))["type"] == 1
+    print("Round trip: %.3f ms" % ((time.monotonic() - start_time) * 1000))
+    bts.command_done()
+
+    payload = b''.join(json.dumps({"type": 1, "ssid": "wifi %d" % i, "wifi_password": "x" * random.randint(0, 2000)})
+                       .encode() + b'\n' for i in range(count))
+
+    def write():
+        pos = 0
+        while pos < len(payload):
+            size = random.randint(1, 3000)
+            client.sendall(payload[pos:pos + size])
+            pos += size
+
+    start_time = time.monotonic()
+    threading.Thread(target=write, daemon=True).start()
+    for i in range(count):
+        message = pipe.get(timeout=5)
+        assert message["ssid"] == "wifi %d" % i, message["ssid"]
+        bts.command_done()
+    duration = time.monotonic() - start_time
+    print("%d messages (%d bytes) in %.2fs, %.0f messages/s" % (count, len(payload), duration, count / duration))
+    client.close()
+
+    # A client that stops reading: its messages and the commands are still handled, then it is disconnected
+    stalled = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stalled.connect(path)
+    start_time = time.monotonic()
+    for i in range(MAX_OUTGOING // 1000 * 4):
+        bts._send_cmd(json.dumps({"type": 5, "networks": "x" * 1000}))
+        if i == 100:
+            stalled.sendall(json.dumps({"type": 2}).encode())
+    assert pipe.get(timeout=1) == {"type": 2}
+    bts.command_done()
+    print("Message received with a stalled client in %.1f ms" % ((time.monotonic() - start_time) * 1000))
+    received = 0
+    while True:
+        data = stalled.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    print("Stalled client disconnected after %d bytes" % received)
+    stalled.close()
+
+    # Idle: the service thread must not use any CPU
+    time.sleep(0.5)
+    start_time = time.process_time()
+    time.sleep(2)
+    print("CPU time while idle: %.1f ms" % ((time.process_time() - start_time) * 1000))
     bts.close_connection()
-    time.sleep(5)
-    bts.close()
+    bts._send_cmd("close")
+    service.join()
+    os.remove(path)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import config
+import log
+import metrics
+
+logger = log.main_logger
+
+PENDING = "pending"
+DONE = "done"
+FAILED = "failed"
+SKIPPED = "skipped"
+
+_start_time = None
+
+
+def process_start_time() -> float:
+    """
+    time.monotonic() when the process was created, taken from the kernel so the interpreter start up and the
+    imports are accounted for. Falls back to the first call when /proc isn't available.
+    """
+    global _start_time
+    if _start_time is None:
+        try:
+            with open('/proc/self/stat', 'r') as f:
+                stat = f.read()
+            # The fields after the command name, which may contain spaces, starting with the state
+            start_ticks = int(stat[stat.rindex(')') + 2:].split()[19])
+            # Counted on the boot time clock, which unlike the monotonic clock keeps running while suspended
+            age = time.clock_gettime(time.CLOCK_BOOTTIME) - start_ticks / os.sysconf('SC_CLK_TCK')
+            _start_time = time.monotonic() - age
+        except (OSError, ValueError, IndexError, AttributeError):
+            _start_time = time.monotonic()
+    return _start_time
+
+
+def since_start() -> float:
+    return time.monotonic() - process_start_time()
+
+
+def since_system_boot() -> float:
+    """Time since the system booted, i.e. since the power came back after a power cut."""
+    return time.clock_gettime(time.CLOCK_BOOTTIME)
+
+
+def check_imports(imported_at: float):
+    """Warns when importing the modules, done at imported_at, took longer than the budget."""
+    duration = imported_at - process_start_time()
+    if duration > config.boot.import_budget:
+        logger.warning("Imports took %.3fs, over the budget of %.3fs" % (duration, config.boot.import_budget))
+    else:
+        logger.info("Imports took %.3fs" % duration)
+
+
+class _Phase(object):
+
+    def __init__(self, name: str, func: Callable[[], Any], requires: Tuple[str, ...]):
+        self.name = name
+        self.func = func
+        self.requires = requires
+        self.status = PENDING
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        # Result True once the phase succeeded, False once it failed or was skipped
+        self.done = asyncio.get_event_loop().create_future()
+
+
+class BootSequence(object):
+    """
+    Boot phases and the phases they require, declared on the event loop. Every phase starts as soon as the phases
+    it requires are done, so independent phases run concurrently. A phase fails when it raises or returns False,
+    the phases requiring it are then skipped. The timeline of the phases is logged once they are all over.
+    """
+
+    def __init__(self):
+        self._phases: Dict[str, _Phase] = {}
+
+    def phase(self, name: str, func: Callable[[], Any], requires: Iterable[str] = ()):
+        """func() may return an awaitable. The required phases must be declared first, so there is no cycle."""
+        requires = tuple(requires)
+        for required in requires:
+            if required not in self._phases:
+                raise ValueError("Phase %s requires the undeclared phase %s" % (name, required))
+        self._phases[name] = _Phase(name, func, requires)
+
+    async def run(self):
+        await asyncio.gather(*(self._run_phase(phase) for phase in self._phases.values()))
+        logger.info("Boot timeline (seconds since the process started):\n%s" % "\n".join(
+            "  %-12s %-8s %s" % (name, status, "%7.3f -> %7.3f" % (start, end) if start is not None else "")
+            for name, status, start, end in self.timeline()))
+
+    async def wait(self, name: str) -> bool:
+        """Waits until the phase is over, returns whether it succeeded."""
+        return await asyncio.shield(self._phases[name].done)
+
+    def timeline(self) -> List[Tuple[str, str, Optional[float], Optional[float]]]:
+        """(name, status, start, end) of the phases in the order they started, times since the process started."""
+        start = process_start_time()
+        phases = sorted(self._phases.values(),
+                        key=lambda phase: phase.start_time if phase.start_time is not None else float("inf"))
+        return [(phase.name, phase.status,
+                 phase.start_time - start if phase.start_time is not None else None,
+                 phase.end_time - start if phase.end_time is not None else None) for phase in phases]
+
+    async def _run_phase(self, phase: _Phase):
+        for required in phase.requires:
+            if not await self._phases[required].done:
+                logger.warning("Boot phase %s skipped, %s didn't succeed" % (phase.name, required))
+                phase.status = SKIPPED
+                phase.done.set_result(False)
+                return
+        phase.start_time = time.monotonic()
+        try:
+            result = phase.func()
+            if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+                result = await result
+            succeeded = result is not False
+        except Exception as e:
+            logger.error("Boot phase %s failed: %s" % (phase.name, e))
+            succeeded = False
+        phase.end_time = time.monotonic()
+        phase.status = DONE if succeeded else FAILED
+        metrics.histogram("boot_seconds", phase=phase.name).observe(phase.end_time - process_start_time())
+        phase.done.set_result(succeeded)
+
+
+# For debugging: imports of main in fresh interpreters against the budget, then the boot of main until armed
+def main():
+    import re
+    import subprocess
+    import sys
+
+    runs = 5
+    totals = []
+    slowest = {}
+    for i in range(runs):
+        result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'],
+                                stderr=subprocess.PIPE, universal_newlines=True)
+        # Listed once imported, after the modules they import
+        children = {}
+        for line in result.stderr.splitlines():
+            match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+            if not match:
+                continue
+            self_us, cumulative_us, indent, module = match.groups()
+            if len(indent) == 3:
+                children[module] = int(cumulative_us) / 1e6
+            elif len(indent) == 1:
+                if module == 'main':
+                    totals.append(int(cumulative_us) / 1e6)
+                    for child, duration in children.items():
+                        slowest[child] = max(slowest.get(child, 0), duration)
+                children = {}
+    totals.sort()
+    print("Import of main: median %.3fs, max %.3fs, budget %.3fs" %
+          (totals[len(totals) // 2], totals[-1], config.boot.import_budget))
+    for module, duration in sorted(slowest.items(), key=lambda item: -item[1])[:10]:
+        print("  %-24s %.3fs" % (module, duration))
+
+    start_time = time.monotonic()
+    process = subprocess.Popen([sys.executable, 'main.py'], stderr=subprocess.PIPE, universal_newlines=True)
+    output = []
+    try:
+        for line in process.stderr:
+            if 'Armed' in line:
+                print("%s (%.3fs measured from outside)" % (line.strip(), time.monotonic() - start_time))
+                break
+            output.append(line)
+        else:
+            print("main exited before being armed:\n%s" % "".join(output[-5:]))
+    finally:
+        process.terminate()
+        process.wait()
+
+
+if __name__ == '__main__':
+    main()
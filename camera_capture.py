@@ -1,168 +1,219 @@
 import multiprocessing as mp
 import time
 from queue import Empty
-from typing import List
-
-import cv2
-import numpy as np
+from typing import List, Optional, Tuple
 
 import config
 import log
-from movement_detection import MovementDetection
+import metrics
+import workers
+from control_block import RUNNING, ControlBlock
+from supervisor import Heartbeat
 from util import clear_pipe
 
 logger = log.capture_logger
 
+WORKERS = ("capture", "detector", "output")
+
 
 class CameraCapture(object):
 
     def __init__(self, camera_num: int, output_frame_pipes: List[mp.Queue]):
         self.camera_num = camera_num
         self.fps = config.capture.fps
-        self.get_cap_process = None
-        self.output_process = None
-        self.frame_processors = []
         self.output_frame_pipes = output_frame_pipes
-        self.resolution = None
-        self.cmd_pipes = [mp.Queue() for _ in range(3)]
+        # Shared with the workers: the run flag stops them all at once, the capture worker fills in the stats
+        self.control = ControlBlock()
+        # Frames handled by each stage, written by the workers and read by the telemetry
+        self.capture_count = mp.Value('L', 0, lock=False)
+        self.detector_count = mp.Value('L', 0, lock=False)
+        self.output_count = mp.Value('L', 0, lock=False)
+        self.heartbeats = {name: Heartbeat() for name in WORKERS}
+        self._specs = {}
+        self._processes = {}
 
-    def get_resolution(self):
-        return self.resolution.copy() if self.resolution else None
+    def __getstate__(self):
+        # Sent to the workers when they aren't forked, the process handles stay in the parent
+        state = self.__dict__.copy()
+        state["_processes"] = {}
+        return state
 
-    def start(self):
-        for pipe in self.cmd_pipes:
-            clear_pipe(pipe)
+    def get_resolution(self) -> Optional[Tuple[int, int]]:
+        """(width, height) of the camera, None until it is opened."""
+        return self.control.resolution()
 
+    def start(self):
+        self.control.set(RUNNING)
         logger.info("Starting camera modules...")
 
         source_pipe4output = mp.Queue()
         source_pipes4processing = [mp.Queue() for _ in range(1)]
         processed_pipes = [mp.Queue() for _ in range(1)]
 
-        self.get_cap_process = mp.Process(target=self._get_cap_frame,
-                                          args=(self.camera_num, source_pipes4processing, source_pipe4output, self.cmd_pipes[0]))
-        self.output_process = mp.Process(target=_output_frame,
-                                         args=(source_pipe4output, processed_pipes, self.output_frame_pipes, self.cmd_pipes[1]))
-        self.get_cap_process.daemon = True
-        self.output_process.daemon = True
+        self._specs = {
+            "capture": (self._get_cap_frame, (self.camera_num, source_pipes4processing, source_pipe4output,
+                                              self.heartbeats["capture"])),
+            "output": (_output_frame, (source_pipe4output, processed_pipes, self.output_frame_pipes, self.control,
+                                       self.output_count, self.heartbeats["output"])),
+            "detector": (_mov_detector, (source_pipes4processing[0], processed_pipes[0], self.control,
+                                         self.detector_count, self.heartbeats["detector"]))
+        }
+        for name in WORKERS:
+            self._start_worker(name)
+
+    def _start_worker(self, name: str):
+        target, args = self._specs[name]
+        process = workers.process(name, target, args)
+        process.start()
+        self._processes[name] = process
 
-        self.frame_processors = [
-            mp.Process(target=_mov_detector, args=(source_pipes4processing[0], processed_pipes[0], self.cmd_pipes[2]))
-        ]
-        self.get_cap_process.start()
-        self.output_process.start()
-        for process in self.frame_processors:
-            process.daemon = True
-            process.start()
+    def is_alive(self, name: str) -> bool:
+        try:
+            return name in self._processes and self._processes[name].is_alive()
+        except ValueError:
+            return False
+
+    def restart_worker(self, name: str):
+        """Replaces a failed worker, keeping the pipes it shares with the others."""
+        process = self._processes.get(name)
+        if process is not None:
+            try:
+                process.terminate()
+                process.join()
+                process.close()
+            except ValueError:
+                pass
+        self._start_worker(name)
 
     def close(self):
         logger.info("Stopping camera modules...")
-        for pipe in self.cmd_pipes:
-            clear_pipe(pipe)
-            pipe.put('stop')
+        self.control.clear(RUNNING)
         try:
-            self.get_cap_process.join()
-            self.get_cap_process.close()
-            self.output_process.join()
-            self.output_process.close()
-            for p in self.frame_processors:
-                p.join()
-                p.close()
+            for name in WORKERS:
+                self._processes[name].join()
+                self._processes[name].close()
         except Exception:
             logger.info("Process already closed")
             return
+        finally:
+            self._processes = {}
         logger.info("Camera modules all stopped")
 
-    def _get_cap_frame(self, camera_num: int, source_pipes4processing: List[mp.Queue], source_pipe4output: mp.Queue, cmd_pipe: mp.Queue, restart_on_err=False):
+    def _get_cap_frame(self, camera_num: int, source_pipes4processing: List[mp.Queue], source_pipe4output: mp.Queue,
+                       heartbeat: Heartbeat):
+        # OpenCV and numpy are only imported by the worker processes
+        import cv2
+
         logger.info("Capture module started")
         camera = cv2.VideoCapture(camera_num)
-        while not camera.isOpened():
+        if not camera.isOpened():
+            # Exits, the supervisor starts the module again after a backoff
             logger.error("Camera failed to start!")
-            if restart_on_err:
-                camera.release()
-                time.sleep(2)
-                camera = cv2.VideoCapture(camera_num)
-            else:
-                self.close()
-                for pipe in source_pipes4processing:
-                    clear_pipe(pipe)
-                clear_pipe(source_pipe4output)
-                return
+            camera.release()
+            return
         logger.info("Camera %d is activated." % camera_num)
         resolution_hw = (int(camera.get(cv2.CAP_PROP_FRAME_HEIGHT)), int(camera.get(cv2.CAP_PROP_FRAME_WIDTH)), 3)
         fps = int(camera.get(cv2.CAP_PROP_FPS))
         logger.info('Resolution: %d x %d | Input fps: %d | Output fps: %d' %
                     (resolution_hw[1], resolution_hw[0], fps, config.capture.fps))
+        self.control.set_stats(resolution_hw[1], resolution_hw[0], fps)
 
         start = time.time()
         initialing = True
         failure_times = 0
         logger.info("Fetching frames from camera")
         frame_time = 1 / config.capture.fps
+        frames = metrics.counter("frames_total", stage="capture")
         while True:
             start_time = time.time()
-            try:
-                cmd = cmd_pipe.get_nowait()
-                if cmd == 'stop':
-                    camera.release()
-                    logger.info("Camera module stopped")
-                    for pipe in source_pipes4processing:
-                        clear_pipe(pipe)
-                    clear_pipe(source_pipe4output)
-                    break
-            except Empty:
-                pass
+            if not self.control.running:
+                camera.release()
+                logger.info("Camera module stopped")
+                for pipe in source_pipes4processing:
+                    clear_pipe(pipe)
+                clear_pipe(source_pipe4output)
+                break
 
+            heartbeat.beat()
             res, frame = camera.read()
             if res:
                 if not initialing or time.time() - start > 5:
                     initialing = False
-                    for pipe in source_pipes4processing:
-                        clear_pipe(pipe, 2)
+                    for i, pipe in enumerate(source_pipes4processing):
+                        clear_pipe(pipe, 2, "detector%d" % i)
                         pipe.put(frame)
-                clear_pipe(source_pipe4output, 2)
+                clear_pipe(source_pipe4output, 2, "output")
                 source_pipe4output.put(frame)
+                self.capture_count.value += 1
+                frames.inc()
+                self.control.frame()
                 failure_times = 0
             else:
                 logger.warning("Failed to get frame from camera")
                 failure_times += 1
                 if failure_times > 1:
-                    time.sleep(2)
-                    logger.info("Trying to restart the capture module")
+                    # Exits, the supervisor starts the module again after a backoff
+                    logger.error("Camera stopped delivering frames")
                     camera.release()
-                    self._get_cap_frame(camera_num, source_pipes4processing, source_pipe4output, cmd_pipe, restart_on_err=True)
                     return
             end_time = time.time()
             if end_time - start_time < frame_time:
                 time.sleep(frame_time - (end_time - start_time))
 
 
-def _mov_detector(source_pipe: mp.Queue, contours_pipe: mp.Queue, cmd_pipe: mp.Queue):
-    logger.info("Motion detector module started")
-    frame = source_pipe.get()
-    md = MovementDetection(frame)
-    while True:
+def _first_frame(source_pipe: mp.Queue, control: ControlBlock, heartbeat: Heartbeat):
+    """Waits for the first frame, returns None if the modules are stopped meanwhile."""
+    while control.running:
+        heartbeat.beat()
         try:
-            cmd = cmd_pipe.get_nowait()
-            if cmd == 'stop':
-                logger.info("Motion detector module stopped")
-                clear_pipe(source_pipe)
-                clear_pipe(contours_pipe)
-                break
+            return source_pipe.get(timeout=1)
         except Empty:
             pass
+    return None
+
+
+def _mov_detector(source_pipe: mp.Queue, contours_pipe: mp.Queue, control: ControlBlock, frame_count,
+                  heartbeat: Heartbeat):
+    from movement_detection import MovementDetection
+
+    logger.info("Motion detector module started")
+    frame = _first_frame(source_pipe, control, heartbeat)
+    if frame is None:
+        logger.info("Motion detector module stopped")
+        return
+    md = MovementDetection(frame)
+    frames = metrics.counter("frames_total", stage="detector")
+    latency = metrics.histogram("detection_seconds", metrics.FRAME_BUCKETS)
+    while True:
+        heartbeat.beat()
+        if not control.running:
+            logger.info("Motion detector module stopped")
+            clear_pipe(source_pipe)
+            clear_pipe(contours_pipe)
+            break
         try:
             frame = source_pipe.get(timeout=1)
+            start_time = time.monotonic()
             contours_frame, flag = md.get_contours4show(frame)
-            clear_pipe(contours_pipe, 2)
+            latency.observe(time.monotonic() - start_time)
+            clear_pipe(contours_pipe, 2, "contours")
             contours_pipe.put((contours_frame, flag))
+            frame_count.value += 1
+            frames.inc()
         except Empty:
             pass
 
 
-def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Queue], output_pipes: List[mp.Queue], cmd_pipe: mp.Queue):
+def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Queue], output_pipes: List[mp.Queue],
+                  control: ControlBlock, frame_count, heartbeat: Heartbeat):
+    import cv2
+    import numpy as np
+
     logger.info("Output module started")
-    frame = source_pipe4output.get()
+    frame = _first_frame(source_pipe4output, control, heartbeat)
+    if frame is None:
+        logger.info("Output module stopped")
+        return
     pipes_frame = [np.zeros(frame.shape, np.uint8) for i in range(len(processed_frame_pipes))]
     pipes_flag = [False for i in range(len(processed_frame_pipes))]
     status = tuple(pipes_flag)
@@ -173,22 +224,22 @@ def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Q
     error_state = False
     error_start_time = 0
     frame_time = 1 / config.capture.fps
+    frames = metrics.counter("frames_total", stage="output")
+    overlay_time = metrics.histogram("overlay_seconds", metrics.FRAME_BUCKETS)
     while True:
         start_time = time.time()
-        try:
-            cmd = cmd_pipe.get_nowait()
-            if cmd == 'stop':
-                logger.info("Output module stopped")
-                clear_pipe(source_pipe4output)
-                for pipe in processed_frame_pipes:
-                    clear_pipe(pipe)
-                for pipe in output_pipes:
-                    clear_pipe(pipe)
-                break
-        except Empty:
-            pass
+        heartbeat.beat()
+        if not control.running:
+            logger.info("Output module stopped")
+            clear_pipe(source_pipe4output)
+            for pipe in processed_frame_pipes:
+                clear_pipe(pipe)
+            for pipe in output_pipes:
+                clear_pipe(pipe)
+            break
         try:
             frame = source_pipe4output.get_nowait()
+            overlay_start = time.monotonic()
             error_state = False
             cur_time_str = time.strftime("%Y/%m/%d %H:%M:%S")
             # cv2.putText(frame, 'refresh_span: %.3f' % (t - frame_update_time), (4, frame.shape[0] - 8), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 255, 0), 1)
@@ -211,6 +262,7 @@ def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Q
                         pipes_flag[i] = False
                 frame = cv2.addWeighted(frame, 1.0, pipes_frame[i], 0.5, 0)
                 status = tuple(pipes_flag)
+            overlay_time.observe(time.monotonic() - overlay_start)
         except Empty:
             if not error_state:
                 error_state = True
@@ -223,9 +275,11 @@ def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Q
                     for q in processed_frame_pipes:
                         if not q.empty():
                             q.get()
-        for pipe in output_pipes:
-            clear_pipe(pipe, 2)
+        for i, pipe in enumerate(output_pipes):
+            clear_pipe(pipe, 2, "media%d" % i)
             pipe.put((frame, status))
+        frame_count.value += 1
+        frames.inc()
         end_time = time.time()
         if end_time - start_time < frame_time:
             time.sleep(frame_time - (end_time - start_time))
@@ -233,6 +287,7 @@ def _output_frame(source_pipe4output: mp.Queue, processed_frame_pipes: List[mp.Q
 
 # For debugging
 def main():
+    log.init()
     cam_pipes = [mp.Queue() for i in range(2)]
     camera_capture = CameraCapture(0, cam_pipes)
     camera_capture.start()
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import log
+import metrics
+
+logger = log.command_logger
+
+ACK_SUCCESS = 0
+ACK_FAILED = 1
+ACK_PREEMPTED = 2
+ACK_INVALID = 3
+ACK_UNKNOWN = 4
+
+
+class Command(object):
+
+    def __init__(self, name: str, handler: Callable[[dict], Awaitable], resources: Tuple[str, ...], preempt: bool):
+        self.name = name
+        self.handler = handler
+        self.resources = tuple(sorted(resources))
+        self.preempt = preempt
+
+
+class _Pending(object):
+
+    def __init__(self, cmd_type: int, command: Command, request_id, sent_at: Optional[float]):
+        self.cmd_type = cmd_type
+        self.command = command
+        self.request_id = request_id
+        self.sent_at = sent_at
+        self.received_at = time.time()
+        self.recv_time = time.monotonic()
+        self.start_time = None
+        self.end_time = None
+        self.task = None
+
+
+class CommandDispatcher(object):
+    """
+    Runs WebSocket commands concurrently on the control event loop. Commands holding a common resource are
+    serialized in arrival order, the others run side by side. A preemptive command (stop, unbind) cancels the
+    commands that share a resource with it and haven't started yet, as its outcome supersedes theirs.
+
+    A message carrying a "request_id" is answered with an ack once it is done, holding the outcome, the time it
+    was received, the transit time from the server (if the message carries the server's "timestamp" in
+    seconds) and the time it spent queued and executing.
+    """
+
+    def __init__(self, send_ack: Callable[[dict], None]):
+        self._send_ack = send_ack
+        self._commands: Dict[int, Command] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self._waiting: List[_Pending] = []
+
+    def register(self, cmd_type: int, name: str, handler: Callable[[dict], Awaitable], resources=(), preempt=False):
+        self._commands[cmd_type] = Command(name, handler, resources, preempt)
+
+    def submit(self, msg: str):
+        data = None
+        try:
+            data = json.loads(msg)
+            cmd_type = data["type"]
+            payload = data["payload"]
+            if not isinstance(cmd_type, int):
+                raise TypeError("the command type isn't an integer")
+        except (ValueError, KeyError, TypeError):
+            logger.warning("Malformed message ignored: %s" % msg)
+            if isinstance(data, dict):
+                self._ack(_Pending(data.get("type"), None, data.get("request_id"), data.get("timestamp")),
+                          ACK_INVALID, "malformed message")
+            return
+        command = self._commands.get(cmd_type)
+        pending = _Pending(cmd_type, command, data.get("request_id"), data.get("timestamp"))
+        if command is None:
+            logger.warning("Unknown command ignored: %s" % msg)
+            self._ack(pending, ACK_UNKNOWN, "unknown command")
+            return
+        logger.info("%s message received: %s" % (command.name, msg))
+        if command.preempt:
+            self._preempt(command)
+        self._waiting.append(pending)
+        pending.task = asyncio.get_event_loop().create_task(self._execute(pending, payload))
+        pending.task.add_done_callback(lambda _: self._finish(pending))
+
+    def _preempt(self, command: Command):
+        for pending in self._waiting:
+            if not pending.command.preempt and set(pending.command.resources) & set(command.resources):
+                logger.info("%s preempted by %s" % (pending.command.name, command.name))
+                pending.task.cancel()
+
+    def _finish(self, pending: _Pending):
+        # A task cancelled before it started never runs its body
+        if pending in self._waiting:
+            self._waiting.remove(pending)
+        if pending.task.cancelled():
+            self._ack(pending, ACK_PREEMPTED, "preempted")
+
+    def _lock(self, resource: str) -> asyncio.Lock:
+        if resource not in self._locks:
+            self._locks[resource] = asyncio.Lock()
+        return self._locks[resource]
+
+    async def _execute(self, pending: _Pending, payload: dict):
+        command = pending.command
+        acquired = []
+        try:
+            # Always in the same order, so commands holding several resources can't deadlock
+            for resource in command.resources:
+                lock = self._lock(resource)
+                await lock.acquire()
+                acquired.append(lock)
+        except asyncio.CancelledError:
+            for lock in acquired:
+                lock.release()
+            raise
+        self._waiting.remove(pending)
+        pending.start_time = time.monotonic()
+        code, message = ACK_SUCCESS, "success"
+        try:
+            await command.handler(payload)
+        except KeyError as e:
+            logger.warning("%s is missing field %s" % (command.name, e))
+            code, message = ACK_INVALID, "missing field %s" % e
+        except Exception as e:
+            logger.error("%s failed: %s" % (command.name, e))
+            code, message = ACK_FAILED, str(e)
+        finally:
+            for lock in acquired:
+                lock.release()
+        pending.end_time = time.monotonic()
+        queue_time = pending.start_time - pending.recv_time
+        exec_time = pending.end_time - pending.start_time
+        metrics.histogram("command_queue_seconds", command=command.name).observe(queue_time)
+        metrics.histogram("command_exec_seconds", command=command.name).observe(exec_time)
+        logger.debug("%s done, queued %.3fs, executed %.3fs" % (command.name, queue_time, exec_time))
+        self._ack(pending, code, message)
+
+    def _ack(self, pending: _Pending, code: int, message: str):
+        if pending.request_id is None:
+            return
+        ack = {
+            "request_id": pending.request_id,
+            "command": pending.cmd_type,
+            "code": code,
+            "message": message,
+            "received_at": pending.received_at,
+            "transit_time": None,
+            "queue_time": None,
+            "exec_time": None
+        }
+        if isinstance(pending.sent_at, (int, float)):
+            ack["transit_time"] = pending.received_at - pending.sent_at
+        if pending.start_time is not None:
+            ack["queue_time"] = pending.start_time - pending.recv_time
+        if pending.end_time is not None:
+            ack["exec_time"] = pending.end_time - pending.start_time
+        self._send_ack(ack)
+
+
+# For debugging: a local stand-in backend driving commands at a high rate and measuring the ack round trip
+def main():
+    import websockets
+
+    import net_conn
+    from ws_client import WsClient
+
+    log.init()
+    net_conn.init()
+    count = 1000
+    port = 8765
+    round_trips = []
+
+    async def backend(conn, path=None):
+        sent = {}
+        for i in range(count):
+            sent[i] = time.monotonic()
+            await conn.send(json.dumps({"type": i % 2 + 1, "payload": {}, "request_id": i, "timestamp": time.time()}))
+        while len(round_trips) < count:
+            ack = json.loads(await conn.recv())["payload"]
+            round_trips.append(time.monotonic() - sent[ack["request_id"]])
+
+    async def noop(payload: dict):
+        pass
+
+    async def run():
+        server = await websockets.serve(backend, "localhost", port)
+        ws = WsClient(lambda msg: dispatcher.submit(msg), url="ws://localhost:%d" % port)
+        dispatcher = CommandDispatcher(lambda ack: ws.send_msg(json.dumps({"type": net_conn.TYPE_ACK, "payload": ack})))
+        dispatcher.register(1, "Command A", noop, resources=("a",))
+        dispatcher.register(2, "Command B", noop, resources=("b",))
+        ws.start()
+        while len(round_trips) < count:
+            await asyncio.sleep(0.1)
+        await ws.close()
+        server.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
+    round_trips.sort()
+    for p in (50, 90, 99, 100):
+        print("p%d: %.2f ms" % (p, round_trips[min(count - 1, count * p // 100)] * 1000))
+
+
+if __name__ == '__main__':
+    main()
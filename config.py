@@ -1,6 +1,8 @@
 import json
+import os
+import threading
 from json import JSONEncoder
-from typing import List, Union
+from typing import Dict, List, Union
 
 
 class Config:
@@ -8,12 +10,35 @@ class Config:
     def __init__(self, data: dict):
         self.bond_user: int = data["bond_user"]
 
+        self.alarm = Config._Alarm(data["alarm"])
+        self.boot = Config._Boot(data["boot"])
         self.capture = Config._Capture(data["capture"])
         self.http = Config._Http(data["http"])
+        self.log = Config._Log(data["log"])
+        self.metrics = Config._Metrics(data["metrics"])
         self.record = Config._Record(data["record"])
         self.sensor = Config._Sensor(data["sensor"])
         self.stream = Config._Stream(data["stream"])
+        self.supervisor = Config._Supervisor(data["supervisor"])
+        self.telemetry = Config._Telemetry(data["telemetry"])
         self.websocket = Config._Websocket(data["websocket"])
+        self.wifi = Config._Wifi(data["wifi"])
+        self.workers = Config._Workers(data["workers"])
+
+    class _Alarm:
+        def __init__(self, data: dict):
+            self.workers: int = data["workers"]
+            self.queue_size: int = data["queue_size"]
+            self.outbox_path: str = data["outbox_path"]
+            self.outbox_quota: int = data["outbox_quota"]
+            self.flush_batch: int = data["flush_batch"]
+            self.flush_concurrency: int = data["flush_concurrency"]
+            self.coalesce_window: float = data["coalesce_window"]
+            self.coalesce_frames: int = data["coalesce_frames"]
+
+    class _Boot:
+        def __init__(self, data: dict):
+            self.import_budget: float = data["import_budget"]
 
     class _Capture:
         def __init__(self, data: dict):
@@ -22,6 +47,39 @@ class Config:
     class _Http:
         def __init__(self, data: dict):
             self.base_url: str = data["base_url"]
+            self.connect_timeout: float = data["connect_timeout"]
+            self.read_timeout: float = data["read_timeout"]
+            self.pool_size: int = data["pool_size"]
+            self.retries: int = data["retries"]
+            self.backoff_base: float = data["backoff_base"]
+            self.backoff_max: float = data["backoff_max"]
+            self.breaker_threshold: int = data["breaker_threshold"]
+            self.breaker_reset: float = data["breaker_reset"]
+
+    class _Log:
+        def __init__(self, data: dict):
+            self.queue_size: int = data["queue_size"]
+            # Per logger, "default" for the others
+            self.limits: Dict[str, Config._LogLimit] = {name: Config._LogLimit(limit)
+                                                        for name, limit in data["limits"].items()}
+
+    class _LogLimit:
+        def __init__(self, data: dict):
+            # Records per second of each call site after the burst
+            self.rate: float = data["rate"]
+            self.burst: int = data["burst"]
+            # Beyond the rate, one record in sample is still written
+            self.sample: int = data["sample"]
+
+    class _Metrics:
+        def __init__(self, data: dict):
+            self.path: str = data["path"]
+            self.interval: int = data["interval"]
+            # Values of each process, on tmpfs
+            self.dir: str = data["dir"]
+            # Prometheus endpoint
+            self.host: str = data["host"]
+            self.port: int = data["port"]
 
     class _Record:
         def __init__(self, data: dict):
@@ -41,10 +99,55 @@ class Config:
             self.fps: int = data['fps']
             self.resolution: List[int] = data["resolution"]
 
+    class _Supervisor:
+        def __init__(self, data: dict):
+            self.interval: float = data["interval"]
+            self.timeout: float = data["timeout"]
+            self.backoff_base: float = data["backoff_base"]
+            self.backoff_max: float = data["backoff_max"]
+
+    class _Telemetry:
+        def __init__(self, data: dict):
+            self.interval: float = data["interval"]
+            self.msgpack: bool = data["msgpack"]
+
     class _Websocket:
         def __init__(self, data: dict):
             self.base_url: str = data["base_url"]
 
+    class _Wifi:
+        def __init__(self, data: dict):
+            self.connect_timeout: float = data["connect_timeout"]
+            self.fast_connect_timeout: float = data["fast_connect_timeout"]
+            self.max_networks: int = data["max_networks"]
+            self.scan_ttl: float = data["scan_ttl"]
+            self.scan_interval: float = data["scan_interval"]
+
+    class _Worker:
+        def __init__(self, data: dict):
+            # Empty for all the CPUs
+            self.cpus: List[int] = data["cpus"]
+            self.nice: int = data["nice"]
+            # other, batch, idle, fifo or rr
+            self.sched: str = data["sched"]
+            # Real time priority, 0 for the other policies
+            self.priority: int = data["priority"]
+
+    class _Workers:
+        def __init__(self, data: dict):
+            # fork or forkserver
+            self.start_method: str = data["start_method"]
+            # Imported by the fork server, forkserver only
+            self.preload: List[str] = data["preload"]
+            self.main = Config._Worker(data["main"])
+            self.capture = Config._Worker(data["capture"])
+            self.detector = Config._Worker(data["detector"])
+            self.output = Config._Worker(data["output"])
+            self.recorder = Config._Worker(data["recorder"])
+            self.stream = Config._Worker(data["stream"])
+            self.sensors = Config._Worker(data["sensors"])
+            self.bluetooth = Config._Worker(data["bluetooth"])
+
 
 class _JsonEncoder(JSONEncoder):
     def default(self, o):
@@ -69,42 +172,97 @@ class WifiProfile:
         self.akm: List[int] = data["akm"]
         self.cipher: int = data["cipher"]
         self.password: str = data["password"]
+        # Link of the last connection, not known for networks saved by older versions
+        self.bssid: Union[str, None] = data.get("bssid")
+        self.freq: Union[int, None] = data.get("freq")
+        self.rssi: Union[int, None] = data.get("rssi")
 
 
-def read_wifi_profile() -> WifiProfile:
+class WifiProfiles:
+    def __init__(self, data: dict):
+        if "networks" not in data:
+            # Single network saved by older versions
+            data = {"networks": [data] if data["ssid"] != "" else []}
+        # Ranked, the last connected first
+        self.networks: List[WifiProfile] = [WifiProfile(n) for n in data["networks"]]
+
+
+def read_wifi_profiles() -> WifiProfiles:
     with open('./wifi_profile.json', 'r', encoding='utf-8') as f:
-        return WifiProfile(json.load(f))
+        return WifiProfiles(json.load(f))
 
 
 def _update_wifi_profile_file():
     with open('./wifi_profile.json', 'r+', encoding='utf-8') as f:
         f.seek(0)
         f.truncate()
-        f.write(json.dumps(wifi_profile, indent=4, cls=_JsonEncoder, ensure_ascii=False))
+        f.write(json.dumps(wifi_profiles, indent=4, cls=_JsonEncoder, ensure_ascii=False))
 
 
-def clear_wifi_profile():
-    wifi_profile.ssid = ""
-    wifi_profile.akm = []
-    wifi_profile.cipher = 0
-    wifi_profile.password = ""
+def save_wifi_profile(profile: WifiProfile):
+    """Saves the network as the best ranked one, replacing the network with the same SSID."""
+    networks = [n for n in wifi_profiles.networks if n.ssid != profile.ssid]
+    wifi_profiles.networks = ([profile] + networks)[:config.wifi.max_networks]
     _update_wifi_profile_file()
 
 
-def update_wifi_profile(ssid: str, akm: List[int], cipher: int, password: str):
-    wifi_profile.ssid = ssid
-    wifi_profile.akm = akm
-    wifi_profile.cipher = cipher
-    wifi_profile.password = password
-    _update_wifi_profile_file()
+# What the user asked the device to do, resumed on boot
+class DeviceState:
+    def __init__(self, data: dict):
+        self.monitoring: bool = data.get("monitoring", False)
+        self.save_mode: int = data.get("save_mode", 0)
+        self.streaming: bool = data.get("streaming", False)
+        self.stream_key: str = data.get("stream_key", "")
+
+
+_state_lock = threading.Lock()
+
+
+def read_device_state() -> DeviceState:
+    try:
+        with open('./state.json', 'r', encoding='utf-8') as f:
+            return DeviceState(json.load(f))
+    except (OSError, ValueError):
+        # Never saved
+        return DeviceState({})
+
+
+def save_device_state(state: DeviceState):
+    """
+    Replaces the state file atomically, a power cut leaves either the previous or the new state. Blocks until the
+    file is on the storage.
+    """
+    global device_state
+    with _state_lock:
+        device_state = state
+        with open('./state.json.tmp', 'w', encoding='utf-8') as f:
+            f.write(json.dumps(state, indent=4, cls=_JsonEncoder, ensure_ascii=False))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace('./state.json.tmp', './state.json')
+        # Makes the rename itself durable
+        dir_fd = os.open('.', os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
 
 config = read_config()
-wifi_profile = read_wifi_profile()
+wifi_profiles = read_wifi_profiles()
+device_state = read_device_state()
 
+alarm = config.alarm
+boot = config.boot
 capture = config.capture
 http = config.http
+log = config.log
+metrics = config.metrics
 record = config.record
 sensor = config.sensor
 stream = config.stream
+supervisor = config.supervisor
+telemetry = config.telemetry
 websocket = config.websocket
+wifi = config.wifi
+workers = config.workers
@@ -0,0 +1,83 @@
+import multiprocessing as mp
+import time
+from typing import Callable, Optional, Tuple
+
+# Flags
+RUNNING = 1
+SAVING = 2
+_FLAGS = (RUNNING, SAVING)
+
+# Interval at which wait_for() checks the flags
+_POLL_INTERVAL = 0.02
+
+
+class ControlBlock(object):
+    """
+    Control flags and live stats of a media module, in shared memory so the parent and the module's processes see
+    the same state at once. Nothing takes a lock: each flag has a byte of its own, written in a single store, so
+    a process terminated at any point can't leave the others waiting for it. wait_for() checks the flags at a
+    short interval. Flags are states, not events: one set and cleared again between two checks goes unnoticed.
+    """
+
+    def __init__(self):
+        self._flags = mp.Array('B', len(_FLAGS), lock=False)
+        self._resolution = mp.Array('i', 2, lock=False)
+        self._fps = mp.Value('d', 0, lock=False)
+        self._last_frame_time = mp.Value('d', 0, lock=False)
+
+    def set(self, flags: int):
+        for i, flag in enumerate(_FLAGS):
+            if flags & flag:
+                self._flags[i] = 1
+
+    def clear(self, flags: int):
+        for i, flag in enumerate(_FLAGS):
+            if flags & flag:
+                self._flags[i] = 0
+
+    def is_set(self, flags: int) -> bool:
+        """True when all the flags are set."""
+        return all(self._flags[i] for i, flag in enumerate(_FLAGS) if flags & flag)
+
+    @property
+    def running(self) -> bool:
+        return self.is_set(RUNNING)
+
+    @property
+    def saving(self) -> bool:
+        return self.is_set(SAVING)
+
+    def wait_for(self, predicate: Callable[[], bool], timeout: float = None) -> bool:
+        """Waits until the flags satisfy the predicate, returns the last result of the predicate."""
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            result = predicate()
+            if result:
+                return result
+            if end is None:
+                time.sleep(_POLL_INTERVAL)
+                continue
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return result
+            time.sleep(min(_POLL_INTERVAL, remaining))
+
+    def set_stats(self, width: int, height: int, fps: float):
+        self._resolution[0] = width
+        self._resolution[1] = height
+        self._fps.value = fps
+
+    def resolution(self) -> Optional[Tuple[int, int]]:
+        """(width, height), None until the module got its first frame."""
+        width, height = self._resolution
+        return (width, height) if width else None
+
+    def fps(self) -> float:
+        return self._fps.value
+
+    def frame(self):
+        self._last_frame_time.value = time.monotonic()
+
+    def last_frame_time(self) -> float:
+        """time.monotonic() of the last frame, 0 if there was none."""
+        return self._last_frame_time.value
@@ -0,0 +1,130 @@
+import random
+import threading
+import time
+from typing import Optional
+
+import config
+import log
+import metrics
+
+logger = log.net_logger
+
+
+class _CircuitBreaker(object):
+    """
+    Opens after `threshold` consecutive failures and rejects requests for `reset_time` seconds, then lets a single
+    trial request through. A success closes it again, a failure keeps it open for another period.
+    """
+
+    def __init__(self, threshold: int, reset_time: float):
+        self.threshold = threshold
+        self.reset_time = reset_time
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._failures < self.threshold:
+                return True
+            if not self._trial and time.monotonic() - self._opened_at >= self.reset_time:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self._failures >= self.threshold:
+                logger.info("Circuit breaker closed")
+            self._failures = 0
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures == self.threshold or self._trial:
+                logger.warning("Circuit breaker opened after %d failures" % self._failures)
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def cancel_trial(self):
+        """Lets another trial request through, the one allowed ended with neither a success nor a failure."""
+        with self._lock:
+            self._trial = False
+
+    def is_open(self) -> bool:
+        with self._lock:
+            return self._failures >= self.threshold
+
+
+class HttpClient(object):
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url
+        self.timeout = (config.http.connect_timeout, config.http.read_timeout)
+        self.retries = config.http.retries
+        self.backoff_base = config.http.backoff_base
+        self.backoff_max = config.http.backoff_max
+        self.breaker = _CircuitBreaker(config.http.breaker_threshold, config.http.breaker_reset)
+        import requests
+
+        # Keep-alive session shared by all requests, so they don't pay a new TCP/TLS handshake each time
+        self._session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=config.http.pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+
+    def post(self, path: str, retries=None, idempotent=True, **kwargs) -> Optional['requests.Response']:
+        """
+        Retries on connection errors, timeouts and 5xx responses with exponential backoff and full jitter. A request
+        that isn't idempotent, e.g. one creating a record, is only retried when it can't have reached the server.
+        Returns the last response received, or None if there is none or the circuit breaker is open.
+        """
+        import requests
+
+        retries = self.retries if retries is None else retries
+        url = self.base_url + path
+        latency = metrics.histogram("http_request_seconds", path=path)
+        errors = metrics.counter("http_errors_total", path=path)
+        response = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt)))
+            if not self.breaker.allow():
+                logger.debug("Circuit breaker is open, request to %s rejected" % path)
+                errors.inc()
+                return response
+            start_time = time.monotonic()
+            error = None
+            try:
+                response = self._session.request('POST', url, timeout=self.timeout, **kwargs)
+            except requests.RequestException as e:
+                error = e
+            except BaseException:
+                # Neither a success nor a failure, a trial request must not keep the breaker half open
+                self.breaker.cancel_trial()
+                raise
+            latency.observe(time.monotonic() - start_time)
+            if error is None and response.status_code < 500:
+                self.breaker.record_success()
+                return response
+            errors.inc()
+            self.breaker.record_failure()
+            if error is not None:
+                logger.debug("Request to %s failed: %s" % (path, error))
+            if not idempotent and (error is None or not _not_sent(error)):
+                # The server may have processed it, retrying could do it twice
+                return response
+        return response
+
+
+def _not_sent(error: Exception) -> bool:
+    """True when the request failed before reaching the server, no connection could be established."""
+    import requests
+    import urllib3
+
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
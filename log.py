@@ -1,64 +1,257 @@
+import atexit
 import logging.handlers
+import multiprocessing as mp
 import os
+import queue
+import signal
+import threading
+import time
 
-if not os.path.exists("./log"):
-    os.makedirs("./log")
+import config
 
+LOG_DIR = "./log"
 LOG_FORMAT = "[%(asctime)s][%(levelname)s][%(name)s]%(message)s"
 DATE_FORMAT = "%Y/%m/%d %H:%M:%S"
-logging.basicConfig(level=logging.INFO, format=LOG_FORMAT, datefmt=DATE_FORMAT)
-formatter = logging.Formatter("[%(asctime)s][%(levelname)s][%(name)s]%(message)s", datefmt="%Y/%m/%d %H:%M:%S")
 
 main_logger = logging.getLogger("Main")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/main.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-main_logger.addHandler(file_handler)
-
 ws_logger = logging.getLogger("WebSocket")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/websocket_service.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-ws_logger.addHandler(file_handler)
-
 wifi_logger = logging.getLogger("WifiManager")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/wifi_manager.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-wifi_logger.addHandler(file_handler)
-
 sensor_logger = logging.getLogger("Sensors")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/sensors.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-sensor_logger.addHandler(file_handler)
-
 bt_logger = logging.getLogger("BluetoothService")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/bluetooth_service.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-bt_logger.addHandler(file_handler)
-
 net_logger = logging.getLogger("NetConn")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/net_conn.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-net_logger.addHandler(file_handler)
-
 capture_logger = logging.getLogger("CameraCapture")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/camera_capture.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-capture_logger.addHandler(file_handler)
-
 stream_logger = logging.getLogger("StreamPusher")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/stream_pusher.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-stream_logger.addHandler(file_handler)
-
 recorder_logger = logging.getLogger("VideoRecorder")
-file_handler = logging.handlers.TimedRotatingFileHandler('./log/video_recorder.log', when='midnight', interval=1, backupCount=7)
-file_handler.setFormatter(formatter)
-file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
-recorder_logger.addHandler(file_handler)
+alarm_logger = logging.getLogger("AlarmDispatcher")
+command_logger = logging.getLogger("CommandDispatcher")
+supervisor_logger = logging.getLogger("Supervisor")
+
+# Log file of each logger, opened by the writer process
+_log_files = {
+    main_logger: "main.log",
+    ws_logger: "websocket_service.log",
+    wifi_logger: "wifi_manager.log",
+    sensor_logger: "sensors.log",
+    bt_logger: "bluetooth_service.log",
+    net_logger: "net_conn.log",
+    capture_logger: "camera_capture.log",
+    stream_logger: "stream_pusher.log",
+    recorder_logger: "video_recorder.log",
+    alarm_logger: "alarm_dispatcher.log",
+    command_logger: "command_dispatcher.log",
+    supervisor_logger: "supervisor.log"
+}
+_queue = None
+_writer = None
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Limits the records of each call site, so a message logged in a hot loop can't flood the log: a call site may
+    log a burst of records, then the rate of records per second of its logger, as set in config.json. Beyond that
+    one record in sample still passes, telling how many were suppressed since the last one passed.
+    """
+
+    def __init__(self, limits: dict):
+        super().__init__()
+        self._limits = limits
+        self._sites = {}
+        self._lock = threading.Lock()
+        # A lock held by another thread while forking would stay locked in the child
+        os.register_at_fork(after_in_child=self._reinit)
+
+    def _reinit(self):
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (record.name, record.pathname, record.lineno)
+        # Not the time of the record, the wall clock steps when it is synchronized after boot
+        now = time.monotonic()
+        with self._lock:
+            site = self._sites.get(key)
+            if site is None:
+                limit = self._limits.get(record.name, self._limits["default"])
+                site = self._sites[key] = _CallSite(limit, now)
+            limit = site.limit
+            site.tokens = min(limit.burst, site.tokens + (now - site.last) * limit.rate)
+            site.last = now
+            if site.tokens < 1 and site.suppressed + 1 < limit.sample:
+                site.suppressed += 1
+                return False
+            site.tokens = max(site.tokens - 1, 0)
+            suppressed, site.suppressed = site.suppressed, 0
+        if suppressed:
+            record.msg = "%s (%d similar suppressed)" % (record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+
+class _CallSite(object):
+
+    def __init__(self, limit, now: float):
+        self.limit = limit
+        self.tokens = float(limit.burst)
+        self.last = now
+        self.suppressed = 0
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Never blocks: when the writer falls behind the records are dropped, counted in the next one queued."""
+
+    def __init__(self, log_queue: mp.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord):
+        if self.dropped:
+            record.msg = "%s (%d records dropped before)" % (record.msg, self.dropped)
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+def init():
+    """
+    Starts the writer process, the only one writing the console and the log files, so they are rotated by a single
+    process, and sends the records of this process to it. Once at boot, after the start method of the workers
+    is set and before the workers are started so the forked ones inherit the handler.
+    """
+    global _queue
+    if _queue is not None:
+        return
+    _queue = mp.Queue(config.log.queue_size)
+    _start_writer()
+    _install(_queue)
+    atexit.register(_stop_writer, os.getpid())
+
+
+def init_worker(log_queue: mp.Queue):
+    """Sends the records of a worker process to the writer, unless it is forked from a process already doing so."""
+    global _queue
+    if _queue is not None:
+        return
+    _queue = log_queue
+    _install(log_queue)
+
+
+def get_queue() -> mp.Queue:
+    return _queue
+
+
+def writer_alive() -> bool:
+    try:
+        return _writer is not None and _writer.is_alive()
+    except ValueError:
+        return False
+
+
+def restart_writer():
+    """Replaces a dead writer process, the records queued meanwhile are written by the new one."""
+    try:
+        _writer.terminate()
+        _writer.join()
+        _writer.close()
+    except ValueError:
+        pass
+    _start_writer()
+
+
+def _install(log_queue: mp.Queue):
+    handler = _QueueHandler(log_queue)
+    handler.addFilter(RateLimitFilter(config.log.limits))
+    root = logging.getLogger()
+    root.setLevel(logging.INFO)
+    # Replaces any handler, pywifi configures the root logger
+    root.handlers = [handler]
+
+
+def _start_writer():
+    global _writer
+    _writer = mp.Process(target=_write, args=(_queue,), daemon=True, name="log")
+    _writer.start()
+
+
+def _stop_writer(pid: int):
+    # Not in the forked processes, which inherit the exit handlers
+    if os.getpid() != pid or not writer_alive():
+        return
+    _queue.put(None)
+    _writer.join(5)
+
+
+def _write(log_queue: mp.Queue):
+    """Writer process: hands every record to the handlers of its logger until the main process stops it."""
+    # Stopped by the main process once its last records are queued
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The records wait in the queue, the workers have priority
+    os.nice(10)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT)
+    console = logging.StreamHandler()
+    console.setFormatter(formatter)
+    logging.getLogger().handlers = [console]
+    for logger, file_name in _log_files.items():
+        # Opened on the first record, so the loggers with nothing to log cost nothing
+        file_handler = logging.handlers.TimedRotatingFileHandler(os.path.join(LOG_DIR, file_name), when='midnight',
+                                                                 interval=1, backupCount=7, delay=True)
+        file_handler.setFormatter(formatter)
+        file_handler.suffix = "%Y-%m-%d_%H-%M-%S.log"
+        logger.handlers = [file_handler]
+    parent = mp.parent_process()
+    while True:
+        try:
+            record = log_queue.get(timeout=1)
+        except queue.Empty:
+            # Exits with the main process, also when it is killed without stopping the writer
+            if parent.is_alive():
+                continue
+            break
+        if record is None:
+            break
+        logging.getLogger(record.name).handle(record)
+
+
+# For debugging: overhead of logging in the hot path, before with a file handler per process and now
+def main():
+    import tempfile
+
+    init()
+    logger = logging.getLogger("Benchmark")
+    root = logging.getLogger()
+    queue_handler = root.handlers[0]
+    frame_time = 1 / config.capture.fps
+    calls = 20000
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_handler = logging.FileHandler(os.path.join(tmp_dir, "benchmark.log"))
+        file_handler.setFormatter(logging.Formatter(LOG_FORMAT, datefmt=DATE_FORMAT))
+        for name, handler, filtered in (("File handler", file_handler, False), ("Queue handler", queue_handler, False),
+                                        ("Queue handler, limited", queue_handler, True)):
+            root.handlers = [handler]
+            filters = handler.filters
+            if not filtered:
+                handler.filters = []
+            # A frame loop logging a message in each frame, against 1% of the frame time
+            costs = []
+            for i in range(config.capture.fps * 5):
+                start_time = time.perf_counter()
+                logger.warning("Failed to get frame from camera")
+                costs.append(time.perf_counter() - start_time)
+                time.sleep(frame_time)
+            costs.sort()
+            start_time = time.perf_counter()
+            for i in range(calls):
+                logger.info("Failed to get source frame %d", i)
+            per_call = (time.perf_counter() - start_time) / calls
+            handler.filters = filters
+            print("%-24s per frame p50 %6.1fus p99 %6.1fus max %6.1fus | back to back %5.1fus per call" %
+                  (name, costs[len(costs) // 2] * 1e6, costs[int(len(costs) * 0.99)] * 1e6, costs[-1] * 1e6,
+                   per_call * 1e6))
+        root.handlers = [queue_handler]
+        file_handler.close()
+    print("Cap per frame %.0fus, records dropped with the queue full %d" % (frame_time * 0.01 * 1e6, queue_handler.dropped))
+
+
+if __name__ == '__main__':
+    main()
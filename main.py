@@ -1,27 +1,37 @@
-import json
+import asyncio
+import functools
 import multiprocessing as mp
 import queue
-import threading
 import time
 from typing import List, Union
 
-import cv2
-import numpy as np
-
+import boot
 import config
 import log
+import metrics
 import net_conn
 import wifi_manager
+import workers
+from alarm_coalescer import AlarmCoalescer
+from alarm_dispatcher import AlarmDispatcher
 from bluetooth_service import BluetoothService
 from camera_capture import CameraCapture
+from command_dispatcher import CommandDispatcher
 from net_conn import NetConn, Status
 from sensors import SensorAlarm, SensorMonitoring
 from stream_pusher import StreamPusher
+from supervisor import Supervisor
+from telemetry import RateMeter, Telemetry, cpu_temperature, disk_used
+from util import bridge_pipe
 from video_recorder import VideoRecorder
 
 
 logger = log.main_logger
 
+# The heavy modules (OpenCV, numpy, gpiozero, bluetooth, requests, websockets, jwt) are imported where they are
+# used, mostly by the worker processes, and the modules have no side effects until their init()
+imported_at = time.monotonic()
+
 INIT = 1
 START_STREAMING = 2
 STOP_STREAMING = 3
@@ -33,22 +43,55 @@ UNBINDING = 7
 CAPTURE_ALWAYS_SAVE = 1
 CAPTURE_SAVE_WHEN_MOVING = 2
 
+# The link is supervised on wpa_supplicant events, polling is only a fallback in case an event is missed.
+# While offline, reconnecting is still retried periodically.
+WIFI_POLL_INTERVAL = 60
+WIFI_RETRY_INTERVAL = 5
+
+# Smallest change worth reporting for the noisy telemetry fields
+TELEMETRY_DEADBANDS = {
+    "capture_fps": 1,
+    "detector_fps": 1,
+    "output_fps": 1,
+    "record_fps": 1,
+    "stream_fps": 1,
+    "cpu_temp": 1,
+    "disk_used": 1,
+    "frame_age": 1
+}
+
 
 class Main(object):
+    """
+    The control plane (commands, status, auth refresh, wifi supervision and alarm dispatch) runs as tasks on a
+    single asyncio event loop, blocking calls are moved to the loop's executor. Media workers keep running in
+    their own processes.
+    """
     config = None
 
     def __init__(self):
         self.cam_pipes = [mp.Queue() for _ in range(2)]
         self.alarm_pipe = mp.Queue()
         self.bt_pipe = mp.Queue()
-        self.ws_recv_pipe = mp.Queue()
 
         self.camera_capture = CameraCapture(0, self.cam_pipes)
         self.sensor_monitor = SensorMonitoring(self.alarm_pipe)
         self.stream_pusher = StreamPusher(self.cam_pipes[0])
-        self.net_conn = NetConn(self.ws_recv_pipe)
+        self.command_dispatcher = CommandDispatcher(self._send_ack)
+        self.telemetry = Telemetry(self._send_telemetry, TELEMETRY_DEADBANDS)
+        self.rate_meter = RateMeter()
+        self.net_conn = NetConn(self.command_dispatcher.submit, on_connect=self.telemetry.reset)
         self.video_recorder = VideoRecorder(self.cam_pipes[1])
         self.bt_service = BluetoothService(self.bt_pipe)
+        self.alarm_dispatcher = AlarmDispatcher()
+        self.alarm_coalescer = AlarmCoalescer(self.alarm_dispatcher.dispatch)
+        self.supervisor = Supervisor()
+
+        self.loop = None
+        self.boot = None
+        self._link_events = None
+        self._register_commands()
+        self._watch_workers()
 
         self.connected = False
         self.is_monitoring = False
@@ -57,207 +100,439 @@ class Main(object):
         self.capture_save_mode = 0
 
     def run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_until_complete(self._run())
+
+    async def _run(self):
         logger.info("Booting...")
-        self.bt_service.start()
-        thread_status_report = threading.Thread(target=self.ws_status_report, daemon=True)
-        thread_recv = threading.Thread(target=self.ws_recv_handler, daemon=True)
-        thread_alarm = threading.Thread(target=self.sensor_alarm_handler, args=(self.cam_pipes[0],),
-                                        daemon=True)
-        thread_bt_msg = threading.Thread(target=self.bt_message_handler, daemon=True)
-        update_auth_thread = threading.Thread(target=self._update_auth, daemon=True)
-        update_auth_thread.start()
-        thread_status_report.start()
-        thread_recv.start()
-        thread_alarm.start()
-        thread_bt_msg.start()
+        self._link_events = asyncio.Queue()
+        self.boot = boot.BootSequence()
+        # The camera warms up and the sensors are armed while the network is brought up
+        self.boot.phase("bluetooth", self.bt_service.start)
+        self.boot.phase("camera", self.camera_capture.start)
+        self.boot.phase("sensors", self.sensor_monitor.start)
+        # Opens the outbox, SQLite syncs to the disk
+        self.boot.phase("alarms", functools.partial(self._run_blocking, self.alarm_dispatcher.start))
+        self.boot.phase("resume", self._resume, requires=("camera", "sensors"))
+        self.boot.phase("armed", self._armed, requires=("resume", "alarms"))
+        self.boot.phase("wifi_iface", functools.partial(self._run_blocking, wifi_manager.init))
+        self.boot.phase("credentials", functools.partial(self._run_blocking, net_conn.init))
+        self.boot.phase("wifi", self._connect_wifi, requires=("wifi_iface",))
+        self.boot.phase("login", self._login, requires=("wifi", "credentials"))
+        await asyncio.gather(
+            self._task(self.boot.run()),
+            self._task(self._update_auth()),
+            self._task(self._write_metrics()),
+            self._task(self.telemetry_report()),
+            self._task(self.sensor_alarm_handler(self.cam_pipes[0])),
+            self._task(self.bt_message_handler()),
+            self._task(self.wifi_supervisor()),
+            self._task(self.supervisor.run()),
+            self._task(self._serve_metrics())
+        )
+
+    @staticmethod
+    async def _task(coro):
+        """Runs a task of the main loop, a task failing is logged and doesn't stop the others."""
+        try:
+            await coro
+        except Exception as e:
+            logger.error("Task %s failed: %s" % (coro.__qualname__, e))
+
+    def _run_blocking(self, func, *args):
+        return self.loop.run_in_executor(None, functools.partial(func, *args))
+
+    def _resume(self):
+        """Re-arms from the saved state without waiting for the server, e.g. after a power cut."""
+        state = config.device_state
+        if state.monitoring:
+            self._start_monitoring(state.save_mode)
+            gap = boot.since_system_boot()
+            metrics.histogram("resume_seconds").observe(gap)
+            logger.info("Monitoring resumed from the saved state %.3fs after the system booted" % gap)
+
+    def _armed(self):
+        logger.info("Armed %.3fs after the process started" % boot.since_start())
+
+    def _reconcile(self):
+        """
+        Once the net module is started, resumes what was stopped with it and reports the state to the server, which
+        answers with commands if it disagrees.
+        """
+        state = config.device_state
+        if state.monitoring and not self.is_monitoring:
+            logger.info("Resuming monitoring from the saved state")
+            self._start_monitoring(state.save_mode)
+        if state.streaming and not self.stream_pusher.control.running:
+            logger.info("Resuming streaming from the saved state")
+            self.stream_pusher.start(key=state.stream_key)
+        self.send_status()
+        self.alarm_dispatcher.flush()
+
+    async def _connect_wifi(self) -> bool:
+        await self._run_blocking(wifi_manager.start_monitor,
+                                 lambda connected: self.loop.call_soon_threadsafe(self._link_events.put_nowait,
+                                                                                  connected))
         logger.info("Connecting to wifi")
-        if wifi_manager.connect_wifi():
-            self.connected = True
-            logger.info("Wifi connected, trying to start the net module")
-            status = self.net_conn.start()
-            while status is not net_conn.STATUS_SUCCESS:
-                logger.warning("Failed to login")
-                time.sleep(5)
-                status = self.net_conn.start()
-            logger.info("Net module started")
-        else:
+        if not await self._run_blocking(wifi_manager.connect_wifi):
             logger.warning("Failed to connect to wifi")
+            return False
+        return True
+
+    async def _login(self) -> bool:
+        logger.info("Wifi connected, trying to start the net module")
+        if await self.net_conn.start() != net_conn.STATUS_SUCCESS:
+            # Tried again by the wifi supervisor
+            logger.warning("Failed to login")
+            return False
+        self.connected = True
+        logger.info("Net module started")
+        self._reconcile()
+        logger.info("State reconciled with the server %.3fs after the system booted" % boot.since_system_boot())
+        return True
+
+    async def wifi_supervisor(self):
+        # Brought up the first time by the boot
+        await self.boot.wait("login")
+        if not await self.boot.wait("wifi_iface"):
+            logger.error("No wifi interface, wifi supervision stopped")
+            return
         while True:
-            time.sleep(5)
+            try:
+                await asyncio.wait_for(self._link_events.get(),
+                                       WIFI_POLL_INTERVAL if self.connected else WIFI_RETRY_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
             if not self.is_reconnecting:
-                if not wifi_manager.is_connected():
+                if not await self._run_blocking(wifi_manager.is_connected):
                     logger.debug("Disconnected, trying to reconnect to wifi")
-                    self.stop_net_modules(send_status=False)
+                    await self.stop_net_modules(send_status=False)
                     self.connected = False
-                    if wifi_manager.connect_wifi():
+                    if await self._run_blocking(wifi_manager.connect_wifi):
                         logger.debug("Reconnected to wifi")
-                if wifi_manager.is_connected() and not self.connected:
+                if await self._run_blocking(wifi_manager.is_connected) and not self.connected:
                     logger.debug("Trying to restart the net module")
-                    if self.net_conn.start() == net_conn.STATUS_SUCCESS:
+                    if await self.net_conn.start() == net_conn.STATUS_SUCCESS:
                         self.connected = True
                         logger.info("Net module restarted")
+                        self._reconcile()
 
-    def _update_auth(self):
+    async def _update_auth(self):
         logger.debug("Token updater started")
+        failures = 0
         while True:
             if self.net_conn.is_running and net_conn.host and net_conn.host.token_expr - time.time() <= 21600:
                 logger.info("Token expired, trying to renew the token")
-                net_conn.login()
-                self.net_conn.wsClient.restart()
-                logger.info("Token renewing finished")
+                if await self._run_blocking(net_conn.login) == net_conn.STATUS_SUCCESS:
+                    failures = 0
+                    await self.net_conn.wsClient.restart()
+                    logger.info("Token renewing finished")
+                else:
+                    # Fails at once while the circuit breaker is open, waits before trying again
+                    delay = min(3600, config.http.breaker_reset * 2 ** failures)
+                    failures = min(failures + 1, 10)
+                    logger.warning("Failed to renew the token, retrying in %ds" % delay)
+                    await asyncio.sleep(delay)
             else:
-                time.sleep(3600)
+                await asyncio.sleep(3600)
+
+    async def _write_metrics(self):
+        while True:
+            await asyncio.sleep(config.metrics.interval)
+            try:
+                metrics.write()
+            except OSError as e:
+                logger.warning("Failed to write metrics: %s" % e)
+
+    async def _serve_metrics(self):
+        try:
+            await metrics.serve()
+        except OSError as e:
+            logger.error("Failed to serve the metrics: %s" % e)
 
-    def sensor_alarm_handler(self, frame_pipe: mp.Queue):
+    async def sensor_alarm_handler(self, frame_pipe: mp.Queue):
         logger.debug("Alarm handler started")
+        alarm_queue = bridge_pipe(self.alarm_pipe)
         while True:
-            alarm: SensorAlarm = self.alarm_pipe.get()
-            alarm_act_t = time.time()
-            frame = np.zeros((480, 640), np.uint8)
-            if alarm.cate == 1:
-                flag = False
-                while not flag and time.time() - alarm_act_t <= 1.0:
-                    try:
-                        frame, status = frame_pipe.get(timeout=0.5)
-                        if status == 'error':
-                            continue
-                        flag = status[0]
-                    except queue.Empty:
-                        continue
-                if flag:
-                    logger.info("Sending motion alarm with an image of the moving object")
-                else:
-                    logger.info("Sending motion alarm with an image that doesn't contain moving object")
-            else:
+            alarm: SensorAlarm = await alarm_queue.get()
+            if not self.is_monitoring:
+                # The sensors are armed from the boot on, the alarms only count while monitoring
+                logger.debug("Alarm ignored while not monitoring: type %d" % alarm.cate)
+                continue
+            alarm.mark("received")
+            frame = await self._run_blocking(self._get_alarm_frame, alarm, frame_pipe)
+            alarm.mark("frame")
+            self.alarm_coalescer.add(alarm, frame)
+
+    def _get_alarm_frame(self, alarm: SensorAlarm, frame_pipe: mp.Queue):
+        import numpy as np
+
+        alarm_act_t = time.time()
+        frame = np.zeros((480, 640), np.uint8)
+        if alarm.cate == 1:
+            flag = False
+            while not flag and time.time() - alarm_act_t <= 1.0:
                 try:
                     frame, status = frame_pipe.get(timeout=0.5)
+                    if status == 'error':
+                        continue
+                    flag = status[0]
                 except queue.Empty:
-                    frame = np.zeros((480, 640), np.uint8)
-                logger.info("Sending smoke alarm")
-            _, frame_byte = cv2.imencode('.jpg', frame)
-            t = threading.Thread(target=net_conn.push_alarm, args=(alarm, frame_byte), daemon=True)
-            t.start()
+                    continue
+            if flag:
+                logger.info("Sending motion alarm with an image of the moving object")
+            else:
+                logger.info("Sending motion alarm with an image that doesn't contain moving object")
+        else:
+            try:
+                frame, status = frame_pipe.get(timeout=0.5)
+            except queue.Empty:
+                frame = np.zeros((480, 640), np.uint8)
+            logger.info("Sending smoke alarm")
+        return frame
 
-    def bt_message_handler(self):
+    async def bt_message_handler(self):
         logger.debug("Bluetooth message handler started")
+        bt_queue = bridge_pipe(self.bt_pipe)
+        # The wifi commands need the interface, they are answered with a failure without it
+        iface_ready = await self.boot.wait("wifi_iface")
         while True:
-            message = self.bt_pipe.get()
-            logger.info("Bluetooth message received: %s" % message)
+            message = await bt_queue.get()
+            logger.info("Bluetooth message received of type %s" % message.get("type"))
             try:
                 cmd = message["type"]
                 if cmd == 1:
                     ssid: str = message["ssid"]
-                    akm: List[str] = message["key_management"]
-                    cipher: str = message["cipher"]
+                    # Detected from the scan results when not given
+                    akm: Union[List[str], None] = message.get("key_management")
+                    cipher: Union[str, None] = message.get("cipher")
                     try:
                         password: Union[str, None] = message["wifi_password"]
                     except KeyError:
                         password = None
                     user_id: int = message["user_id"]
                     # connect to wifi or bind user
-                    if config.config.bond_user == 0 or config.config.bond_user == user_id:
+                    if not iface_ready:
+                        logger.warning("No wifi interface, cannot connect to wifi")
+                        self.bt_service.send_wifi_message(wifi_manager.CONNECTION_FAILURE)
+                        self.bt_service.command_done()
+                    elif config.config.bond_user == 0 or config.config.bond_user == user_id:
                         self.bt_service.send_binding_status(config.config.bond_user != 0)
                         self.is_reconnecting = True
-                        self.stop_net_modules()
-                        connection_result = wifi_manager.connect_new_wifi(ssid, akm, cipher, password)
-                        self.bt_service.send_wifi_message(connection_result)
-                        if connection_result is wifi_manager.SUCCESS:
-                            logger.info("Connect to wifi successfully")
-                            net_status = self.net_conn.start()
-                            self.bt_service.send_login_status(net_status)
-                            if net_status == net_conn.STATUS_SUCCESS:
-                                logger.info("Connected to the server")
-                                if config.config.bond_user == 0:
-                                    bind_result = net_conn.bind_user(user_id)
-                                    if bind_result == net_conn.STATUS_SUCCESS:
-                                        logger.info("Binding succeed")
-                                    else:
-                                        logger.warning("Binding failed, code %d" % bind_result)
-                                    self.bt_service.send_bind_message(bind_result)
+                        try:
+                            await self.stop_net_modules()
+                            connection_result = await self._run_blocking(wifi_manager.connect_new_wifi,
+                                                                         ssid, akm, cipher, password)
+                            self.bt_service.send_wifi_message(connection_result)
+                            if connection_result is wifi_manager.SUCCESS:
+                                logger.info("Connect to wifi successfully")
+                                net_status = await self.net_conn.start()
+                                self.bt_service.send_login_status(net_status)
+                                if net_status == net_conn.STATUS_SUCCESS:
+                                    logger.info("Connected to the server")
+                                    self.alarm_dispatcher.flush()
+                                    if config.config.bond_user == 0:
+                                        bind_result = await self._run_blocking(net_conn.bind_user, user_id)
+                                        if bind_result == net_conn.STATUS_SUCCESS:
+                                            logger.info("Binding succeed")
+                                        else:
+                                            logger.warning("Binding failed, code %d" % bind_result)
+                                        self.bt_service.send_bind_message(bind_result)
+                                else:
+                                    logger.warning("Failed to connect to the server")
                             else:
-                                logger.warning("Failed to connect to the server")
-                        else:
-                            logger.warning("Failed to connect to wifi")
-                        self.is_reconnecting = False
+                                logger.warning("Failed to connect to wifi")
+                        finally:
+                            # The wifi supervisor takes over again, also when reconnecting failed
+                            self.is_reconnecting = False
                         self.bt_service.command_done()
                     else:
                         logger.warning("Device is not bound to this user and cannot be operated")
                         self.bt_service.send_unbound_message()
                         self.bt_service.command_done()
+                elif cmd == 2:
+                    if not iface_ready:
+                        logger.warning("No wifi interface, cannot scan")
+                        self.bt_service.send_scan_failure()
+                    else:
+                        # Answered from the cache right away, even when a new scan is needed
+                        networks, age = wifi_manager.scan_cache.networks()
+                        self.bt_service.send_scan_results(networks, age)
+                    self.bt_service.command_done()
+                else:
+                    # Every message is answered with done, the service counts them
+                    logger.warning("Unknown bluetooth command %s" % cmd)
+                    self.bt_service.command_done()
             except KeyError:
                 logger.warning("Failed to decode the bluetooth message")
                 self.bt_service.command_done()
                 self.bt_service.close_connection()
+            except Exception as e:
+                # The next messages are still handled
+                logger.error("Bluetooth command %s failed: %s" % (message.get("type"), e))
+                self.bt_service.command_done()
 
-    def ws_recv_handler(self):
-        logger.debug("WebSocket message handler started")
-        while True:
-            msg = self.ws_recv_pipe.get()
-            data = json.loads(msg)
-            try:
-                cmd = data["type"]
-                payload = data["payload"]
-                if cmd == INIT:
-                    logger.info("Initialization message received: %s" % msg)
-                    config.config.bond_user = payload["user_id"]
-                    config.update_config()
-                elif cmd == START_STREAMING:
-                    logger.info("Start streaming message received: %s" % msg)
-                    if not self.stream_pusher.is_streaming():
-                        key = payload["key"]
-                        self.stream_pusher.start(key=key)
-                    self.send_status()
-                elif cmd == STOP_STREAMING:
-                    logger.info("Stop streaming message received: %s" % msg)
-                    if self.stream_pusher.is_streaming():
-                        self.stream_pusher.stop()
-                    self.send_status()
-                elif cmd == START_MONITORING:
-                    logger.info("Start monitoring message received: %s" % msg)
-                    if not self.is_monitoring:
-                        self.is_monitoring = True
-                        self.capture_save_mode = payload["save_mode"]
-                        self.camera_capture.start()
-                        self.sensor_monitor.start()
-                        self.video_recorder.start_ffmpeg(self.capture_save_mode)
-                    self.send_status()
-                elif cmd == STOP_MONITORING:
-                    logger.info("Stop monitoring received: %s" % msg)
-                    if self.is_monitoring:
-                        self.is_monitoring = False
-                        self.is_streaming = False
-                        self.capture_save_mode = 0
-                        self.video_recorder.close()
-                        self.stream_pusher.stop()
-                        self.camera_capture.close()
-                        self.sensor_monitor.close()
-                    self.send_status()
-                elif cmd == UNBINDING:
-                    logger.info("Unbind message received: %s" % msg)
-                    self.stop_net_modules()
-                    config.config.bond_user = 0
-                    config.update_config()
-            except KeyError:
-                continue
+    def _register_commands(self):
+        d = self.command_dispatcher
+        d.register(INIT, "Initialization", self._cmd_init, resources=("config",))
+        d.register(START_STREAMING, "Start streaming", self._cmd_start_streaming, resources=("streaming",))
+        d.register(STOP_STREAMING, "Stop streaming", self._cmd_stop_streaming, resources=("streaming",),
+                   preempt=True)
+        d.register(START_MONITORING, "Start monitoring", self._cmd_start_monitoring, resources=("monitoring",))
+        d.register(STOP_MONITORING, "Stop monitoring", self._cmd_stop_monitoring,
+                   resources=("monitoring", "streaming"), preempt=True)
+        d.register(UNBINDING, "Unbind", self._cmd_unbind, resources=("config", "monitoring", "streaming"),
+                   preempt=True)
 
-    def stop_net_modules(self, send_status=True):
-        logger.info("Stopping network related modules")
+    def _watch_workers(self):
+        def blocking(func, *args):
+            return functools.partial(self._run_blocking, func, *args)
+
+        capture = self.camera_capture
+        for name in ("capture", "detector", "output"):
+            self.supervisor.watch(name, lambda: capture.control.running, functools.partial(capture.is_alive, name),
+                                  blocking(capture.restart_worker, name), capture.heartbeats[name])
+        self.supervisor.watch("recorder", lambda: self.is_monitoring, self.video_recorder.is_recording,
+                              blocking(self.video_recorder.restart), self.video_recorder.heartbeat)
+        self.supervisor.watch("sensors", lambda: self.sensor_monitor.is_running, self.sensor_monitor.is_alive,
+                              blocking(self.sensor_monitor.restart), self.sensor_monitor.heartbeat)
+        self.supervisor.watch("stream", lambda: self.stream_pusher.control.running, self.stream_pusher.is_streaming,
+                              blocking(self.stream_pusher.restart), self.stream_pusher.heartbeat)
+        # The log writer and the bluetooth service sleep while idle, so only their process is checked
+        self.supervisor.watch("log", lambda: True, log.writer_alive, blocking(log.restart_writer))
+        self.supervisor.watch("bluetooth", lambda: True, self.bt_service.is_alive, blocking(self.bt_service.restart))
+        # The websocket client is a task on the event loop, reconnecting by itself as long as it runs
+        self.supervisor.watch("websocket", lambda: self.net_conn.is_running, self.net_conn.wsClient.is_alive,
+                              self.net_conn.wsClient.start)
+
+    def _send_ack(self, ack: dict):
+        self.net_conn.ws_ack(ack)
+
+    async def _cmd_init(self, payload: dict):
+        config.config.bond_user = payload["user_id"]
+        config.update_config()
+
+    async def _cmd_start_streaming(self, payload: dict):
+        if not self.stream_pusher.is_streaming():
+            key = payload["key"]
+            self.stream_pusher.start(key=key)
+            await self._save_state()
+        self.send_status()
+
+    async def _cmd_stop_streaming(self, payload: dict):
+        if self.stream_pusher.is_streaming():
+            await self._run_blocking(self.stream_pusher.stop)
+            await self._save_state()
+        self.send_status()
+
+    async def _cmd_start_monitoring(self, payload: dict):
+        if not self.is_monitoring:
+            self._start_monitoring(payload["save_mode"])
+            await self._save_state()
+        self.send_status()
+
+    async def _cmd_stop_monitoring(self, payload: dict):
+        if self.is_monitoring:
+            await self._stop_monitoring()
+            await self._save_state()
+        self.send_status()
+
+    async def _cmd_unbind(self, payload: dict):
         if self.is_monitoring:
-            self.is_monitoring = False
-            self.capture_save_mode = 0
-            self.video_recorder.close()
-            self.stream_pusher.stop()
-            self.camera_capture.close()
-            self.sensor_monitor.close()
+            await self._stop_monitoring()
+        await self.stop_net_modules()
+        config.config.bond_user = 0
+        config.update_config()
+        await self._save_state()
+
+    def _start_monitoring(self, save_mode: int):
+        self.is_monitoring = True
+        self.capture_save_mode = save_mode
+        # Already running unless monitoring was stopped since the boot
+        if not self.camera_capture.control.running:
+            self.camera_capture.start()
+        if not self.sensor_monitor.is_running:
+            self.sensor_monitor.start()
+        self.video_recorder.start_ffmpeg(save_mode)
+
+    async def _stop_monitoring(self):
+        self.is_monitoring = False
+        self.is_streaming = False
+        self.capture_save_mode = 0
+        await self._run_blocking(self._stop_monitoring_modules)
+
+    async def _save_state(self):
+        """Saves what the commands asked for, the modules keep running when the network is lost."""
+        state = config.DeviceState({
+            "monitoring": self.is_monitoring,
+            "save_mode": self.capture_save_mode,
+            "streaming": self.stream_pusher.control.running,
+            "stream_key": self.stream_pusher.key
+        })
+        try:
+            await self._run_blocking(config.save_device_state, state)
+        except OSError as e:
+            logger.error("Failed to save the state: %s" % e)
+
+    def _stop_monitoring_modules(self):
+        self.video_recorder.close()
+        self.stream_pusher.stop()
+        self.camera_capture.close()
+        self.sensor_monitor.close()
+
+    async def stop_net_modules(self, send_status=True):
+        """
+        Closes the connection to the server. Recording, the sensors and streaming don't depend on it and keep
+        running, so the alarms raised while offline wait in the outbox.
+        """
+        logger.info("Stopping network related modules")
         if send_status:
             self.send_status()
-        self.net_conn.close()
+        await self.net_conn.close()
 
-    def ws_status_report(self):
+    async def telemetry_report(self):
         while True:
+            await asyncio.sleep(config.telemetry.interval)
+            # Sampled even when offline, so the fps are computed over a single interval once connected
+            fields = await self._run_blocking(self._collect_telemetry)
             if self.net_conn.is_running:
-                self.send_status()
-            time.sleep(10)
+                self.telemetry.report(fields)
+
+    def _collect_telemetry(self) -> dict:
+        streaming = self.stream_pusher.is_streaming()
+        rate = self.rate_meter.rate
+        output_fps = round(rate("output", self.camera_capture.output_count.value), 1)
+        stream_fps = round(rate("stream", self.stream_pusher.frame_count.value), 1)
+        last_frame_time = self.camera_capture.control.last_frame_time()
+        return {
+            "monitoring": self.is_monitoring,
+            "streaming": streaming,
+            "capture_fps": round(rate("capture", self.camera_capture.capture_count.value), 1),
+            "detector_fps": round(rate("detector", self.camera_capture.detector_count.value), 1),
+            "output_fps": output_fps,
+            "record_fps": round(rate("record", self.video_recorder.frame_count.value), 1),
+            "stream_fps": stream_fps,
+            "resolution": self.camera_capture.get_resolution(),
+            # Seconds since the camera delivered its last frame, None while it is stopped so an idle device sends
+            # nothing
+            "frame_age": round(time.monotonic() - last_frame_time, 1)
+            if last_frame_time and self.camera_capture.control.running else None,
+            "stream_queue": self.cam_pipes[0].qsize(),
+            "record_queue": self.cam_pipes[1].qsize(),
+            "alarm_queue": self.alarm_dispatcher.queue_depth(),
+            "outbox_pending": self.alarm_dispatcher.outbox_pending(),
+            "cpu_temp": cpu_temperature(),
+            "disk_used": round(disk_used('./video'), 1),
+            # An encoder is unhealthy when it should be running but its process died, or it stopped taking frames
+            "recorder_ok": not self.is_monitoring or self.video_recorder.is_recording(),
+            "pusher_ok": not streaming or stream_fps > 0 or output_fps == 0,
+            "restarts": self.supervisor.restarts()
+        }
+
+    def _send_telemetry(self, payload: dict):
+        logger.debug("Sending telemetry: %s" % payload)
+        self.net_conn.ws_telemetry(payload)
 
     def send_status(self):
         status = Status(
@@ -269,6 +544,12 @@ class Main(object):
 
 
 def main():
+    # The start method first, the log queue belongs to it
+    workers.init()
+    log.init()
+    metrics.init()
+    boot.check_imports(imported_at)
+    workers.apply("main")
     m = Main()
     m.run()
 
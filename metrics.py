@@ -0,0 +1,468 @@
+import asyncio
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import config
+import log
+
+logger = log.main_logger
+
+# Upper bounds in seconds, the last bucket catches everything above
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, float("inf"))
+# For the work done on every frame
+FRAME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0, float("inf"))
+
+COUNTER = "counter"
+GAUGE = "gauge"
+HISTOGRAM = "histogram"
+
+_SEGMENT_SIZE = 64 * 1024
+# Counters and histograms of the processes that exited, written by the collecting process
+_RETIRED = "retired.db"
+
+
+class _Segment(object):
+    """
+    Values of the metrics of one process, in a file of the metrics directory, on tmpfs, mapped in memory. Only the
+    process owning it writes it, so no process ever waits for another one: the values are updated in place and
+    a new value is appended behind the used size in the header, which is updated last. Readers take the entries
+    up to the used size. The file is named after the pid and the start time of the process, so a process reusing
+    the pid of one that exited doesn't overwrite its values before they are retired.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        os.makedirs(config.metrics.dir, exist_ok=True)
+        file_name = "%d-%s.db" % (self.pid, _start_time(self.pid) or "0")
+        self._file = open(os.path.join(config.metrics.dir, file_name), 'w+b')
+        self._size = _SEGMENT_SIZE
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        self._used = 8
+        struct.pack_into('I', self._map, 0, self._used)
+        self._offsets: Dict[str, int] = {}
+
+    def _offset(self, key: str) -> int:
+        offset = self._offsets.get(key)
+        if offset is None:
+            data = key.encode('utf8')
+            # Key length, key, then the value aligned on 8 bytes
+            padded = (4 + len(data) + 7) // 8 * 8
+            if self._used + padded + 8 > self._size:
+                self._grow(self._used + padded + 8)
+            struct.pack_into('I%dsd' % (padded - 4), self._map, self._used, len(data), data, 0.0)
+            offset = self._offsets[key] = self._used + padded
+            self._used += padded + 8
+            struct.pack_into('I', self._map, 0, self._used)
+        return offset
+
+    def _grow(self, size: int):
+        while self._size < size:
+            self._size *= 2
+        self._file.truncate(self._size)
+        self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+
+    def add(self, key: str, amount: float):
+        offset = self._offset(key)
+        struct.pack_into('d', self._map, offset, struct.unpack_from('d', self._map, offset)[0] + amount)
+
+    def set(self, key: str, value: float):
+        struct.pack_into('d', self._map, self._offset(key), value)
+
+    def set_max(self, key: str, value: float):
+        offset = self._offset(key)
+        if value > struct.unpack_from('d', self._map, offset)[0]:
+            struct.pack_into('d', self._map, offset, value)
+
+
+_segment = None
+_registry = {}
+# Only between the threads of a process
+_lock = threading.Lock()
+# Between the threads collecting, each retiring the segments of the processes that exited
+_collect_lock = threading.Lock()
+
+
+def _reinit():
+    global _lock, _collect_lock
+    # A lock held by another thread while forking would stay locked in the child
+    _lock = threading.Lock()
+    _collect_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reinit)
+
+
+def _current_segment() -> _Segment:
+    global _segment
+    # A forked process writes its own segment, not the one of its parent
+    if _segment is None or _segment.pid != os.getpid():
+        _segment = _Segment()
+    return _segment
+
+
+def _key(kind: str, name: str, labels: Dict[str, str], part: str = "") -> str:
+    return json.dumps([kind, name, sorted(labels.items()), part])
+
+
+class Counter(object):
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self._key = _key(COUNTER, name, labels)
+
+    def inc(self, amount=1):
+        with _lock:
+            _current_segment().add(self._key, amount)
+
+
+class Gauge(object):
+    """Value of the live processes, summed when several set it."""
+
+    def __init__(self, name: str, labels: Dict[str, str]):
+        self.name = name
+        self.labels = labels
+        self._key = _key(GAUGE, name, labels)
+
+    def set(self, value: float):
+        with _lock:
+            _current_segment().set(self._key, value)
+
+
+class Histogram(object):
+
+    def __init__(self, name: str, labels: Dict[str, str], buckets: Tuple[float, ...]):
+        self.name = name
+        self.labels = labels
+        self.buckets = buckets
+        self._bucket_keys = [_key(HISTOGRAM, name, labels, str(bound)) for bound in buckets]
+        self._count_key = _key(HISTOGRAM, name, labels, "count")
+        self._sum_key = _key(HISTOGRAM, name, labels, "sum")
+        self._max_key = _key(HISTOGRAM, name, labels, "max")
+        self._segment_pid = None
+
+    def observe(self, value: float):
+        with _lock:
+            segment = _current_segment()
+            if self._segment_pid != segment.pid:
+                # All the buckets are exported, also the empty ones
+                for key in self._bucket_keys:
+                    segment.add(key, 0)
+                self._segment_pid = segment.pid
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    segment.add(self._bucket_keys[i], 1)
+                    break
+            segment.add(self._count_key, 1)
+            segment.add(self._sum_key, value)
+            segment.set_max(self._max_key, value)
+
+
+def _get(cls, name: str, labels: Dict[str, str], *args):
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        metric = _registry.get(key)
+        if metric is None:
+            metric = _registry[key] = cls(name, labels, *args)
+        return metric
+
+
+def counter(name: str, **labels) -> Counter:
+    return _get(Counter, name, labels)
+
+
+def gauge(name: str, **labels) -> Gauge:
+    return _get(Gauge, name, labels)
+
+
+def histogram(name: str, buckets=DEFAULT_BUCKETS, **labels) -> Histogram:
+    return _get(Histogram, name, labels, buckets)
+
+
+def init():
+    """Once at boot in the main process, before the workers are started: drops the values of the previous run."""
+    os.makedirs(config.metrics.dir, exist_ok=True)
+    for file_name in os.listdir(config.metrics.dir):
+        if file_name.endswith(".db"):
+            os.remove(os.path.join(config.metrics.dir, file_name))
+
+
+def _read(path: str) -> List[Tuple[str, float]]:
+    with open(path, 'rb') as f:
+        data = f.read()
+    entries = []
+    if len(data) < 8:
+        return entries
+    used = struct.unpack_from('I', data, 0)[0]
+    pos = 8
+    while pos < used:
+        length = struct.unpack_from('I', data, pos)[0]
+        padded = (4 + length + 7) // 8 * 8
+        key = data[pos + 4:pos + 4 + length].decode('utf8')
+        entries.append((key, struct.unpack_from('d', data, pos + padded)[0]))
+        pos += padded + 8
+    return entries
+
+
+def _write_entries(path: str, values: Dict[str, float]):
+    """Writes the entries in the layout of a segment, replacing the file atomically."""
+    data = bytearray(8)
+    for key, value in values.items():
+        encoded = key.encode('utf8')
+        padded = (4 + len(encoded) + 7) // 8 * 8
+        data += struct.pack('I%dsd' % (padded - 4), len(encoded), encoded, value)
+    struct.pack_into('I', data, 0, len(data))
+    tmp_path = path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _retire(file_names: List[str]):
+    """
+    Folds the counters and histograms of the segments of processes that exited into the retired segment, then
+    removes them, so the metrics directory doesn't grow with every restarted worker. Their gauges are dropped.
+    """
+    retired_path = os.path.join(config.metrics.dir, _RETIRED)
+    try:
+        values = dict(_read(retired_path))
+    except FileNotFoundError:
+        values = {}
+    retired = []
+    for file_name in file_names:
+        path = os.path.join(config.metrics.dir, file_name)
+        try:
+            entries = _read(path)
+        except (OSError, struct.error):
+            continue
+        for key, value in entries:
+            kind, name, labels, part = json.loads(key)
+            if kind == GAUGE:
+                continue
+            if part == "max":
+                values[key] = max(values.get(key, 0.0), value)
+            else:
+                values[key] = values.get(key, 0.0) + value
+        retired.append(path)
+    _write_entries(retired_path, values)
+    for path in retired:
+        os.remove(path)
+
+
+def _start_time(pid: int) -> Optional[str]:
+    """Start time of the process in clock ticks since boot, None if it isn't running or there is no /proc."""
+    try:
+        with open("/proc/%d/stat" % pid, 'rb') as f:
+            stat = f.read()
+    except OSError:
+        return None
+    # The command name may contain spaces, the fields follow its closing parenthesis
+    return stat[stat.rindex(b')') + 2:].split()[19].decode('ascii')
+
+
+def _alive(pid: int, start_time: str) -> bool:
+    """Whether the process owning the segment is still running, not another one that reused its pid."""
+    current = _start_time(pid)
+    if current is not None:
+        return current == start_time
+    try:
+        os.kill(pid, 0)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+
+
+def collect() -> Dict[Tuple[str, str], Dict[tuple, dict]]:
+    """
+    Values of all the processes by (kind, name) and labels. Counters and histograms of the processes that exited,
+    e.g. a restarted worker, still count through the retired segment, gauges only of the live processes. Only in
+    the main process, which retires the segments of the processes that exited.
+    """
+    families = {}
+    with _collect_lock:
+        try:
+            file_names = os.listdir(config.metrics.dir)
+        except FileNotFoundError:
+            return families
+        segments = {}
+        for file_name in file_names:
+            if not file_name.endswith(".db"):
+                continue
+            if file_name == _RETIRED:
+                segments[file_name] = None
+                continue
+            pid, _, start_time = file_name[:-3].partition("-")
+            try:
+                segments[file_name] = (int(pid), start_time)
+            except ValueError:
+                continue
+        dead = [file_name for file_name, owner in segments.items() if owner is not None and not _alive(*owner)]
+        if dead:
+            _retire(dead)
+            for file_name in dead:
+                del segments[file_name]
+            segments[_RETIRED] = None
+        for file_name, owner in segments.items():
+            try:
+                entries = _read(os.path.join(config.metrics.dir, file_name))
+            except (OSError, struct.error):
+                continue
+            for key, value in entries:
+                kind, name, labels, part = json.loads(key)
+                # A process exiting since keeps its gauges until the next collection
+                if kind == GAUGE and owner is None:
+                    continue
+                series = families.setdefault((kind, name), {}).setdefault(tuple(tuple(label) for label in labels), {})
+                if part == "max":
+                    series[part] = max(series.get(part, 0.0), value)
+                else:
+                    series[part] = series.get(part, 0.0) + value
+    return families
+
+
+def _labels(labels: tuple, extra: tuple = ()) -> str:
+    labels = labels + extra
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for name, value in labels)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def exposition() -> str:
+    """All the metrics in the Prometheus text format."""
+    lines = []
+    for (kind, name), family in sorted(collect().items(), key=lambda item: item[0][1]):
+        lines.append("# TYPE %s %s" % (name, kind))
+        for labels, series in sorted(family.items()):
+            if kind != HISTOGRAM:
+                lines.append("%s%s %s" % (name, _labels(labels), _format_value(series[""])))
+                continue
+            cumulative = 0.0
+            bounds = sorted((float(part), part) for part in series if part not in ("count", "sum", "max"))
+            for bound, part in bounds:
+                cumulative += series[part]
+                lines.append("%s_bucket%s %s" % (name, _labels(labels, (("le", _format_value(bound)),)),
+                                                 _format_value(cumulative)))
+            lines.append("%s_sum%s %s" % (name, _labels(labels), _format_value(series.get("sum", 0.0))))
+            lines.append("%s_count%s %s" % (name, _labels(labels), _format_value(series.get("count", 0.0))))
+        if kind == HISTOGRAM:
+            lines.append("# TYPE %s_max gauge" % name)
+            for labels, series in sorted(family.items()):
+                lines.append("%s_max%s %s" % (name, _labels(labels), _format_value(series.get("max", 0.0))))
+    lines.append("")
+    return "\n".join(lines)
+
+
+def write():
+    """Dumps all metrics to the local metrics file, replacing it atomically."""
+    data = []
+    for (kind, name), family in sorted(collect().items(), key=lambda item: item[0][1]):
+        for labels, series in sorted(family.items()):
+            metric = {"name": name, "labels": dict(labels)}
+            if kind == HISTOGRAM:
+                bounds = sorted((float(part), part) for part in series if part not in ("count", "sum", "max"))
+                metric["buckets"] = [[part, series[part]] for bound, part in bounds]
+                metric["count"] = series.get("count", 0.0)
+                metric["sum"] = series.get("sum", 0.0)
+                metric["max"] = series.get("max", 0.0)
+            else:
+                metric["value"] = series[""]
+            data.append(metric)
+    tmp_path = config.metrics.path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf8') as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, config.metrics.path)
+
+
+async def serve():
+    """Serves the metrics of all the processes on GET /metrics, read in the executor on every scrape."""
+    server = await asyncio.start_server(_handle_request, config.metrics.host, config.metrics.port)
+    logger.info("Serving the metrics on %s:%d" % (config.metrics.host, config.metrics.port))
+    async with server:
+        await server.serve_forever()
+
+
+async def _handle_request(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # The headers aren't needed
+        while (await asyncio.wait_for(reader.readline(), 5)).strip():
+            pass
+        parts = request.split()
+        if len(parts) >= 2 and parts[0] == b'GET' and parts[1].split(b'?')[0] == b'/metrics':
+            start_time = time.monotonic()
+            body = (await asyncio.get_event_loop().run_in_executor(None, exposition)).encode('utf8')
+            histogram("metrics_scrape_seconds").observe(time.monotonic() - start_time)
+            status = "200 OK"
+        else:
+            body = b"Not found\n"
+            status = "404 Not Found"
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                      "Content-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(body))).encode('ascii') + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+def _work(updates: int):
+    latency = histogram("benchmark_seconds")
+    frames = counter("benchmark_frames_total")
+    for i in range(updates):
+        latency.observe(i % 100 / 1000)
+        frames.inc()
+
+
+# For debugging: cost of an update, then of a scrape with the values of several processes
+def main():
+    import multiprocessing as mp
+
+    log.init()
+    init()
+    updates = 100000
+    start_time = time.perf_counter()
+    _work(updates)
+    print("Histogram observation and counter increment: %.2fus" %
+          ((time.perf_counter() - start_time) / updates * 1e6))
+
+    processes = [mp.Process(target=_work, args=(updates,)) for _ in range(4)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    for name in ("capture", "detector", "output", "recorder", "stream"):
+        counter("frames_total", stage=name).inc()
+        gauge("pipe_depth", pipe=name).set(1)
+        histogram("encoder_write_seconds", encoder=name).observe(0.01)
+    # The first scrape retires the segments of the processes that exited
+    segments = len(os.listdir(config.metrics.dir))
+    start_time = time.perf_counter()
+    text = exposition()
+    print("First scrape of %d segments: %.2fms, %d bytes" %
+          (segments, (time.perf_counter() - start_time) * 1e3, len(text)))
+    start_time = time.perf_counter()
+    exposition()
+    print("Next scrape of %d segments: %.2fms" %
+          (len(os.listdir(config.metrics.dir)), (time.perf_counter() - start_time) * 1e3))
+    print("\n".join(line for line in text.splitlines() if line.startswith("benchmark_frames_total") or
+                    line.startswith("benchmark_seconds_count")))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,34 @@
+import asyncio
 import json
-import multiprocessing
 import time
+from typing import Callable, List, Optional
 
-import jwt
-import requests
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 import config
 import log
+from http_client import HttpClient
 from sensors import SensorAlarm
 from ws_client import WsClient
 
 logger = log.net_logger
 
 TYPE_STATUS = 1
+TYPE_ACK = 2
+TYPE_TELEMETRY = 3
 
 STATUS_SUCCESS = 0
 
+# Results of push_alarm()
+PUSH_DELIVERED = 0
+# No response, a server error or a rate limit, the alarm may be accepted later
+PUSH_RETRY = 1
+# Refused by the server, the same alarm will never be accepted
+PUSH_REJECTED = 2
+
 
 class Status(object):
 
@@ -41,33 +54,44 @@ def _read_config():
         return hostname, password
 
 
-_auth_config = _read_config()
-host = Host(_auth_config[0], _auth_config[1])
+host: Optional[Host] = None
+_client: Optional[HttpClient] = None
 
 
-class NetConn(object):
+def init():
+    """Reads the credentials and creates the HTTP client, once at boot."""
+    global host, _client
+    hostname, password = _read_config()
+    host = Host(hostname, password)
+    _client = HttpClient(config.http.base_url)
 
-    def __init__(self, ws_recv_pipe: multiprocessing.Queue):
-        self.wsClient = WsClient(ws_recv_pipe)
-        self.ws_recv_pipe = self.wsClient.recv_pipe
 
-        self.update_auth_thread = None
-        self.is_running = False
+class NetConn(object):
 
-    def start(self) -> int:
-        if self.is_running:
-            return STATUS_SUCCESS
-        status = login()
-        if status == STATUS_SUCCESS:
-            self.is_running = True
-            self.wsClient.start()
-            return status
-        else:
+    def __init__(self, on_message: Callable[[str], None], on_connect: Callable[[], None] = None):
+        self.wsClient = WsClient(on_message, on_connect=on_connect)
+        self.is_running = False
+        self._lock = None
+        self.use_msgpack = config.telemetry.msgpack
+        if self.use_msgpack and msgpack is None:
+            logger.warning("msgpack is not installed, sending telemetry as JSON")
+            self.use_msgpack = False
+
+    async def start(self) -> int:
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self.is_running:
+                return STATUS_SUCCESS
+            status = await asyncio.get_event_loop().run_in_executor(None, login)
+            if status == STATUS_SUCCESS:
+                self.is_running = True
+                self.wsClient.start()
             return status
 
-    def close(self):
+    async def close(self):
         self.is_running = False
-        self.wsClient.close()
+        await self.wsClient.close()
 
     def ws_status_report(self, status: Status):
         data = {
@@ -80,37 +104,66 @@ class NetConn(object):
         data = json.dumps(data)
         self.wsClient.send_msg(data)
 
+    def ws_ack(self, ack: dict):
+        data = {
+            "type": TYPE_ACK,
+            "payload": ack
+        }
+        self.wsClient.send_msg(json.dumps(data))
+
+    def ws_telemetry(self, payload: dict):
+        data = {
+            "type": TYPE_TELEMETRY,
+            "payload": payload
+        }
+        # msgpack goes out as a binary frame
+        self.wsClient.send_msg(msgpack.packb(data) if self.use_msgpack else json.dumps(data))
 
-def push_alarm(alarm: SensorAlarm, frame: bytes) -> bool:
+
+def push_alarm(alarm: SensorAlarm, frames: List[bytes]) -> int:
     data = {
         'host_id': host.host_id,
         'type': alarm.cate,
         'desc': alarm.desc,
-        'time': alarm.time
+        'time': alarm.time,
+        'count': alarm.count,
+        'last_time': alarm.last_time
     }
     data = {"data": json.dumps(data)}
-    img_name = "%s%03d.jpg" % (time.strftime('%Y%m%d_%H%M%S', time.localtime(alarm.time)),
-                               (alarm.time - int(alarm.time)) * 1000)
-    files = {'img': (img_name, frame)}
-    response = _post('/home_host/sensor_alarm', data=data, files=files)
-    if response:
+    img_name = "%s%03d" % (time.strftime('%Y%m%d_%H%M%S', time.localtime(alarm.time)),
+                           (alarm.time - int(alarm.time)) * 1000)
+    # The first image keeps the original name, the representative frames of coalesced alarms follow it
+    files = [('img', ("%s.jpg" % img_name if i == 0 else "%s_%d.jpg" % (img_name, i), frame))
+             for i, frame in enumerate(frames)]
+    # Stable across the deliveries of the alarm, so the server can tell a redelivery from a new alarm
+    headers = {"Idempotency-Key": "%d-%d-%.6f" % (host.host_id, alarm.cate, alarm.time)}
+    response = _post('/home_host/sensor_alarm', idempotent=False, headers=headers, data=data, files=files)
+    if response is not None:
         if response.status_code == 200:
             logger.info("Push alarm succeed: %s" % data)
-            return True
+            return PUSH_DELIVERED
         elif response.status_code == 401:
             logger.warning("Token expired, renewing the token")
-            if login():
-                return push_alarm(alarm, frame)
-        else:
-            logger.warning("Push alarm failed, response: %s message: %s" % (response.text, data))
+            if login() == STATUS_SUCCESS:
+                return push_alarm(alarm, frames)
+            return PUSH_RETRY
+        elif 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            logger.error("Push alarm rejected, status %d, response: %s message: %s" %
+                         (response.status_code, response.text, data))
+            return PUSH_REJECTED
+        logger.warning("Push alarm failed, status %d, response: %s message: %s" %
+                       (response.status_code, response.text, data))
+        return PUSH_RETRY
     logger.warning("Push alarm failed with no response, message: %s" % data)
-    return False
+    return PUSH_RETRY
 
 
 def login() -> int:
+    import jwt
+
     data = {"hostname": host.hostname, "password": host.password}
-    response = _post("/auth/home_host/login", retry_times=1, json=data)
-    if response:
+    response = _post("/auth/home_host/login", retries=1, json=data)
+    if response is not None:
         try:
             response_json = response.json()
             if response_json["code"] == STATUS_SUCCESS:
@@ -133,8 +186,8 @@ def login() -> int:
 
 def bind_user(user_id: int) -> int:
     data = {"host_id": host.host_id, "user_id": user_id}
-    response = _post("/home_host/binding", retry_times=-1, json=data)
-    if response:
+    response = _post("/home_host/binding", json=data)
+    if response is not None:
         try:
             response_json = response.json()
             if response_json["code"] == STATUS_SUCCESS:
@@ -143,7 +196,7 @@ def bind_user(user_id: int) -> int:
                 logger.info("Bind user succeed: %s" % data)
             elif response.status_code == 401:
                 logger.warning("Token expired, renewing the token")
-                if login():
+                if login() == STATUS_SUCCESS:
                     return bind_user(user_id)
             else:
                 logger.warning("Bind user failed, response: %s message: %s" % (response.text, data))
@@ -156,18 +209,8 @@ def bind_user(user_id: int) -> int:
         return -1
 
 
-def _post(path: str, retry_times=5, **kwargs):
-    url = config.http.base_url + path
-    headers = dict()
+def _post(path: str, retries=None, idempotent=True, headers=None, **kwargs):
+    headers = dict(headers or {})
     if host.token != "":
         headers["Authorization"] = "Bearer " + host.token
-    i = 0
-    while True:
-        try:
-            response = requests.request('POST', url, headers=headers, timeout=(10, 10), **kwargs)
-            return response
-        except:
-            time.sleep(5)
-        i += 1
-        if retry_times != -1 and i > 5:
-            return None
+    return _client.post(path, retries=retries, idempotent=idempotent, headers=headers, **kwargs)
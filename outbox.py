@@ -0,0 +1,113 @@
+import sqlite3
+import threading
+from typing import List
+
+import log
+from sensors import SensorAlarm
+
+logger = log.alarm_logger
+
+
+class OutboxEntry(object):
+
+    def __init__(self, entry_id: int, alarm: SensorAlarm, imgs: List[bytes]):
+        self.id = entry_id
+        self.alarm = alarm
+        self.imgs = imgs
+
+
+class Outbox(object):
+    """
+    Durable store of alarms that haven't been delivered yet, backed by SQLite in WAL mode so an entry survives
+    crashes and power cuts once append() returns. Entries handed out to an uploader are claimed until they are
+    removed or released, so the same alarm is never uploaded twice concurrently.
+    """
+
+    def __init__(self, path: str, quota_bytes: int):
+        self.quota_bytes = quota_bytes
+        self._lock = threading.Lock()
+        self._claimed = set()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=FULL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS alarms ("
+                           "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "cate INTEGER NOT NULL, "
+                           "desc TEXT NOT NULL, "
+                           "time REAL NOT NULL, "
+                           "last_time REAL NOT NULL, "
+                           "count INTEGER NOT NULL, "
+                           "size INTEGER NOT NULL)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS images ("
+                           "alarm_id INTEGER NOT NULL, "
+                           "idx INTEGER NOT NULL, "
+                           "img BLOB NOT NULL, "
+                           "PRIMARY KEY (alarm_id, idx))")
+
+    def append(self, alarm: SensorAlarm, imgs: List[bytes]) -> int:
+        """Persists the alarm and returns its id, the entry is claimed by the caller."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            cursor = self._conn.execute("INSERT INTO alarms (cate, desc, time, last_time, count, size) "
+                                        "VALUES (?, ?, ?, ?, ?, ?)",
+                                        (alarm.cate, alarm.desc, alarm.time, alarm.last_time, alarm.count,
+                                         sum(len(img) for img in imgs)))
+            entry_id = cursor.lastrowid
+            self._conn.executemany("INSERT INTO images (alarm_id, idx, img) VALUES (?, ?, ?)",
+                                   [(entry_id, i, img) for i, img in enumerate(imgs)])
+            self._conn.execute("COMMIT")
+            self._claimed.add(entry_id)
+            self._evict()
+            return entry_id
+
+    def remove(self, entry_id: int):
+        with self._lock:
+            self._delete(entry_id)
+            self._claimed.discard(entry_id)
+
+    def release(self, entry_id: int):
+        with self._lock:
+            self._claimed.discard(entry_id)
+
+    def claim_batch(self, size: int) -> List[OutboxEntry]:
+        """Claims up to size of the oldest unclaimed entries."""
+        with self._lock:
+            claimed = list(self._claimed)
+            rows = self._conn.execute("SELECT id, cate, desc, time, last_time, count FROM alarms "
+                                      "WHERE id NOT IN (%s) ORDER BY id LIMIT ?" % ", ".join("?" * len(claimed)),
+                                      claimed + [size]).fetchall()
+            entries = []
+            for entry_id, cate, desc, alarm_time, last_time, count in rows:
+                imgs = [img for (img,) in self._conn.execute("SELECT img FROM images WHERE alarm_id = ? ORDER BY idx",
+                                                             (entry_id,))]
+                alarm = SensorAlarm(cate, desc, alarm_time, count=count, last_time=last_time)
+                entries.append(OutboxEntry(entry_id, alarm, imgs))
+                self._claimed.add(entry_id)
+            return entries
+
+    def pending(self) -> int:
+        with self._lock:
+            count = self._conn.execute("SELECT COUNT(*) FROM alarms").fetchone()[0]
+            return count - len(self._claimed)
+
+    def _evict(self):
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM alarms").fetchone()[0]
+        if total <= self.quota_bytes:
+            return
+        evicted = 0
+        for entry_id, size in self._conn.execute("SELECT id, size FROM alarms ORDER BY id").fetchall():
+            if total <= self.quota_bytes:
+                break
+            if entry_id in self._claimed:
+                continue
+            self._delete(entry_id)
+            total -= size
+            evicted += 1
+        if evicted:
+            logger.warning("Outbox exceeded its quota, evicted %d oldest alarms" % evicted)
+
+    def _delete(self, entry_id: int):
+        self._conn.execute("BEGIN")
+        self._conn.execute("DELETE FROM images WHERE alarm_id = ?", (entry_id,))
+        self._conn.execute("DELETE FROM alarms WHERE id = ?", (entry_id,))
+        self._conn.execute("COMMIT")
@@ -3,10 +3,13 @@
 
 """Implementations of wifi functions of Linux."""
 
+import itertools
 import logging
 import socket
 import stat
 import os
+import threading
+import time
 
 from .const import *
 from .profile import Profile
@@ -14,6 +17,21 @@ from .profile import Profile
 CTRL_IFACE_DIR = '/var/run/wpa_supplicant'
 CTRL_IFACE_RETRY = 3
 REPLY_SIZE = 4096
+CTRL_TIMEOUT = 5
+# The event monitor checks that wpa_supplicant is still there after this long without events
+EVENT_PING_INTERVAL = 10
+EVENT_POLL_TIMEOUT = 1
+EVENT_REATTACH_INTERVAL = 3
+
+# Unsolicited events mapped to the interface status they report. A temporarily
+# disabled network means the connection attempt failed (e.g. a wrong key),
+# scan results mean a scan is over and its results can be read.
+event_to_status = {
+    'CTRL-EVENT-CONNECTED': IFACE_CONNECTED,
+    'CTRL-EVENT-DISCONNECTED': IFACE_DISCONNECTED,
+    'CTRL-EVENT-SSID-TEMP-DISABLED': IFACE_DISCONNECTED,
+    'CTRL-EVENT-SCAN-RESULTS': IFACE_SCANNING
+}
 
 status_dict = {
     'completed': IFACE_CONNECTED,
@@ -57,6 +75,14 @@ class WifiUtil:
     """WifiUtil implements the wifi functions in Linux."""
 
     _connections = {}
+    # Profiles saved in wpa_supplicant per iface, None until enumerated.
+    # Commands changing the profiles invalidate it, and so does a new
+    # control socket, wpa_supplicant may have restarted with other ids.
+    # A list read while it was invalidated isn't stored, the version
+    # per iface tells.
+    _profiles = {}
+    _profiles_version = {}
+    _profiles_lock = threading.Lock()
     _logger = logging.getLogger('pywifi')
 
     def scan(self, obj):
@@ -79,7 +105,8 @@ class WifiUtil:
             bss.bssid = values[0]
             bss.freq = int(values[1])
             bss.signal = int(values[2])
-            bss.ssid = values[4]
+            # Hidden networks have no ssid
+            bss.ssid = values[4] if len(values) > 4 else ''
             bss.akm = []
             if 'WPA-PSK' in values[3]:
                 bss.akm.append(AKM_TYPE_WPAPSK)
@@ -90,6 +117,14 @@ class WifiUtil:
             if 'WPA2-EAP' in values[3]:
                 bss.akm.append(AKM_TYPE_WPA2)
 
+            # e.g. [WPA2-PSK-CCMP][ESS] or [WPA-PSK-TKIP+CCMP]
+            if 'CCMP' in values[3]:
+                bss.cipher = CIPHER_TYPE_CCMP
+            elif 'TKIP' in values[3]:
+                bss.cipher = CIPHER_TYPE_TKIP
+            elif 'WEP' in values[3]:
+                bss.cipher = CIPHER_TYPE_WEP
+
             bss.auth = AUTH_ALG_OPEN
 
             bsses.append(bss)
@@ -99,20 +134,11 @@ class WifiUtil:
     def connect(self, obj, network):
         """Connect to the specified AP."""
 
-        network_summary = self._send_cmd_to_wpas(
-            obj['name'],
-            'LIST_NETWORKS',
-            True)
-        network_summary = network_summary[:-1].split('\n')
-        if len(network_summary) == 1:
-            return networks
-
-        for l in network_summary[1:]:
-            values = l.split('\t')
-            if values[1] == network.ssid:
-                network_summary = self._send_cmd_to_wpas(
+        for profile in self.network_profiles(obj):
+            if profile.ssid == network.ssid:
+                self._send_cmd_to_wpas(
                     obj['name'],
-                    'SELECT_NETWORK {}'.format(values[0]),
+                    'SELECT_NETWORK {}'.format(profile.id),
                     True)
 
     def disconnect(self, obj):
@@ -165,11 +191,65 @@ class WifiUtil:
                 obj['name'],
                 'SET_NETWORK {} psk \"{}\"'.format(network_id, params.key))
 
+        # Restrict the network to a known AP and channels, so connecting
+        # doesn't have to scan every band
+        if params.bssid:
+            self._send_cmd_to_wpas(
+                obj['name'],
+                'SET_NETWORK {} bssid {}'.format(network_id, params.bssid))
+
+        if params.freq_list:
+            self._send_cmd_to_wpas(
+                obj['name'],
+                'SET_NETWORK {} freq_list {}'.format(
+                    network_id,
+                    ' '.join(str(freq) for freq in params.freq_list)))
+
+        params.id = network_id
+
+        # The commands above invalidated the profiles, the next
+        # network_profiles() reads them again from wpa_supplicant
         return params
 
+    def unpin_network_profile(self, obj, params):
+        """Let an AP profile added with a bssid or freq_list use any AP and channel."""
+
+        if params.bssid:
+            self._send_cmd_to_wpas(
+                obj['name'],
+                'SET_NETWORK {} bssid any'.format(params.id))
+
+        if params.freq_list:
+            # An empty list clears it
+            self._send_cmd_to_wpas(
+                obj['name'],
+                'SET_NETWORK {} freq_list '.format(params.id))
+
+        params.bssid = None
+        params.freq_list = []
+
     def network_profiles(self, obj):
         """Get AP profiles."""
 
+        with self._profiles_lock:
+            profiles = self._profiles.get(obj['name'])
+            version = self._profiles_version.get(obj['name'], 0)
+        if profiles is None:
+            profiles = self._list_network_profiles(obj)
+            with self._profiles_lock:
+                if self._profiles_version.get(obj['name'], 0) == version:
+                    self._profiles[obj['name']] = profiles
+
+        return list(profiles)
+
+    def _invalidate_profiles(self, iface):
+
+        with self._profiles_lock:
+            self._profiles[iface] = None
+            self._profiles_version[iface] = self._profiles_version.get(iface, 0) + 1
+
+    def _list_network_profiles(self, obj):
+
         networks = []
         network_ids = []
         network_summary = self._send_cmd_to_wpas(
@@ -236,7 +316,8 @@ class WifiUtil:
             else:
                 # Assume the possible ciphers TKIP and CCMP
                 if len(ciphers) == 1:
-                    network.cipher = cipher_str_to_value(ciphers[0].upper())
+                    network.cipher = cipher_str_to_value.get(
+                        ciphers[0].upper(), CIPHER_TYPE_UNKNOWN)
                 elif 'CCMP' in ciphers:
                     network.cipher = CIPHER_TYPE_CCMP
 
@@ -247,16 +328,12 @@ class WifiUtil:
     def remove_network_profile(self, obj, params):
         """Remove the specified AP profiles"""
 
-        network_id = -1
         profiles = self.network_profiles(obj)
+        removed = [profile for profile in profiles if profile == params]
 
-        for profile in profiles:
-            if profile == params:
-                network_id = profile.id
-
-        if network_id != -1:
+        for profile in removed:
             self._send_cmd_to_wpas(obj['name'],
-                                   'REMOVE_NETWORK {}'.format(network_id))
+                                   'REMOVE_NETWORK {}'.format(profile.id))
 
     def remove_all_network_profiles(self, obj):
         """Remove all the AP profiles."""
@@ -275,6 +352,27 @@ class WifiUtil:
                 status = l[10:]
                 return status_dict[status.lower()]
 
+    def link_info(self, obj):
+        """Get the bssid, frequency and signal of the current link."""
+
+        info = {'bssid': None, 'freq': None, 'signal': None}
+        for l in self._send_cmd_to_wpas(obj['name'], 'STATUS', True).split('\n'):
+            if l.startswith('bssid='):
+                info['bssid'] = l[6:]
+            elif l.startswith('freq='):
+                info['freq'] = int(l[5:])
+
+        for l in self._send_cmd_to_wpas(obj['name'], 'SIGNAL_POLL', True).split('\n'):
+            if l.startswith('RSSI='):
+                info['signal'] = int(l[5:])
+
+        return info
+
+    def event_monitor(self, obj):
+        """Get a monitor of the link events of the wifi interface."""
+
+        return EventMonitor(obj['name'])
+
     def interfaces(self):
         """Get the wifi interface lists."""
 
@@ -290,53 +388,41 @@ class WifiUtil:
 
         return ifaces
 
+    def ctrl_stats(self, obj):
+        """Get the latency stats of the commands sent to wpa_supplicant."""
+
+        return self._connections[obj['name']].stats()
+
     def _connect_to_wpa_s(self, iface):
 
-        ctrl_iface = '/'.join([CTRL_IFACE_DIR, iface])
-        if ctrl_iface in self._connections:
+        if iface in self._connections:
             self._logger.info(
                 "Connection for iface '%s' aleady existed!",
                 iface)
+            return
 
-        sock_file = '{}/{}_{}'.format('/tmp', 'pywifi', iface)
-        self._remove_existed_sock(sock_file)
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
-        sock.bind(sock_file)
-        sock.connect(ctrl_iface)
-
-        send_len = sock.send(b'PING')
-        retry = CTRL_IFACE_RETRY
-        while retry >= 0:
-            reply = sock.recv(REPLY_SIZE)
-            if reply == b'':
-                self._logger.error("Connection to '%s' is broken!", ctrl_iface)
-                break
-
-            if reply.startswith(b'PONG'):
-                self._logger.info(
-                    "Connect to sock '%s' successfully!", ctrl_iface)
-                self._connections[iface] = {
-                    'sock': sock,
-                    'sock_file': sock_file,
-                    'ctrl_iface': ctrl_iface
-                }
-                break
-            retry -= 1
-
-    def _remove_existed_sock(self, sock_file):
-
-        if os.path.exists(sock_file):
-            mode = os.stat(sock_file).st_mode
-            if stat.S_ISSOCK(mode):
-                os.remove(sock_file)
+        ctrl = WpaCtrl('/'.join([CTRL_IFACE_DIR, iface]),
+                       '{}/{}_{}'.format('/tmp', 'pywifi', iface),
+                       on_reset=lambda: self._invalidate_profiles(iface))
+        if ctrl.connect():
+            self._connections[iface] = ctrl
 
-    def _send_cmd_to_wpas(self, iface, cmd, get_reply=False):
+    def _send_cmd_to_wpas(self, iface, cmd, get_reply=False, timeout=CTRL_TIMEOUT):
 
         if 'psk' not in cmd:
             self._logger.info("Send cmd '%s' to wpa_s", cmd)
-        sock = self._connections[iface]['sock']
-        sock.send(bytearray(cmd, 'utf-8'))
-        reply = sock.recv(REPLY_SIZE)
+        changes_profiles = cmd.startswith(('ADD_NETWORK', 'REMOVE_NETWORK', 'SET_NETWORK'))
+        if changes_profiles:
+            self._invalidate_profiles(iface)
+        try:
+            reply = self._connections[iface].request(cmd, timeout)
+        except OSError as e:
+            self._logger.error("Command '%s' failed: %s", cmd.split(' ', 1)[0], e)
+            # Looks like a failure reported by wpa_supplicant to the callers
+            reply = b'FAIL\n'
+        if changes_profiles:
+            # Also the lists read while the command was running
+            self._invalidate_profiles(iface)
         if get_reply:
             return reply.decode('unicode-escape').encode('raw_unicode_escape').decode('utf-8')
 
@@ -345,3 +431,393 @@ class WifiUtil:
                 "Unexpected resp '%s' for Command '%s'",
                 reply.decode('unicode-escape').encode('raw_unicode_escape').decode('utf-8'),
                 cmd)
+
+
+class WpaCtrl:
+    """WpaCtrl is a wpa_supplicant control client shared between threads.
+
+    The control protocol has no request IDs, so requests are serialized and
+    each one waits for its reply with a timeout. Unsolicited event messages
+    are skipped. A reply arriving after its request timed out would be taken
+    for the reply to the next one, so the socket is replaced by one bound to
+    a new path after a timeout. on_reset is called whenever the socket is
+    opened or closed, what was read through the previous one may be stale.
+    """
+
+    _logger = logging.getLogger('pywifi')
+
+    def __init__(self, ctrl_iface, sock_file, on_reset=None):
+
+        self.ctrl_iface = ctrl_iface
+        self.sock_file = sock_file
+        self.on_reset = on_reset
+        self._sock = None
+        self._sock_path = None
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._stats = {}
+
+    def connect(self):
+        """Open the socket and check that wpa_supplicant answers."""
+
+        with self._lock:
+            self._open()
+            self._sock.settimeout(CTRL_TIMEOUT)
+            self._sock.send(b'PING')
+            retry = CTRL_IFACE_RETRY
+            while retry >= 0:
+                try:
+                    reply = self._sock.recv(REPLY_SIZE)
+                except OSError as e:
+                    self._logger.error("Connection to '%s' is broken: %s", self.ctrl_iface, e)
+                    return False
+                if reply.startswith(b'PONG'):
+                    self._logger.info(
+                        "Connect to sock '%s' successfully!", self.ctrl_iface)
+                    return True
+                retry -= 1
+            return False
+
+    def request(self, cmd, timeout=CTRL_TIMEOUT):
+        """Send a command and return its reply, raise socket.timeout if there is none."""
+
+        name = cmd.split(' ', 1)[0]
+        with self._lock:
+            start_time = time.monotonic()
+            deadline = start_time + timeout
+            try:
+                if self._sock is None:
+                    self._open()
+                self._sock.send(bytearray(cmd, 'utf-8'))
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        raise socket.timeout('timed out')
+                    self._sock.settimeout(remaining)
+                    reply = self._sock.recv(REPLY_SIZE)
+                    if not reply.startswith(b'<'):
+                        break
+                    self._logger.debug("Skipped event '%s'", reply)
+            except OSError:
+                self._record(name, time.monotonic() - start_time, True)
+                self._close()
+                raise
+            self._record(name, time.monotonic() - start_time, False)
+            return reply
+
+    def stats(self):
+        """Get count, failures, average and max latency in seconds per command."""
+
+        with self._lock:
+            return {name: {'count': s[0],
+                           'failures': s[1],
+                           'avg': s[2] / s[0],
+                           'max': s[3]}
+                    for name, s in self._stats.items()}
+
+    def _record(self, name, latency, failed):
+
+        s = self._stats.setdefault(name, [0, 0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += 1 if failed else 0
+        s[2] += latency
+        s[3] = max(s[3], latency)
+
+    def _open(self):
+
+        if self._generation == 0:
+            self._sock_path = self.sock_file
+        else:
+            self._sock_path = '{}_{}'.format(self.sock_file, self._generation)
+        self._generation += 1
+        if os.path.exists(self._sock_path):
+            os.remove(self._sock_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self._sock_path)
+            sock.connect(self.ctrl_iface)
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        if self.on_reset:
+            self.on_reset()
+
+    def _close(self):
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+        if os.path.exists(self._sock_path):
+            os.remove(self._sock_path)
+        if self.on_reset:
+            self.on_reset()
+
+
+class EventMonitor:
+    """EventMonitor attaches to wpa_supplicant and reports link and scan events.
+
+    wpa_supplicant only sends unsolicited events to the sockets that ATTACHed,
+    so the monitor uses its own socket, separate from the one carrying the
+    commands. Callbacks are called from the monitor thread with the status
+    the event reports and the event name.
+    """
+
+    _logger = logging.getLogger('pywifi')
+    _counter = itertools.count()
+
+    def __init__(self, iface, ctrl_dir=CTRL_IFACE_DIR):
+
+        self.iface = iface
+        self.ctrl_iface = '/'.join([ctrl_dir, iface])
+        # Unique per monitor, like wpa_cli does, so monitors of other
+        # processes don't take over each other's socket
+        self.sock_file = '{}/{}_{}_events_{}-{}'.format(
+            '/tmp', 'pywifi', iface, os.getpid(), next(self._counter))
+        self._callbacks = []
+        self._sock = None
+        self._thread = None
+        self._running = False
+
+    def add_callback(self, callback):
+        """Register callback(status, event), called on every event."""
+
+        self._callbacks.append(callback)
+
+    def start(self):
+        """Start monitoring in a background thread."""
+
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop monitoring."""
+
+        self._running = False
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _attach(self):
+
+        if os.path.exists(self.sock_file):
+            os.remove(self.sock_file)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            sock.bind(self.sock_file)
+            sock.connect(self.ctrl_iface)
+            sock.settimeout(EVENT_POLL_TIMEOUT)
+            sock.send(b'ATTACH')
+            if not sock.recv(REPLY_SIZE).startswith(b'OK'):
+                raise OSError("ATTACH refused")
+        except OSError:
+            sock.close()
+            raise
+        self._sock = sock
+        self._logger.info("Attached to '%s'", self.ctrl_iface)
+
+    def _detach(self):
+
+        try:
+            self._sock.send(b'DETACH')
+        except OSError:
+            pass
+        self._sock.close()
+        self._sock = None
+        if os.path.exists(self.sock_file):
+            os.remove(self.sock_file)
+
+    def _run(self):
+
+        last_msg = 0
+        pinged = False
+        while self._running:
+            if self._sock is None:
+                try:
+                    self._attach()
+                    last_msg = time.monotonic()
+                    pinged = False
+                except OSError as e:
+                    self._logger.warning(
+                        "Failed to attach to '%s': %s", self.ctrl_iface, e)
+                    time.sleep(EVENT_REATTACH_INTERVAL)
+                    continue
+            try:
+                msg = self._sock.recv(REPLY_SIZE)
+            except socket.timeout:
+                if time.monotonic() - last_msg < EVENT_PING_INTERVAL:
+                    continue
+                if pinged:
+                    # wpa_supplicant is gone (e.g. restarted), attach again
+                    self._logger.warning(
+                        "No reply from '%s', attaching again", self.ctrl_iface)
+                    self._detach()
+                    continue
+                try:
+                    self._sock.send(b'PING')
+                    last_msg = time.monotonic()
+                    pinged = True
+                except OSError:
+                    self._detach()
+                continue
+            except OSError:
+                self._detach()
+                continue
+            last_msg = time.monotonic()
+            pinged = False
+            self._handle(msg.decode('utf-8', 'replace').strip())
+        if self._sock is not None:
+            self._detach()
+
+    def _handle(self, msg):
+
+        # Events are prefixed with their priority, e.g. "<3>CTRL-EVENT-CONNECTED"
+        if not msg.startswith('<'):
+            return
+        event = msg[msg.find('>') + 1:].split(' ', 1)[0]
+        status = event_to_status.get(event)
+        if status is None:
+            return
+        self._logger.info("Event '%s' on iface '%s'", event, self.iface)
+        for callback in self._callbacks:
+            try:
+                callback(status, event)
+            except Exception:
+                self._logger.exception("Event callback failed")
+
+
+# For debugging: local wpa_supplicant stand-ins, run with
+# "python -m pywifi._wifiutil_linux"
+def _debug_event_monitor(ctrl_dir):
+
+    events = 100
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind('/'.join([ctrl_dir, 'wlan0']))
+    server.settimeout(1)
+
+    received = threading.Semaphore(0)
+    latencies = []
+    sent_at = [0.0]
+
+    def on_event(status, event):
+        latencies.append(time.monotonic() - sent_at[0])
+        received.release()
+
+    monitor = EventMonitor('wlan0', ctrl_dir=ctrl_dir)
+    monitor.add_callback(on_event)
+    monitor.start()
+
+    cmd, client = server.recvfrom(REPLY_SIZE)
+    assert cmd == b'ATTACH'
+    server.sendto(b'OK\n', client)
+    for i in range(events):
+        if i % 2 == 0:
+            event = '<3>CTRL-EVENT-CONNECTED - Connection to 00:11:22:33:44:55 completed [id=0 id_str=]'
+        else:
+            event = '<3>CTRL-EVENT-DISCONNECTED bssid=00:11:22:33:44:55 reason=3 locally_generated=1'
+        sent_at[0] = time.monotonic()
+        server.sendto(event.encode(), client)
+        assert received.acquire(timeout=1)
+        # Other events are ignored
+        server.sendto(b'<3>CTRL-EVENT-BSS-ADDED 1 00:11:22:33:44:55', client)
+    monitor.stop()
+    server.close()
+
+    latencies.sort()
+    print("%d events, detection latency p50 %.3f ms, max %.3f ms" % (
+        len(latencies), latencies[len(latencies) // 2] * 1000,
+        latencies[-1] * 1000))
+
+
+def _debug_ctrl(ctrl_dir):
+
+    import random
+
+    clients = 8
+    requests = 200
+    slow_every = 97
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    server.bind('/'.join([ctrl_dir, 'wlan1']))
+    server.settimeout(1)
+    stopped = threading.Event()
+
+    def serve():
+        # Echoes every command, with events mixed in and a few replies later
+        # than the client's timeout
+        handled = 0
+        while not stopped.is_set():
+            try:
+                cmd, client = server.recvfrom(REPLY_SIZE)
+            except socket.timeout:
+                continue
+            handled += 1
+            if cmd == b'PING':
+                server.sendto(b'PONG\n', client)
+                continue
+            try:
+                if handled % 5 == 0:
+                    server.sendto(b'<3>CTRL-EVENT-SCAN-STARTED ', client)
+                if handled % slow_every == 0:
+                    time.sleep(0.15)
+                server.sendto(b'REPLY ' + cmd + b'\n', client)
+            except OSError:
+                # The client gave up and closed its socket
+                pass
+
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+    ctrl = WpaCtrl('/'.join([ctrl_dir, 'wlan1']), '/'.join([ctrl_dir, 'client']))
+    assert ctrl.connect()
+    mismatches = []
+    timeouts = []
+
+    def run_client(n):
+        for i in range(requests):
+            cmd = 'CMD{} {} {}'.format(n, i, random.random())
+            try:
+                reply = ctrl.request(cmd, timeout=0.1)
+            except socket.timeout:
+                timeouts.append(cmd)
+                continue
+            if reply != ('REPLY ' + cmd + '\n').encode():
+                mismatches.append((cmd, reply))
+
+    start_time = time.monotonic()
+    threads = [threading.Thread(target=run_client, args=(n,))
+               for n in range(clients)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.monotonic() - start_time
+    stopped.set()
+    server_thread.join()
+    server.close()
+
+    assert not mismatches, mismatches[:3]
+    stats = ctrl.stats()
+    total = sum(s['count'] for s in stats.values())
+    print("%d requests from %d threads in %.2fs, %d timed out, 0 mismatched, "
+          "max latency %.3f ms" % (
+              total, clients, duration, len(timeouts),
+              max(s['max'] for s in stats.values()) * 1000))
+
+
+def main():
+
+    import shutil
+    import tempfile
+
+    ctrl_dir = tempfile.mkdtemp()
+    try:
+        _debug_event_monitor(ctrl_dir)
+        _debug_ctrl(ctrl_dir)
+    finally:
+        shutil.rmtree(ctrl_dir)
+
+
+if __name__ == '__main__':
+    main()
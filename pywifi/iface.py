@@ -33,6 +33,11 @@ class Interface:
         self._wifi_ctrl = wifiutil.WifiUtil()
         self._logger = logging.getLogger('pywifi')
 
+    def supports(self, method):
+        """Whether the backend of the platform implements the method, e.g. event_monitor."""
+
+        return hasattr(self._wifi_ctrl, method)
+
     def name(self):
         """"Get the name of the wifi interfacce."""
 
@@ -67,6 +72,11 @@ class Interface:
 
         return self._wifi_ctrl.add_network_profile(self._raw_obj, params)
 
+    def unpin_network_profile(self, params):
+        """Let the AP settings added with a bssid or freq_list use any AP and channel."""
+
+        self._wifi_ctrl.unpin_network_profile(self._raw_obj, params)
+
     def remove_network_profile(self, params):
         """Remove the specified AP settings."""
 
@@ -111,3 +121,18 @@ class Interface:
         """Get the status of the wifi interface."""
 
         return self._wifi_ctrl.status(self._raw_obj)
+
+    def link_info(self):
+        """Get the bssid, frequency and signal of the current link."""
+
+        return self._wifi_ctrl.link_info(self._raw_obj)
+
+    def event_monitor(self):
+        """Get a monitor calling back on link events of the wifi interface."""
+
+        return self._wifi_ctrl.event_monitor(self._raw_obj)
+
+    def ctrl_stats(self):
+        """Get the latency stats of the calls to the wifi service."""
+
+        return self._wifi_ctrl.ctrl_stats(self._raw_obj)
@@ -16,6 +16,7 @@ class Profile:
         self.cipher = CIPHER_TYPE_NONE
         self.ssid = None
         self.bssid = None
+        self.freq_list = []
         self.key = None
 
     def process_akm(self):
@@ -1,10 +1,10 @@
 import multiprocessing as mp
 import time
 
-from gpiozero import MotionSensor, Buzzer, DigitalInputDevice
-
 import log
 import config
+import workers
+from supervisor import Heartbeat
 
 logger = log.sensor_logger
 
@@ -13,10 +13,21 @@ SMOKE_ALARM = 2
 
 
 class SensorAlarm(object):
-    def __init__(self, alarm_type: int, alarm_desc: str, alarm_time: float):
+    def __init__(self, alarm_type: int, alarm_desc: str, alarm_time: float, count=1, last_time=None):
         self.cate = alarm_type
         self.desc = alarm_desc
+        # time of the first trigger, coalesced alarms also carry the number of triggers and the last one
         self.time = alarm_time
+        self.count = count
+        self.last_time = alarm_time if last_time is None else last_time
+        # (stage, time.monotonic()) for every hop the alarm passes, the monotonic clock is shared by all processes
+        self.trace = []
+
+    def mark(self, stage: str):
+        self.trace.append((stage, time.monotonic()))
+
+    def spans(self):
+        return [(self.trace[i][0], self.trace[i][1] - self.trace[i - 1][1]) for i in range(1, len(self.trace))]
 
 
 class SensorMonitoring(object):
@@ -27,6 +38,8 @@ class SensorMonitoring(object):
         self.smoke_GPIO = config.sensor.smoke_gpio
         self.buzzer_GPIO = config.sensor.buzzer_gpio
         self.process = None
+        self.is_running = False
+        self.heartbeat = Heartbeat()
         self.ms_is_activated = False
         self.ms_activation_time = 0
         self.ms_activation_count = 0
@@ -37,10 +50,17 @@ class SensorMonitoring(object):
         self.ss_deact_time = 0
         self.ss_is_activated = False
 
+    def __getstate__(self):
+        # Sent to the sensor process when it isn't forked, the process handle stays in the parent
+        state = self.__dict__.copy()
+        state["process"] = None
+        return state
+
     def _ss_activated(self):
         self.ss_activation_time = time.time()
-        logger.info("Smoke detected")
         alarm = SensorAlarm(SMOKE_ALARM, "Smoke detected!", self.ss_activation_time)
+        alarm.mark("gpio")
+        logger.info("Smoke detected")
         self._report_alarm(alarm)
 
     def _ss_deactivated(self):
@@ -51,8 +71,9 @@ class SensorMonitoring(object):
         self.ms_activation_count += 1
         self.ms_interval_count += 1
         self.ms_activation_time = time.time()
-        logger.info("Motion sensor activated")
         alarm = SensorAlarm(MOTION_ALARM, "Motion detected!", self.ms_activation_time)
+        alarm.mark("gpio")
+        logger.info("Motion sensor activated")
         self._report_alarm(alarm)
 
     def _ms_deactivated(self):
@@ -66,6 +87,9 @@ class SensorMonitoring(object):
         self.alarm_pipe.put(alarm)
 
     def _run_process(self):
+        # Only needed in the sensor process
+        from gpiozero import MotionSensor, Buzzer, DigitalInputDevice
+
         self.motion_sensor = MotionSensor(self.motion_GPIO)
         self.smoke_sensor = DigitalInputDevice(self.smoke_GPIO)
         self.buzzer = Buzzer(self.buzzer_GPIO)
@@ -75,14 +99,31 @@ class SensorMonitoring(object):
         self.smoke_sensor.when_deactivated = self._ss_deactivated
         logger.info("Sensor module started")
         while True:
+            self.heartbeat.beat()
             time.sleep(0.1)
 
     def start(self):
-        self.process = mp.Process(target=self._run_process)
-        self.process.daemon = True
+        self.is_running = True
+        self.process = workers.process("sensors", self._run_process)
         self.process.start()
 
+    def is_alive(self) -> bool:
+        try:
+            return self.process is not None and self.process.is_alive()
+        except ValueError:
+            return False
+
+    def restart(self):
+        try:
+            self.process.terminate()
+            self.process.join()
+            self.process.close()
+        except ValueError:
+            pass
+        self.start()
+
     def close(self):
+        self.is_running = False
         try:
             self.process.terminate()
             self.process.join()
@@ -95,6 +136,7 @@ class SensorMonitoring(object):
 
 # For debugging
 if __name__ == '__main__':
+    log.init()
     q = mp.Queue()
     s = SensorMonitoring(q)
     s.start()
@@ -2,10 +2,14 @@ import multiprocessing
 import queue
 import signal
 import subprocess as sp
+import time
 
 import config
 import log
-from util import clear_pipe
+import metrics
+import workers
+from control_block import RUNNING, ControlBlock
+from supervisor import Heartbeat
 
 logger = log.stream_logger
 
@@ -21,7 +25,18 @@ class StreamPusher(object):
         self.ffmpeg_cmd = config.stream.ffmpeg_cmd
         self.ffmpeg_process = None
         self.push_process = multiprocessing.Process()
-        self._cmd_pipe = multiprocessing.Queue()
+        # Shared with the streaming process. Running means streaming was requested, the process may have died
+        # meanwhile.
+        self.control = ControlBlock()
+        self.heartbeat = Heartbeat()
+        # Frames handed to the encoder, read by the telemetry
+        self.frame_count = multiprocessing.Value('L', 0, lock=False)
+
+    def __getstate__(self):
+        # Sent to the streaming process when it isn't forked, the process handle stays in the parent
+        state = self.__dict__.copy()
+        state["push_process"] = None
+        return state
 
     def _push(self):
         logger.info('Streaming started')
@@ -55,22 +70,25 @@ class StreamPusher(object):
         else:
             ffmpeg_cmd = self.ffmpeg_cmd
         self.ffmpeg_process = sp.Popen(ffmpeg_cmd, stdin=sp.PIPE)
-        while True:
-            if not self.frame_pipe.empty():
-                try:
-                    frame, status = self.frame_pipe.get(timeout=1)
-                    self.ffmpeg_process.stdin.write(frame.tostring())
-                except queue.Empty:
-                    pass
+        self.control.set_stats(self.resolution[0], self.resolution[1], self.fps)
+        frames = metrics.counter("frames_total", stage="stream")
+        # Blocks while FFmpeg lags behind and its input pipe is full
+        write_time = metrics.histogram("encoder_write_seconds", metrics.FRAME_BUCKETS, encoder="stream")
+        while self.control.running:
+            self.heartbeat.beat()
             try:
-                cmd = self._cmd_pipe.get_nowait()
-                if cmd == 'stop':
-                    self.ffmpeg_process.send_signal(signal.SIGINT)
-                    self.ffmpeg_process.communicate()
-                    self.ffmpeg_process.wait()
-                    break
+                frame, status = self.frame_pipe.get(timeout=1)
+                start_time = time.monotonic()
+                self.ffmpeg_process.stdin.write(frame.tostring())
+                write_time.observe(time.monotonic() - start_time)
+                self.frame_count.value += 1
+                frames.inc()
+                self.control.frame()
             except queue.Empty:
-                continue
+                pass
+        self.ffmpeg_process.send_signal(signal.SIGINT)
+        self.ffmpeg_process.communicate()
+        self.ffmpeg_process.wait()
 
     def is_streaming(self):
         try:
@@ -79,15 +97,23 @@ class StreamPusher(object):
             return False
 
     def start(self, key=''):
-        clear_pipe(self._cmd_pipe)
         self.key = key
-        self.push_process = multiprocessing.Process(target=self._push)
-        self.push_process.daemon = True
+        self.control.set(RUNNING)
+        self.push_process = workers.process("stream", self._push)
         self.push_process.start()
 
+    def restart(self):
+        """Replaces a dead or stalled streaming process, pushing to the same key."""
+        try:
+            self.push_process.terminate()
+            self.push_process.join()
+            self.push_process.close()
+        except ValueError:
+            pass
+        self.start(key=self.key)
+
     def stop(self):
-        clear_pipe(self._cmd_pipe)
-        self._cmd_pipe.put('stop')
+        self.control.clear(RUNNING)
         try:
             self.push_process.join()
             self.push_process.close()
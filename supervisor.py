@@ -0,0 +1,133 @@
+import asyncio
+import multiprocessing as mp
+import time
+from typing import Callable, Dict, Optional
+
+import config
+import log
+import metrics
+
+logger = log.supervisor_logger
+
+# A restarted worker that stays healthy this long starts again from the shortest backoff
+BACKOFF_RESET_TIME = 60
+
+
+class Heartbeat(object):
+    """
+    Time of the last beat of a worker, in shared memory so the worker's process updates it and the supervisor reads
+    it without any message passing. The monotonic clock is shared by all processes.
+    """
+
+    def __init__(self):
+        self._value = mp.Value('d', time.monotonic(), lock=False)
+
+    def beat(self):
+        self._value.value = time.monotonic()
+
+    def last(self) -> float:
+        return self._value.value
+
+
+class _Worker(object):
+
+    def __init__(self, name: str, expected: Callable[[], bool], alive: Callable[[], bool], restart: Callable,
+                 heartbeat: Optional[Heartbeat]):
+        self.name = name
+        self.expected = expected
+        self.alive = alive
+        self.restart = restart
+        self.heartbeat = heartbeat
+        self.was_expected = False
+        self.grace_until = 0.0
+        self.failed_at = None
+        self.restarted_at = 0.0
+        self.healthy_since = time.monotonic()
+        self.next_restart = 0.0
+        self.backoff = config.supervisor.backoff_base
+        self.restarts = 0
+        self.recoveries = 0
+        self.recovery_time = 0.0
+
+
+class Supervisor(object):
+    """
+    Checks the workers that are expected to run on the control event loop. A worker has failed when its process
+    died, or when it has a heartbeat and didn't beat for the timeout. A failed worker is restarted, again and again
+    with an exponential backoff as long as it doesn't recover. The restarts and the time from the failure until
+    the worker is healthy again are recorded.
+    """
+
+    def __init__(self):
+        self._workers: Dict[str, _Worker] = {}
+
+    def watch(self, name: str, expected: Callable[[], bool], alive: Callable[[], bool], restart: Callable,
+              heartbeat: Optional[Heartbeat] = None):
+        """restart() may return an awaitable, e.g. when the restart is moved to the executor."""
+        self._workers[name] = _Worker(name, expected, alive, restart, heartbeat)
+
+    async def run(self):
+        logger.info("Supervising %s" % ", ".join(self._workers))
+        while True:
+            await asyncio.sleep(config.supervisor.interval)
+            for worker in self._workers.values():
+                try:
+                    await self._check(worker)
+                except Exception as e:
+                    logger.error("Failed to check %s: %s" % (worker.name, e))
+
+    def restarts(self) -> int:
+        return sum(worker.restarts for worker in self._workers.values())
+
+    def stats(self) -> Dict[str, dict]:
+        return {worker.name: {
+            "restarts": worker.restarts,
+            "mttr": worker.recovery_time / worker.recoveries if worker.recoveries else None
+        } for worker in self._workers.values()}
+
+    async def _check(self, worker: _Worker):
+        now = time.monotonic()
+        timeout = config.supervisor.timeout
+        if not worker.expected():
+            worker.was_expected = False
+            worker.failed_at = None
+            worker.backoff = config.supervisor.backoff_base
+            return
+        if not worker.was_expected:
+            # Just started, give it a full timeout before the first beat
+            worker.was_expected = True
+            worker.grace_until = now + timeout
+            worker.healthy_since = now
+        alive = worker.alive()
+        if worker.failed_at is None:
+            stalled = worker.heartbeat is not None and now > worker.grace_until and \
+                now - worker.heartbeat.last() > timeout
+            if alive and not stalled:
+                if now - worker.healthy_since > BACKOFF_RESET_TIME:
+                    worker.backoff = config.supervisor.backoff_base
+                return
+            worker.failed_at = now
+            worker.next_restart = now
+            logger.warning("%s %s" % (worker.name, "stalled" if alive else "died"))
+        elif alive and (worker.heartbeat is None or worker.heartbeat.last() > worker.restarted_at):
+            # Running again and, if it has a heartbeat, beating since it was restarted
+            recovery_time = now - worker.failed_at
+            worker.recoveries += 1
+            worker.recovery_time += recovery_time
+            metrics.histogram("worker_recovery_seconds", worker=worker.name).observe(recovery_time)
+            logger.info("%s recovered in %.2fs" % (worker.name, recovery_time))
+            worker.failed_at = None
+            worker.healthy_since = now
+            return
+        if now < worker.next_restart:
+            return
+        worker.restarts += 1
+        metrics.counter("worker_restarts_total", worker=worker.name).inc()
+        logger.info("Restarting %s (restart %d, next one in %.0fs at the earliest)" %
+                    (worker.name, worker.restarts, worker.backoff))
+        worker.restarted_at = now
+        worker.next_restart = now + worker.backoff
+        worker.backoff = min(worker.backoff * 2, config.supervisor.backoff_max)
+        result = worker.restart()
+        if asyncio.iscoroutine(result) or asyncio.isfuture(result):
+            await result
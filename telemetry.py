@@ -0,0 +1,72 @@
+import shutil
+import time
+from typing import Callable, Dict, Union
+
+CPU_TEMP_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+
+class RateMeter(object):
+    """Turns monotonically increasing counters into per-second rates between two samples."""
+
+    def __init__(self):
+        self._last: Dict[str, tuple] = {}
+
+    def rate(self, name: str, count: int) -> float:
+        now = time.monotonic()
+        last = self._last.get(name)
+        self._last[name] = (count, now)
+        if last is None or now <= last[1] or count < last[0]:
+            return 0.0
+        return (count - last[0]) / (now - last[1])
+
+
+def cpu_temperature() -> Union[float, None]:
+    try:
+        with open(CPU_TEMP_PATH, 'r') as f:
+            return int(f.read()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def disk_used(path: str) -> float:
+    usage = shutil.disk_usage(path)
+    return usage.used * 100 / usage.total
+
+
+class Telemetry(object):
+    """
+    Sends a full snapshot of the device fields on (re)connect, and afterwards only the fields that changed since
+    the last message, so an idle device sends nothing. Numeric fields with a deadband only count as changed when
+    they moved at least that much from the value last sent.
+    """
+
+    def __init__(self, send: Callable[[dict], None], deadbands: Dict[str, float]):
+        self._send = send
+        self._deadbands = deadbands
+        self._sent = None
+
+    def reset(self):
+        """The next report will be a full snapshot."""
+        self._sent = None
+
+    def report(self, fields: dict):
+        if self._sent is None:
+            changed = fields
+            full = True
+            self._sent = dict(fields)
+        else:
+            changed = {k: v for k, v in fields.items() if self._changed(k, v)}
+            full = False
+            if not changed:
+                return
+            self._sent.update(changed)
+        self._send({"full": full, "fields": changed})
+
+    def _changed(self, key: str, value) -> bool:
+        if key not in self._sent:
+            return True
+        last = self._sent[key]
+        deadband = self._deadbands.get(key)
+        if deadband and isinstance(value, (int, float)) and isinstance(last, (int, float)):
+            return abs(value - last) >= deadband
+        return value != last
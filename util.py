@@ -1,10 +1,39 @@
+import asyncio
 import multiprocessing as mp
+import threading
 from queue import Empty
 
+import metrics
 
-def clear_pipe(pipe: mp.Queue, size=0):
+
+def clear_pipe(pipe: mp.Queue, size=0, name: str = None):
+    """Drops the oldest items beyond size. For a named pipe the depth found and the drops go to the metrics."""
+    depth = pipe.qsize()
+    dropped = 0
     while pipe.qsize() > size:
         try:
             pipe.get_nowait()
+            dropped += 1
         except Empty:
             pass
+    if name is not None:
+        metrics.gauge("pipe_depth", pipe=name).set(depth)
+        if dropped:
+            metrics.counter("pipe_drops_total", pipe=name).inc(dropped)
+
+
+def bridge_pipe(pipe: mp.Queue) -> asyncio.Queue:
+    """
+    Returns an asyncio.Queue of the running loop fed with the items of the pipe. A daemon thread blocks on the
+    pipe and hands every item over to the loop as soon as it arrives.
+    """
+    loop = asyncio.get_event_loop()
+    aqueue = asyncio.Queue()
+
+    def _reader():
+        while True:
+            item = pipe.get()
+            loop.call_soon_threadsafe(aqueue.put_nowait, item)
+
+    threading.Thread(target=_reader, daemon=True).start()
+    return aqueue
@@ -6,10 +6,12 @@ import subprocess as sp
 import threading
 import time
 
-import cv2
-
 import config
 import log
+import metrics
+import workers
+from control_block import RUNNING, SAVING, ControlBlock
+from supervisor import Heartbeat
 from util import clear_pipe
 
 logger = log.recorder_logger
@@ -17,38 +19,70 @@ logger = log.recorder_logger
 CAPTURE_ALWAYS_SAVE = 1
 CAPTURE_SAVE_WHEN_MOVING = 2
 
-if not os.path.exists("./video"):
-    os.makedirs("./video")
+VIDEO_DIR = "./video"
 
 
 class VideoRecorder(object):
 
     def __init__(self, cam_pipe: mp.Queue):
         self.cam_pipe = cam_pipe
-        self.cmd_pipe = mp.Queue()
+        os.makedirs(VIDEO_DIR, exist_ok=True)
         self.fps = config.record.fps
         self.buf_time = config.record.saving_buf_time
         self.buf_pipe = mp.Queue()
-        self.save_flag = False
-        self.is_running = True
+        # Shared with the recording process, stopping or saving takes effect there at once
+        self.control = ControlBlock()
         self.save_process = None
+        self.saving_mode = 0
+        self.heartbeat = Heartbeat()
+        # Frames handed to the encoder, read by the telemetry
+        self.frame_count = mp.Value('L', 0, lock=False)
+
+    def __getstate__(self):
+        # Sent to the recording process when it isn't forked, the process handle stays in the parent
+        state = self.__dict__.copy()
+        state["save_process"] = None
+        return state
 
     def start(self, saving_mode: int):
-        clear_pipe(self.cmd_pipe)
-        self.is_running = True
-        self.save_flag = False
-        self.save_process = mp.Process(target=self._handler, args=(saving_mode,), daemon=True)
+        self.saving_mode = saving_mode
+        self.control.clear(SAVING)
+        self.control.set(RUNNING)
+        self.save_process = workers.process("recorder", self._handler, (saving_mode,))
         self.save_process.start()
 
     def start_ffmpeg(self, saving_mode: int):
-        self.save_process = mp.Process(target=self._ffmpeg_handler, args=(saving_mode,), daemon=True)
+        self.saving_mode = saving_mode
+        self.control.clear(SAVING)
+        self.control.set(RUNNING)
+        self.save_process = workers.process("recorder", self._ffmpeg_handler, (saving_mode,))
         self.save_process.start()
 
+    def set_saving(self, saving: bool):
+        """Starts or stops saving in the OpenCV CAPTURE_SAVE_WHEN_MOVING mode, e.g. on an alarm."""
+        if saving:
+            self.control.set(SAVING)
+        else:
+            self.control.clear(SAVING)
+
+    def is_recording(self) -> bool:
+        try:
+            return self.save_process is not None and self.save_process.is_alive()
+        except ValueError:
+            return False
+
+    def restart(self):
+        """Replaces a dead or stalled FFmpeg recording process."""
+        try:
+            self.save_process.terminate()
+            self.save_process.join()
+            self.save_process.close()
+        except ValueError:
+            pass
+        self.start_ffmpeg(self.saving_mode)
+
     def close(self):
-        clear_pipe(self.cmd_pipe)
-        self.is_running = False
-        self.save_flag = False
-        self.cmd_pipe.put('stop')
+        self.control.clear(RUNNING | SAVING)
         try:
             self.save_process.join()
             self.save_process.close()
@@ -58,88 +92,79 @@ class VideoRecorder(object):
         logger.info("Video recording module stopped")
 
     def _ffmpeg_handler(self, saving_mode):
-        self.is_running = True
-        self.save_flag = False
         signal.signal(signal.SIGINT, signal.SIG_IGN)
         if saving_mode == CAPTURE_ALWAYS_SAVE:
             logger.info("Video recording module started: FFmpeg, Always save")
-            self.save_flag = True
+            self.control.set(SAVING)
             saving_thread = threading.Thread(target=self._save_ffmpeg, args=(self.cam_pipe,), daemon=True)
             saving_thread.start()
-            while True:
-                cmd = self.cmd_pipe.get()
-                if cmd == 'stop':
-                    self.is_running = False
-                self.save_flag = False
-                clear_pipe(self.cam_pipe)
-                saving_thread.join()
-                break
+            self.control.wait_for(lambda: not self.control.running)
+            clear_pipe(self.cam_pipe)
+            saving_thread.join()
         else:
             logger.info("Video recording module started: FFmpeg, Save when motion detected")
             save_pipe = mp.Queue()
             saving_thread = threading.Thread(target=self._save_ffmpeg, args=(save_pipe,), daemon=True)
             saving_thread.start()
             span_start = 0
-            cmd = ""
-            while True:
-                try:
-                    cmd = self.cmd_pipe.get_nowait()
-                except queue.Empty:
-                    pass
+            while self.control.running:
                 try:
                     frame, status = self.cam_pipe.get(timeout=2)
                     if status:
                         span_start = 0
-                        self.save_flag = True
+                        if not self.control.saving:
+                            self.control.set(SAVING)
                     else:
-                        if self.save_flag:
+                        if self.control.saving:
                             if span_start == 0:
                                 span_start = time.time()
                             if time.time() - span_start > 5:
-                                self.save_flag = False
+                                self.control.clear(SAVING)
                         else:
                             continue
-                    clear_pipe(save_pipe, 2)
+                    clear_pipe(save_pipe, 2, "save")
                     save_pipe.put((frame, status))
                 except queue.Empty:
                     pass
-                if cmd == 'stop':
-                    self.is_running = False
-                    self.save_flag = False
-                    clear_pipe(self.cam_pipe)
-                    clear_pipe(save_pipe)
-                    saving_thread.join()
-                    break
+            clear_pipe(self.cam_pipe)
+            clear_pipe(save_pipe)
+            saving_thread.join()
 
     def _handler(self, saving_mode):
-        self.is_running = True
         read_thread = threading.Thread(target=self._read_stream, daemon=True)
         read_thread.start()
+        control = self.control
         if saving_mode == CAPTURE_ALWAYS_SAVE:
             logger.info("Video recording module started: OpenCV, Always save")
-            self.save_flag = True
+            control.set(SAVING)
             save_thread = threading.Thread(target=self._save, daemon=True)
             save_thread.start()
+            control.wait_for(lambda: not control.running)
+            save_thread.join()
         else:
             logger.info("Video recording module started: OpenCV, Save when motion detected")
-        while True:
-            cmd = self.cmd_pipe.get()
-            if saving_mode == CAPTURE_SAVE_WHEN_MOVING and cmd == 'alarm':
-                self.save_flag = True
-                read_thread = threading.Thread(target=self._save, daemon=True)
-                read_thread.start()
-            elif saving_mode == CAPTURE_SAVE_WHEN_MOVING and cmd == 'alarm_canceled':
-                self.save_flag = False
-            elif cmd == 'stop':
-                self.is_running = False
-                self.save_flag = False
-                time.sleep(3)
-                return
+            while control.wait_for(lambda: control.saving or not control.running) and control.running:
+                save_thread = threading.Thread(target=self._save, daemon=True)
+                save_thread.start()
+                control.wait_for(lambda: not control.saving)
+                save_thread.join()
+        read_thread.join()
 
     def _save_ffmpeg(self, cam_pipe: mp.Queue):
         logger.info("Saving module started")
-        frame, status = self.cam_pipe.get()
+        control = self.control
+        while True:
+            self.heartbeat.beat()
+            if not control.running:
+                logger.info("Saving module stopped")
+                return
+            try:
+                frame, status = self.cam_pipe.get(timeout=1)
+                break
+            except queue.Empty:
+                pass
         resolution = (frame.shape[1], frame.shape[0])
+        control.set_stats(resolution[0], resolution[1], self.fps)
         ffmpeg_cmd = ['ffmpeg',
                       '-thread_queue_size', '16',
                       '-y',
@@ -162,16 +187,25 @@ class VideoRecorder(object):
                       '-tune:a', 'zerolatency',
                       '-f', 'flv',
                       './video/%s.avi' % time.strftime("%Y-%m-%d_%H-%M-%S")]
-        while self.is_running:
-            if self.save_flag:
+        frames = metrics.counter("frames_total", stage="recorder")
+        # Blocks while FFmpeg lags behind and its input pipe is full
+        write_time = metrics.histogram("encoder_write_seconds", metrics.FRAME_BUCKETS, encoder="recorder")
+        while control.running:
+            if control.saving:
                 logger.info("Recording started...")
                 last_hour = time.strftime("%H")
                 ffmpeg_cmd[-1] = 'video/%s.avi' % time.strftime("%Y-%m-%d_%H-%M-%S")
                 ffmpeg_process = sp.Popen(ffmpeg_cmd, stdin=sp.PIPE, stdout=sp.PIPE)
-                while self.save_flag and self.is_running:
+                while control.is_set(RUNNING | SAVING):
+                    self.heartbeat.beat()
                     try:
                         frame, status = cam_pipe.get_nowait()
+                        start_time = time.monotonic()
                         ffmpeg_process.stdin.write(frame.tostring())
+                        write_time.observe(time.monotonic() - start_time)
+                        self.frame_count.value += 1
+                        frames.inc()
+                        control.frame()
                     except queue.Empty:
                         pass
                     if time.strftime("%H") != last_hour:
@@ -186,22 +220,39 @@ class VideoRecorder(object):
                 ffmpeg_process.communicate()
                 ffmpeg_process.wait()
             else:
-                time.sleep(0.1)
+                self.heartbeat.beat()
+                control.wait_for(lambda: control.saving or not control.running, 1)
 
         logger.info("Saving module stopped")
 
     def _save(self):
-        frame = self.buf_pipe.get()
+        import cv2
+
+        while True:
+            if not self.control.saving:
+                return
+            try:
+                frame = self.buf_pipe.get(timeout=1)
+                break
+            except queue.Empty:
+                pass
         resolution = (frame.shape[1], frame.shape[0])
+        self.control.set_stats(resolution[0], resolution[1], self.fps)
         fourcc = cv2.VideoWriter_fourcc(*'XVID')
         writer = cv2.VideoWriter('video/%s.avi' % time.strftime("%Y-%m-%d_%H-%M-%S"), fourcc, self.fps, resolution)
         last_hour = time.strftime("%H")
-        while self.save_flag:
+        frames = metrics.counter("frames_total", stage="recorder")
+        write_time = metrics.histogram("encoder_write_seconds", metrics.FRAME_BUCKETS, encoder="recorder")
+        while self.control.saving:
             try:
                 frame = self.buf_pipe.get(timeout=1)
             except:
                 continue
+            start_time = time.monotonic()
             writer.write(frame)
+            write_time.observe(time.monotonic() - start_time)
+            frames.inc()
+            self.control.frame()
             if time.strftime("%H") != last_hour:
                 writer.release()
                 writer = cv2.VideoWriter('video/%s.avi' % time.strftime("%Y-%m-%d_%H-00-00"), fourcc, self.fps,
@@ -214,7 +265,7 @@ class VideoRecorder(object):
 
     def _read_stream(self):
         t_prev_frame = 0
-        while self.is_running:
+        while self.control.running:
             try:
                 frame, status = self.cam_pipe.get(timeout=1)
             except queue.Empty:
@@ -227,5 +278,5 @@ class VideoRecorder(object):
             for i in range(count):
                 self.buf_pipe.put(frame)
                 t_prev_frame = time.time()
-            while not self.save_flag and self.buf_pipe.qsize() > self.buf_time * self.fps:
+            while not self.control.saving and self.buf_pipe.qsize() > self.buf_time * self.fps:
                 self.buf_pipe.get()
@@ -1,34 +1,157 @@
 import logging
+import threading
 import time
 import traceback
-from typing import List, Union
+from typing import Callable, List, Union
 
 import pywifi
 from pywifi import const
 
 import config
 import log
+import metrics
 
 logger = log.wifi_logger
 pywifi.set_loglevel(logging.WARNING)
-iface = pywifi.PyWiFi().interfaces()[1]
+# Set by init()
+iface = None
 
 SUCCESS = 0
 CONNECTION_FAILURE = 1
 WIFI_NOT_FOUND = 2
 
+# Reported by wpa_supplicant when a connection attempt failed, e.g. with a wrong password
+EVENT_SSID_TEMP_DISABLED = 'CTRL-EVENT-SSID-TEMP-DISABLED'
+EVENT_SCAN_RESULTS = 'CTRL-EVENT-SCAN-RESULTS'
+# Time given to a scan to finish
+SCAN_TIMEOUT = 10
+# Without scan events, time after which the results of a scan are read
+SCAN_WAIT = 5
+
+# None where the backend reports no link events, e.g. on Windows
+_monitor = None
+_monitor_started = False
+_link_callbacks: List[Callable[[bool], None]] = []
+_link_cond = threading.Condition()
+# Sequence number, status and name of the last link event
+_last_event = (0, None, None)
+
 akm_dict = {"NONE": const.AKM_TYPE_NONE, "WPA": const.AKM_TYPE_WPA, "WPA-PSK": const.AKM_TYPE_WPAPSK,
             "WPA2": const.AKM_TYPE_WPA2, "WPA2-PSK": const.AKM_TYPE_WPA2PSK}
 cipher_dict = {"NONE": const.CIPHER_TYPE_NONE, "WEP": const.CIPHER_TYPE_WEP,
                "TKIP": const.CIPHER_TYPE_TKIP, "CCMP": const.CIPHER_TYPE_CCMP}
+akm_names = {v: k for k, v in akm_dict.items()}
+cipher_names = {v: k for k, v in cipher_dict.items()}
+
+
+class ScanCache(object):
+    """
+    Keeps the networks around from the last scan, the strongest AP of each SSID. Results older than the TTL are
+    still returned, a new scan is started in the background instead. While the device is offline, e.g. while being
+    provisioned, the networks are also scanned periodically so they are fresh when asked for.
+    """
+
+    def __init__(self, ttl: float, interval: float):
+        self.ttl = ttl
+        self.interval = interval
+        self._networks: List[pywifi.Profile] = []
+        self._updated = 0.0
+        self._lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        # Scans finished so far, counted under the lock publishing the results
+        self._scans = 0
+        self._scan_done = threading.Condition(self._lock)
+        self._wanted = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="WifiScanner", daemon=True)
+            self._thread.start()
+
+    def networks(self):
+        """Returns the cached networks and their age in seconds without waiting for a scan."""
+        with self._lock:
+            age = time.monotonic() - self._updated
+            networks = list(self._networks)
+        if age > self.ttl:
+            self._wanted.set()
+        return networks, age
+
+    def find(self, ssid: str) -> Union[pywifi.Profile, None]:
+        """Looks the network up, scanning first if it isn't in fresh results."""
+        networks, age = self.networks()
+        if age > self.ttl or ssid not in [n.ssid for n in networks]:
+            self.refresh()
+            networks, age = self.networks()
+        for network in networks:
+            if network.ssid == ssid:
+                return network
+        return None
+
+    def refresh(self):
+        with self._scan_lock:
+            start_time = time.monotonic()
+            with self._lock:
+                scans = self._scans
+            iface.scan()
+            with self._scan_done:
+                if _monitor is None:
+                    self._scan_done.wait(SCAN_WAIT)
+                # Only a scan finishing after this one was asked for
+                elif not self._scan_done.wait_for(lambda: self._scans > scans, SCAN_TIMEOUT):
+                    logger.warning("Scan didn't finish in %ds" % SCAN_TIMEOUT)
+            strongest = {}
+            for bss in iface.scan_results():
+                if bss.ssid and (bss.ssid not in strongest or bss.signal > strongest[bss.ssid].signal):
+                    strongest[bss.ssid] = bss
+            with self._lock:
+                self._networks = sorted(strongest.values(), key=lambda n: n.signal, reverse=True)
+                self._updated = time.monotonic()
+            logger.debug("Scanned %d networks in %.2fs" % (len(strongest), time.monotonic() - start_time))
 
+    def on_scan_results(self):
+        with self._scan_done:
+            self._scans += 1
+            self._scan_done.notify_all()
 
-def connect_new_wifi(ssid: str, akm_list: List[str], cipher: str, password: Union[str, None]) -> int:
+    def _run(self):
+        while True:
+            wanted = self._wanted.wait(self.interval)
+            self._wanted.clear()
+            try:
+                if wanted or not is_connected():
+                    self.refresh()
+            except Exception as e:
+                logger.error("Failed to scan: %s" % e)
+
+
+# Set by init()
+scan_cache: ScanCache = None
+
+
+def init():
+    """Opens the wifi interface, once at boot. Enumerating the interfaces connects to wpa_supplicant."""
+    global iface, scan_cache
+    iface = pywifi.PyWiFi().interfaces()[1]
+    scan_cache = ScanCache(config.wifi.scan_ttl, config.wifi.scan_interval)
+
+
+def connect_new_wifi(ssid: str, akm_list: Union[List[str], None], cipher: Union[str, None],
+                     password: Union[str, None]) -> int:
+    """The key management and cipher are taken from the scan results when they aren't given."""
     logger.debug("Connecting to wifi")
+    start_time = time.monotonic()
+    if akm_list is None or cipher is None:
+        network = scan_cache.find(ssid)
+        if network is None:
+            logger.warning("Wifi not found: %s" % ssid)
+            return WIFI_NOT_FOUND
+        akm_list = [akm_names[akm] for akm in network.akm] if akm_list is None else akm_list
+        cipher = cipher_names[network.cipher] if cipher is None else cipher
+        logger.debug("Detected key management %s and cipher %s for %s" % (akm_list, cipher, ssid))
     iface.disconnect()
-    config.clear_wifi_profile()
     iface.remove_all_network_profiles()
-    time.sleep(3)
     profile = pywifi.Profile()
     try:
         profile.ssid = ssid
@@ -38,9 +161,9 @@ def connect_new_wifi(ssid: str, akm_list: List[str], cipher: str, password: Unio
         profile.cipher = cipher_dict[cipher]
         profile.key = password
         iface.add_network_profile(profile)
-        iface.connect(profile)
-        if _connect_wifi_with_profile(profile):
-            config.update_wifi_profile(ssid, profile.akm, profile.cipher, password)
+        if _connect_wifi_with_profile(profile, config.wifi.connect_timeout):
+            _connected(config.WifiProfile({"ssid": ssid, "akm": profile.akm, "cipher": profile.cipher,
+                                           "password": password}), "new", start_time)
             return SUCCESS
         else:
             return CONNECTION_FAILURE
@@ -52,36 +175,120 @@ def connect_new_wifi(ssid: str, akm_list: List[str], cipher: str, password: Unio
 
 
 def connect_wifi() -> bool:
+    """
+    Tries the saved networks from the best ranked one. The best one is first tried on the AP and channel it was
+    last connected to, which skips scanning every band, then all of them without restriction. The AP and channel
+    are pinned for that first attempt only, so wpa_supplicant can still roam and reconnect to any AP afterwards.
+    """
     logger.info("Connecting to wifi")
     if iface.status() == const.IFACE_CONNECTED:
         logger.info("Already connected to wifi")
         return True
-    if config.wifi_profile.ssid != "":
-        iface.remove_all_network_profiles()
-        profile = pywifi.Profile()
-        profile.ssid = config.wifi_profile.ssid
-        profile.auth = const.AUTH_ALG_OPEN
-        profile.akm = config.wifi_profile.akm
-        profile.cipher = config.wifi_profile.cipher
-        profile.key = config.wifi_profile.password
-        iface.add_network_profile(profile)
-        return _connect_wifi_with_profile(profile)
-    else:
+    networks = config.wifi_profiles.networks
+    if not networks:
         logger.info("No saved wifi")
         return False
+    start_time = time.monotonic()
+    best = networks[0]
+    if best.bssid and best.freq:
+        iface.remove_all_network_profiles()
+        profile = _saved_profile(best)
+        profile.bssid = best.bssid
+        profile.freq_list = [best.freq]
+        iface.add_network_profile(profile)
+        connected = _connect_wifi_with_profile(profile, config.wifi.fast_connect_timeout)
+        if iface.supports("unpin_network_profile"):
+            iface.unpin_network_profile(profile)
+        if connected:
+            _connected(best, "fast", start_time)
+            return True
+    for saved in networks:
+        iface.remove_all_network_profiles()
+        profile = _saved_profile(saved)
+        iface.add_network_profile(profile)
+        if _connect_wifi_with_profile(profile, config.wifi.connect_timeout):
+            _connected(saved, "full", start_time)
+            return True
+    logger.warning("Failed to connect to any of the %d saved wifi networks in %.2fs" %
+                   (len(networks), time.monotonic() - start_time))
+    return False
 
 
-def _connect_wifi_with_profile(profile: pywifi.Profile) -> bool:
-    iface.connect(profile)
-    count = 0
-    while iface.status() is not const.IFACE_CONNECTED:
-        if iface.status() == const.IFACE_CONNECTING:
-            time.sleep(1)
+def _saved_profile(saved: config.WifiProfile) -> pywifi.Profile:
+    profile = pywifi.Profile()
+    profile.ssid = saved.ssid
+    profile.auth = const.AUTH_ALG_OPEN
+    profile.akm = list(saved.akm)
+    profile.cipher = saved.cipher
+    profile.key = saved.password
+    return profile
+
+
+def _connected(saved: config.WifiProfile, mode: str, start_time: float):
+    """Records the time to connect and remembers the link, so the next reconnection can go straight to it."""
+    duration = time.monotonic() - start_time
+    metrics.histogram("wifi_connect_seconds", mode=mode).observe(duration)
+    # Without link info the next reconnection goes the full way
+    link = iface.link_info() if iface.supports("link_info") else {"bssid": None, "freq": None, "signal": None}
+    saved.bssid = link["bssid"]
+    saved.freq = link["freq"]
+    saved.rssi = link["signal"]
+    logger.info("Connected to %s in %.2fs (%s), bssid %s, freq %s, rssi %s" %
+                (saved.ssid, duration, mode, saved.bssid, saved.freq, saved.rssi))
+    config.save_wifi_profile(saved)
+
+
+def start_monitor(on_change: Callable[[bool], None] = None):
+    """
+    Watches the link events of wpa_supplicant, on_change(connected) is called from the monitor thread. Where the
+    backend has no link events, the connection attempts and the scans poll instead.
+    """
+    global _monitor, _monitor_started
+    if on_change:
+        _link_callbacks.append(on_change)
+    if not _monitor_started:
+        _monitor_started = True
+        if iface.supports("event_monitor"):
+            _monitor = iface.event_monitor()
+            _monitor.add_callback(_on_link_event)
+            _monitor.start()
         else:
-            if count >= 3:
+            logger.warning("No link events on this platform, polling the wifi status")
+        scan_cache.start()
+
+
+def _on_link_event(status: int, event: str):
+    global _last_event
+    if event == EVENT_SCAN_RESULTS:
+        scan_cache.on_scan_results()
+        return
+    logger.info("Wifi link event: %s" % event)
+    with _link_cond:
+        _last_event = (_last_event[0] + 1, status, event)
+        _link_cond.notify_all()
+    for callback in _link_callbacks:
+        callback(status == const.IFACE_CONNECTED)
+
+
+def _connect_wifi_with_profile(profile: pywifi.Profile, timeout: float) -> bool:
+    start_monitor()
+    with _link_cond:
+        seq = _last_event[0]
+    iface.connect(profile)
+    # Wait for wpa_supplicant to report the outcome instead of polling its status. A disconnection is expected
+    # when leaving the current network, so only a connection or a failed attempt ends the wait early.
+    deadline = time.monotonic() + timeout
+    while _monitor is None and time.monotonic() < deadline and iface.status() != const.IFACE_CONNECTED:
+        time.sleep(1)
+    with _link_cond:
+        while True:
+            if _last_event[0] > seq and (_last_event[1] == const.IFACE_CONNECTED
+                                         or _last_event[2] == EVENT_SSID_TEMP_DISABLED):
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
                 break
-            count += 1
-            time.sleep(1)
+            _link_cond.wait(remaining)
     if iface.status() == const.IFACE_CONNECTED:
         logger.info("Successfully connected to the wifi: %s" % profile.ssid)
         return True
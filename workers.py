@@ -0,0 +1,137 @@
+import multiprocessing as mp
+import os
+from typing import Callable
+
+import config
+import log
+
+logger = log.supervisor_logger
+
+_policies = {
+    "other": getattr(os, "SCHED_OTHER", None),
+    "batch": getattr(os, "SCHED_BATCH", None),
+    "idle": getattr(os, "SCHED_IDLE", None),
+    "fifo": getattr(os, "SCHED_FIFO", None),
+    "rr": getattr(os, "SCHED_RR", None)
+}
+
+
+def init():
+    """
+    Sets the start method of the worker processes, once at boot before any queue, lock or shared value is created:
+    they belong to the start method they were created with. With forkserver the workers are forked from a server
+    process that imported the preloaded modules, instead of from the main process with its threads and sockets.
+    """
+    method = config.workers.start_method
+    if method == "forkserver":
+        mp.set_forkserver_preload(config.workers.preload)
+    mp.set_start_method(method, force=True)
+
+
+def process(name: str, target: Callable, args: tuple = (), daemon: bool = True) -> mp.Process:
+    """Process of the worker, which applies the CPU and scheduling settings of the worker once started."""
+    return mp.Process(target=_run, args=(name, log.get_queue(), target, args), daemon=daemon, name=name)
+
+
+def apply(name: str):
+    """
+    Applies the settings of the worker to the calling process: the CPUs it may run on, its nice value and its
+    scheduling policy. The threads and the subprocesses started afterwards, like FFmpeg, inherit them. A setting
+    the system doesn't allow, e.g. a negative nice value without the privilege, is skipped with a warning.
+    """
+    settings = getattr(config.workers, name)
+    if settings.cpus:
+        cpus = [cpu for cpu in settings.cpus if cpu < os.cpu_count()]
+        if len(cpus) < len(settings.cpus):
+            logger.warning("%s: CPUs %s not available" % (name, sorted(set(settings.cpus) - set(cpus))))
+        try:
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+        except OSError as e:
+            logger.warning("%s: failed to set the CPUs %s: %s" % (name, cpus, e))
+    try:
+        policy = _policies[settings.sched]
+        os.sched_setscheduler(0, policy, os.sched_param(settings.priority))
+    except (OSError, KeyError, TypeError, AttributeError) as e:
+        logger.warning("%s: failed to set the scheduling policy %s: %s" % (name, settings.sched, e))
+    try:
+        # Only has an effect with the normal policies, the real time ones ignore it
+        os.setpriority(os.PRIO_PROCESS, 0, settings.nice)
+    except OSError as e:
+        logger.warning("%s: failed to set the nice value %d: %s" % (name, settings.nice, e))
+    logger.info("%s: pid %d, CPUs %s, %s priority %d, nice %d" %
+                (name, os.getpid(), sorted(os.sched_getaffinity(0)), settings.sched, settings.priority,
+                 os.getpriority(os.PRIO_PROCESS, 0)))
+
+
+def _run(name: str, log_queue: mp.Queue, target: Callable, args: tuple):
+    # The worker doesn't inherit the log handler when it isn't forked from the main process
+    log.init_worker(log_queue)
+    apply(name)
+    target(*args)
+
+
+def _capture_loop(seconds: float, intervals, count):
+    """Paced like the capture worker, records the interval between consecutive frames in shared memory."""
+    import time
+
+    frame_time = 1 / config.capture.fps
+    end = time.monotonic() + seconds
+    last = time.monotonic()
+    while last < end and count.value < len(intervals):
+        start_time = time.monotonic()
+        # Stands for reading and handing over a frame
+        while time.monotonic() - start_time < frame_time * 0.2:
+            pass
+        elapsed = time.monotonic() - start_time
+        if elapsed < frame_time:
+            time.sleep(frame_time - elapsed)
+        now = time.monotonic()
+        intervals[count.value] = now - last
+        count.value += 1
+        last = now
+
+
+def _busy_loop(seconds: float):
+    """Stands for a worker keeping a CPU busy, like the detector or an encoder."""
+    import time
+
+    end = time.monotonic() + seconds
+    while time.monotonic() < end:
+        sum(i * i for i in range(10000))
+
+
+# For debugging: frame jitter of a capture loop competing with busy workers, without and then with the settings
+def main():
+    import time
+
+    init()
+    log.init()
+    seconds = 10
+    frame_time = 1 / config.capture.fps
+    contenders = ["detector", "recorder", "stream", "bluetooth"]
+    for configured in (False, True):
+        intervals = mp.Array('d', int(seconds / frame_time) + 1, lock=False)
+        count = mp.Value('L', 0, lock=False)
+        if configured:
+            capture = process("capture", _capture_loop, (seconds, intervals, count))
+            busy = [process(name, _busy_loop, (seconds + 1,)) for name in contenders]
+        else:
+            capture = mp.Process(target=_capture_loop, args=(seconds, intervals, count), daemon=True)
+            busy = [mp.Process(target=_busy_loop, args=(seconds + 1,), daemon=True) for _ in contenders]
+        for p in busy:
+            p.start()
+        capture.start()
+        capture.join()
+        for p in busy:
+            p.join()
+        jitter = sorted(abs(interval - frame_time) * 1000 for interval in intervals[:count.value])
+        missed = sum(1 for interval in intervals[:count.value] if interval > frame_time * 1.5)
+        print("%-10s frames %d/%d, jitter p50 %.2fms p99 %.2fms max %.2fms, late frames %d" %
+              ("configured" if configured else "default", len(jitter), int(seconds / frame_time),
+               jitter[len(jitter) // 2], jitter[int(len(jitter) * 0.99)], jitter[-1], missed))
+        time.sleep(1)
+
+
+if __name__ == '__main__':
+    main()
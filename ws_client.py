@@ -1,15 +1,11 @@
 import asyncio
-import multiprocessing
-import threading
 import time
-from queue import Empty
-
-import websockets
+from typing import Callable, Union
 
 import config
 import log
+import metrics
 import net_conn
-from util import clear_pipe
 
 logger = log.ws_logger
 
@@ -17,82 +13,88 @@ PING_INTERVAL = 5
 PING_TIMEOUT = 10
 CLOSE_TIMEOUT = 10
 TIMEOUT = 5
+RECONNECT_INTERVAL = 5
+# Time given to queued messages to go out when the client is closed
+DRAIN_TIMEOUT = 1
 
 
 class WsClient:
+    """
+    WebSocket client running on the control event loop. start() and close() must be called from the loop,
+    send_msg() may be called from any thread.
+    """
 
-    def __init__(self, recv_pipe: multiprocessing.Queue):
+    def __init__(self, on_message: Callable[[str], None], url=None, on_connect: Callable[[], None] = None):
         self.conn = None
-        self._url = config.websocket.base_url + '/ws/home_host'
-        self._process = None
-        self._closed = False
-        self._close_pipe = multiprocessing.Queue()
-        self.send_pipe = multiprocessing.Queue()
-        self.recv_pipe = recv_pipe
+        self._url = url if url else config.websocket.base_url + '/ws/home_host'
+        self._on_message = on_message
+        self._on_connect = on_connect
         self._loop = None
-        self._loop_thread = None
+        self._task = None
+        self._connected = None
+        self._send_queue = None
 
     def start(self):
-        self._closed = False
+        if self._task and not self._task.done():
+            return
+        if self._loop is None:
+            # Created here so they are bound to the running loop
+            self._loop = asyncio.get_event_loop()
+            self._connected = asyncio.Event()
+            self._send_queue = asyncio.Queue()
         self.conn = None
-        clear_pipe(self._close_pipe)
-        self._process = multiprocessing.Process(target=self._run_process)
-        self._process.daemon = True
-        self._process.start()
-
-    def close(self):
-        clear_pipe(self._close_pipe)
-        self._close_pipe.put("close")
-        self._closed = True
-        try:
-            self._process.join()
-            self._process.close()
-        except Exception:
-            logger.info("Process already closed")
+        self._task = self._loop.create_task(self._run())
+
+    async def close(self):
+        if not self._task:
             return
+        if self._connected.is_set():
+            try:
+                await asyncio.wait_for(self._send_queue.join(), DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning("Closing with %d messages not sent" % self._send_queue.qsize())
+        task = self._task
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        # Unless it was started again meanwhile
+        if self._task is task:
+            self._task = None
         logger.info("WebSocket service stopped")
 
-    def restart(self):
+    def is_alive(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def restart(self):
         logger.info("Restarting...")
-        self.close()
+        await self.close()
         self.start()
 
-    def send_msg(self, msg: str):
-        self.send_pipe.put(msg)
+    def send_msg(self, msg: Union[str, bytes]):
+        if self._loop is None:
+            logger.debug("WebSocket service not started, message dropped: %s" % msg)
+            return
+        self._loop.call_soon_threadsafe(self._send_queue.put_nowait, (msg, time.monotonic()))
 
-    def _run_process(self):
-        self._start_loop_thread()
-        self._handle_close()
+    async def _run(self):
+        send_task = self._loop.create_task(self._send_loop())
+        try:
+            while True:
+                if await self._connect():
+                    await self._recv_loop()
+                    logger.warning("WebSocket service stopped unexpectedly, preparing to restart...")
+                await asyncio.sleep(RECONNECT_INTERVAL)
+        finally:
+            self._connected.clear()
+            send_task.cancel()
+            if self.conn:
+                await self.conn.close()
+
+    async def _connect(self) -> bool:
+        import websockets
 
-    def _start_loop_thread(self):
-        self._closed = False
-        self.conn = None
-        self._loop = asyncio.new_event_loop()
-        asyncio.ensure_future(self._connect(), loop=self._loop)
-        asyncio.ensure_future(self._recv_loop(), loop=self._loop)
-        asyncio.ensure_future(self._send_loop(), loop=self._loop)
-        self._loop_thread = threading.Thread(target=self._start_loop, daemon=True)
-        self._loop_thread.start()
-
-    def _handle_close(self):
-        while True:
-            msg = self._close_pipe.get()
-            if msg == "close":
-                self._closed = True
-                self._loop.call_soon_threadsafe(self._loop.create_task, self.conn.close())
-                while not self.conn.closed:
-                    time.sleep(0.5)
-                break
-            if msg == "closed":
-                logger.warning("WebSocket service stopped unexpectedly, preparing to restart...")
-                time.sleep(5)
-                self._loop.call_soon_threadsafe(self._loop.create_task, self._connect())
-                continue
-
-    def _start_loop(self):
-        self._loop.run_forever()
-
-    async def _connect(self):
         try:
             self.conn = await websockets.connect(self._url,
                                                  ping_interval=PING_INTERVAL,
@@ -100,82 +102,62 @@ class WsClient:
                                                  close_timeout=CLOSE_TIMEOUT,
                                                  timeout=TIMEOUT,
                                                  extra_headers=(("Authorization", "Bearer " + net_conn.host.token),))
-            self._closed = False
-            logger.info("WebSocket service started")
-        except:
-            self._closed = True
-            self._close_pipe.put("closed")
-            logger.error("Failed to start WebSocket service")
+        except Exception as e:
+            logger.error("Failed to start WebSocket service: %s" % e)
+            return False
+        self._connected.set()
+        logger.info("WebSocket service started")
+        if self._on_connect:
+            self._on_connect()
+        return True
 
     async def _recv_loop(self):
-        while not self.conn:
-            if self._closed:
-                return
-            await asyncio.sleep(1)
-        logger.debug("Recv loop running")
-        while True:
-            if not self._closed:
-                try:
-                    msg = await self.conn.recv()
-                    logger.info("Message received: %s" % msg)
-                    self.recv_pipe.put(msg)
-                except:
-                    if not self._closed:
-                        self._close_pipe.put("closed")
-                        self._closed = True
-            else:
-                await asyncio.sleep(1)
+        import websockets
+
+        try:
+            while True:
+                msg = await self.conn.recv()
+                logger.info("Message received: %s" % msg)
+                self._on_message(msg)
+        except websockets.ConnectionClosed as e:
+            logger.warning("Connection closed: %s" % e)
+        finally:
+            self._connected.clear()
 
     async def _send_loop(self):
-        while not self.conn:
-            if self._closed:
-                return
-            await asyncio.sleep(1)
-        logger.debug("Send loop running")
+        latency = metrics.histogram("ws_send_seconds")
         while True:
-            if not self._closed:
+            msg, enqueue_time = await self._send_queue.get()
+            logger.debug("Sending message: %s" % msg)
+            # Keep the message until it is sent, the connection is re-established in between if needed
+            while True:
+                await self._connected.wait()
                 try:
-                    msg: str = self.send_pipe.get(block=False)
-                    asyncio.ensure_future(self._handle_send(msg))
-                except Empty:
-                    await asyncio.sleep(0.5)
-            else:
-                await asyncio.sleep(1)
-
-    async def _handle_send(self, msg: str):
-        logger.debug("Sending message: %s" % msg)
-        while True:
-            if not self._closed:
-                for i in range(5):
-                    try:
-                        if self._closed:
-                            break
-                        await self.conn.send(msg)
-                        logger.debug("Message sent: %s" % msg)
-                        return
-                    except:
-                        pass
-                if not self._closed:
+                    await self.conn.send(msg)
+                    break
+                except Exception:
                     logger.warning("Cannot send message, closing connection...")
-                    self._close_pipe.put("closed")
-                    self._closed = True
-            else:
-                await asyncio.sleep(1)
+                    await self.conn.close()
+                    self._connected.clear()
+            latency.observe(time.monotonic() - enqueue_time)
+            self._send_queue.task_done()
+            logger.debug("Message sent: %s" % msg)
 
 
 # For debugging
 def main():
-    url = "ws://echo.websocket.org"
-    pipe = multiprocessing.Queue()
-    wsc = WsClient(pipe)
-    wsc.start()
-    i = 0
-    ct = time.time()
-    while time.time() - ct < 10:
-        i += 1
-        wsc.send_msg("hello %d" % i)
-        time.sleep(2)
-    wsc.close()
+    log.init()
+    net_conn.init()
+
+    async def run():
+        wsc = WsClient(lambda msg: print(msg))
+        wsc.start()
+        for i in range(5):
+            wsc.send_msg("hello %d" % i)
+            await asyncio.sleep(2)
+        await wsc.close()
+
+    asyncio.get_event_loop().run_until_complete(run())
 
 
 if __name__ == '__main__':